@@ -0,0 +1,524 @@
+"""Benchmarks for the bot's hot paths.
+
+Always point this at a throwaway database, never the production one:
+
+    BENCH_DATABASE_URL=postgresql://localhost/lovebot_bench python bench.py drop
+
+Everything is created inside a scratch `bench` schema that is dropped afterwards.
+`explain` migrates the scratch schema, seeds it and checks that the hot queries
+use their indexes; it exits non-zero when one does not.
+
+`encode` needs no database; point it at exported card images with --cards-dir:
+
+    python bench.py encode --cards-dir ./card_images
+
+`suite` times the render hot paths (each case in a fresh process, so its peak
+RSS is its own) and, given a database, the drop/inventory/album queries.
+Save a baseline, then compare later runs against it; the run fails when a case
+gets slower or bigger than --threshold:
+
+    python bench.py suite --save-baseline baseline.json
+    python bench.py suite --baseline baseline.json
+"""
+import argparse
+import asyncio
+import hashlib
+import io
+import json
+import os
+import random
+import resource
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, timedelta
+
+import asyncpg
+from PIL import Image, ImageDraw
+
+import main as bot_main
+from main import (ALBUM_COLLECTED_QUERY, ALBUM_PAGE_COLLECTED_QUERY, SERIES_PROGRESS_QUERY,
+                  CardCatalog, InventoryQuery, blob_to_image, compose_drop_strip, create_blurred_card, create_collage,
+                  encode_as, encode_image, fetch_card_sources, rebuild_collection_stats, render_album_group,
+                  render_card_variant, render_drop_strip, encode_policy, RARITIES, run_migrations)
+
+BENCH_SCHEMA = 'bench'
+
+
+def make_card_image(width, height):
+    # Noise compresses badly, so the PNG is about as big as a real card photo
+    img = Image.frombytes('RGB', (width, height), os.urandom(width * height * 3))
+    with io.BytesIO() as buffer:
+        img.save(buffer, 'PNG')
+        return buffer.getvalue()
+
+
+def row_bytes(rows):
+    """Rough payload size of fetched rows (what asyncpg had to decode)."""
+    total = 0
+    for row in rows:
+        for value in row.values():
+            if isinstance(value, (bytes, bytearray, memoryview)):
+                total += len(value)
+            elif isinstance(value, str):
+                total += len(value.encode())
+    return total
+
+
+def make_photo_image(width, height, seed):
+    """A smoother synthetic card (gradient, shapes, light grain) for encoder runs."""
+    rng = random.Random(seed)
+    img = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+    img = Image.merge('RGB', [band.point(lambda v, k=rng.random(): int(v * k)) for band in img.split()])
+    draw = ImageDraw.Draw(img)
+    for _ in range(12):
+        x, y = rng.randrange(width), rng.randrange(height)
+        r = rng.randrange(20, width // 2)
+        draw.ellipse((x - r, y - r, x + r, y + r), fill=tuple(rng.randrange(256) for _ in range(3)))
+    grain = Image.effect_noise((width, height), 12).convert('RGB')
+    return Image.blend(img, grain, 0.08)
+
+
+def load_card_images(args):
+    if args.cards_dir:
+        names = sorted(os.listdir(args.cards_dir))
+        images = []
+        for name in names:
+            try:
+                with Image.open(os.path.join(args.cards_dir, name)) as img:
+                    images.append(img.convert('RGBA'))
+            except OSError:
+                continue
+        if not images:
+            raise SystemExit(f"no readable images in {args.cards_dir}")
+        return images
+    width, height = (int(part) for part in args.image_size.split('x'))
+    return [make_photo_image(width, height, seed).convert('RGBA') for seed in range(8)]
+
+
+async def create_pool(database_url):
+    conn = await asyncpg.connect(database_url)
+    try:
+        await conn.execute(f'DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE')
+        await conn.execute(f'CREATE SCHEMA {BENCH_SCHEMA}')
+    finally:
+        await conn.close()
+    return await asyncpg.create_pool(
+        database_url, min_size=1, max_size=4,
+        server_settings={'search_path': BENCH_SCHEMA},
+    )
+
+
+async def drop_schema(database_url):
+    conn = await asyncpg.connect(database_url)
+    try:
+        await conn.execute(f'DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE')
+    finally:
+        await conn.close()
+
+
+async def seed_cards(pool, start, stop, images):
+    """Add cards `start`..`stop` to a seeded schema, with the image inline in the
+    legacy `cards.image` column as well as its hash."""
+    digests = [hashlib.sha256(image).hexdigest() for image in images]
+    records = [
+        (f'c{i:06d}', f'Card {i}', date(2024, 1, 1), f'Series {i % 50}', 'common',
+         images[i % len(images)], digests[i % len(digests)])
+        for i in range(start, stop)
+    ]
+    async with pool.acquire() as conn:
+        await conn.copy_records_to_table(
+            'cards', records=records,
+            columns=['id', 'name', 'date', 'series', 'rarity', 'image', 'image_hash'],
+        )
+
+
+async def time_it(repeats, func):
+    timings, payload = [], 0
+    for _ in range(repeats):
+        started = time.perf_counter()
+        payload = await func()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings), payload
+
+
+def time_encode(repeats, func):
+    timings, size = [], 0
+    for _ in range(repeats):
+        started = time.perf_counter()
+        size = len(func())
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings), size
+
+
+def image_bytes(img):
+    with io.BytesIO() as buffer:
+        img.save(buffer, 'PNG')
+        return buffer.getvalue()
+
+
+async def bench_drop(args):
+    """Old `SELECT * FROM cards` drop versus catalog sampling + `ANY($1)` fetch."""
+    width, height = (int(part) for part in args.image_size.split('x'))
+    images = [make_card_image(width, height) for _ in range(8)]
+    print(f"Card image: {width}x{height}, ~{statistics.mean(map(len, images)) / 1024:.0f} KiB")
+
+    pool = await create_pool(args.database_url)
+    try:
+        async with pool.acquire() as conn:
+            await seed_schema(conn, 0)  # the real schema and its series; cards are added per size below
+
+        async def old_drop():
+            async with pool.acquire() as conn:
+                rows = await conn.fetch('SELECT * FROM cards')
+            random.sample(list(rows), 3)
+            return row_bytes(rows)
+
+        catalog = CardCatalog()
+
+        async def new_drop():
+            ids = catalog.sample(3)
+            async with pool.acquire() as conn:
+                rows = await conn.fetch('SELECT id, image FROM cards WHERE id = ANY($1::text[])', ids)
+            return row_bytes(rows)
+
+        print(f"{'cards':>7} {'old ms':>9} {'old MiB':>9} {'new ms':>9} {'new KiB':>9} {'load ms':>9}")
+        seeded = 0
+        for size in sorted(int(s) for s in args.sizes.split(',')):
+            await seed_cards(pool, seeded, size, images)
+            seeded = size
+
+            started = time.perf_counter()
+            await catalog.load(pool)
+            load_time = time.perf_counter() - started
+
+            old_time, old_bytes = await time_it(args.repeats, old_drop)
+            new_time, new_bytes = await time_it(args.repeats, new_drop)
+            print(f"{size:>7} {old_time * 1000:>9.1f} {old_bytes / 2**20:>9.1f} "
+                  f"{new_time * 1000:>9.1f} {new_bytes / 1024:>9.0f} {load_time * 1000:>9.1f}")
+    finally:
+        await pool.close()
+        await drop_schema(args.database_url)
+
+
+async def seed_schema(conn, card_count, blobs=(), users=500, per_user=40):
+    """Migrate the scratch schema and fill it: 50 series, `card_count` cards, and
+    `per_user` cards in each of `users` inventories. Cards point at `blobs`
+    (image bytes, stored in card_blobs) round-robin. Returns the seed time."""
+    await run_migrations(conn)
+    digests = [hashlib.sha256(blob).hexdigest() for blob in blobs]
+    if blobs:
+        await conn.copy_records_to_table('card_blobs', records=list(zip(digests, blobs)), columns=['hash', 'data'])
+    await conn.copy_records_to_table('series', records=[(f'Series {i}', None) for i in range(50)],
+                                     columns=['name', 'emoji'])
+    await conn.copy_records_to_table('cards', records=[
+        (f'c{i:06d}', f'Card {i}', date(2024, 1, 1), f'Series {i % 50}', 'common',
+         digests[i % len(digests)] if digests else f'{i:064x}')
+        for i in range(card_count)
+    ], columns=['id', 'name', 'date', 'series', 'rarity', 'image_hash'])
+    now = datetime.now()
+    rng = random.Random(0)
+    await conn.copy_records_to_table('inventory', records=[
+        (user_id, f'c{card:06d}', rng.randint(1, 3), now - timedelta(minutes=rng.randrange(100000)))
+        for user_id in range(users)
+        for card in rng.sample(range(card_count), min(per_user, card_count))
+    ], columns=['user_id', 'card_id', 'quantity', 'grabbed_time'])
+    await rebuild_collection_stats(conn)  # COPY bypasses the grab flush that keeps them
+    await conn.execute('ANALYZE')
+    return now
+
+
+class ExplainConn:
+    """Stands in for a connection: EXPLAINs each query instead of running it."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.plans = []
+
+    async def fetch(self, query, *args):
+        plan = await self.conn.fetchval(f'EXPLAIN (FORMAT JSON) {query}', *args)
+        self.plans.append(json.loads(plan)[0]['Plan'])
+        return []
+
+
+def plan_nodes(plan):
+    yield plan
+    for child in plan.get('Plans', ()):
+        yield from plan_nodes(child)
+
+
+async def bench_explain(args):
+    """Assert the hot queries are served by indexes on a migrated, seeded schema."""
+    card_count = max(int(s) for s in args.sizes.split(','))
+    pool = await create_pool(args.database_url)
+    try:
+        async with pool.acquire() as conn:
+            now = await seed_schema(conn, card_count)
+
+            explain = ExplainConn(conn)
+            recent = InventoryQuery(7)
+            await recent.page(explain, None, 10)
+            await recent.page(explain, (now, 'c000100'), 10)
+            await explain.fetch('SELECT id FROM cards WHERE series = $1', 'Series 3')
+            await explain.fetch(ALBUM_COLLECTED_QUERY, 7, 'Series 3')
+            await explain.fetch(ALBUM_PAGE_COLLECTED_QUERY, 7, ['c000001', 'c000051', 'c000101', 'c000151'])
+            await explain.fetch(SERIES_PROGRESS_QUERY, 7, 'Series 3')
+
+        checks = [
+            ('inventory, first page', 'inventory_user_grabbed_idx'),
+            ('inventory, next page', 'inventory_user_grabbed_idx'),
+            ('cards by series', 'cards_series_idx'),
+            ('album collected cards', None),  # any index; the planner may start from either table
+            ('album page collected', 'inventory_pkey'),
+            ('series progress', 'collection_stats_pkey'),
+        ]
+        failed = 0
+        for (label, expected), plan in zip(checks, explain.plans):
+            nodes = list(plan_nodes(plan))
+            indexes = {node['Index Name'] for node in nodes if 'Index Name' in node}
+            seq_scans = {node['Relation Name'] for node in nodes if node['Node Type'] == 'Seq Scan'}
+            ok = not seq_scans and (expected is None or expected in indexes)
+            failed += not ok
+            detail = f"indexes: {', '.join(sorted(indexes)) or '-'}"
+            if seq_scans:
+                detail += f"; seq scan on {', '.join(sorted(seq_scans))}"
+            print(f"{'ok  ' if ok else 'FAIL'} {label:<24} {detail}")
+    finally:
+        await pool.close()
+        await drop_schema(args.database_url)
+    if failed:
+        raise SystemExit(f"{failed} quer{'y' if failed == 1 else 'ies'} not using the expected index")
+
+
+ENCODE_POLICIES = [
+    ('png', 6), ('png', 1), ('png8', 9),
+    ('webp', 90), ('webp', 80), ('webp-lossless', 50),
+    ('jpeg', 90), ('jpeg', 80),
+]
+
+
+async def bench_encode(args):
+    """Encode time versus size for drop strips and album collages, per format policy."""
+    images = load_card_images(args)
+    print(f"{len(images)} card images, e.g. {images[0].width}x{images[0].height}")
+
+    rng = random.Random(0)
+    labels = [(RARITIES[name][1], RARITIES[name][2]) for name in ('common', 'rare', 'epic')]
+    outputs = {
+        'drop': compose_drop_strip([image_bytes(rng.choice(images)) for _ in range(3)], 500, labels),
+        'album': create_collage([rng.choice(images) for _ in range(4)], ['a1', 'b2', 'c3', 'd4'], 400),
+    }
+
+    for output, canvas in outputs.items():
+        print(f"\n{output}: {canvas.width}x{canvas.height} {canvas.mode}")
+        print(f"{'policy':>18} {'ms':>9} {'KiB':>9}")
+        for fmt, quality in ENCODE_POLICIES:
+            if fmt == 'jpeg':
+                # encode_image would switch transparent canvases to WebP; measure JPEG on the flattened image
+                subject = Image.new('RGB', canvas.size, (0, 0, 0))
+                subject.paste(canvas, mask=canvas.getchannel('A'))
+            else:
+                subject = canvas
+            elapsed, size = time_encode(args.repeats, lambda: encode_as(subject, fmt, quality))
+            print(f"{fmt + ':' + str(quality):>18} {elapsed * 1000:>9.1f} {size / 1024:>9.0f}")
+
+        fmt, quality, max_bytes = encode_policy(output)
+        elapsed, size = time_encode(args.repeats, lambda: encode_image(canvas, output))
+        print(f"{'current policy':>18} {elapsed * 1000:>9.1f} {size / 1024:>9.0f}  ({fmt}:{quality}, budget {max_bytes})")
+
+
+#___________________________________________________________Suite___________________________________________________________
+RENDER_SETUP = {}  # render case name -> setup(image bytes) returning the case's arguments, built in its worker
+RENDER_CASES = {}  # render case name -> function timed with those arguments
+
+
+def render_case(name, setup):
+    def register(func):
+        RENDER_SETUP[name] = setup
+        RENDER_CASES[name] = func
+        return func
+    return register
+
+
+def drop_variants(blobs):
+    return [render_card_variant(blob, 'drop', 500) for blob in blobs[:3]]
+
+
+def album_variants(blobs):
+    return [render_card_variant(blob, 'album', 400) for blob in blobs[:4]]
+
+
+DROP_LABELS = [(RARITIES[name][1], RARITIES[name][2]) for name in ('common', 'rare', 'epic')]
+ALBUM_IDS = ['c000001', 'c000002', 'c000003', 'c000004']
+
+render_case('blurred_card', lambda blobs: (blobs[0], 400))(create_blurred_card)
+render_case('card_variants', lambda blobs: (blobs[0],))(
+    lambda blob: [render_card_variant(blob, variant, height) for variant, height in bot_main.CARD_VARIANTS])
+render_case('collage', lambda blobs: ([blob_to_image(blob) for blob in album_variants(blobs)], ALBUM_IDS, 400))(
+    create_collage)
+render_case('album_page', lambda blobs: (list(zip(ALBUM_IDS, album_variants(blobs))), 400))(render_album_group)
+render_case('drop_compose', lambda blobs: (drop_variants(blobs), 500, DROP_LABELS))(compose_drop_strip)
+render_case('drop_strip', lambda blobs: (drop_variants(blobs), 500, DROP_LABELS))(render_drop_strip)
+
+
+def run_render_case(name, blobs, repeats):
+    """Time one render case (runs alone in a fresh worker process)."""
+    case_args = RENDER_SETUP[name](blobs)
+    RENDER_CASES[name](*case_args)  # warm-up: font loading, lazy imports
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        RENDER_CASES[name](*case_args)
+        timings.append(time.perf_counter() - started)
+    return timings, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KiB on Linux
+
+
+def summarize(timings, peak_rss_mib=None):
+    timings = sorted(timings)
+    return {
+        'p50_ms': round(statistics.median(timings) * 1000, 3),
+        'p95_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.95))] * 1000, 3),
+        'ops_per_s': round(len(timings) / sum(timings), 2),
+        'peak_rss_mib': round(peak_rss_mib, 1) if peak_rss_mib is not None else None,
+    }
+
+
+async def time_queries(repeats, func):
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        await func()
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+async def sql_cases(args, blobs):
+    pool = await create_pool(args.database_url)
+    results = {}
+    try:
+        async with pool.acquire() as conn:
+            await seed_schema(conn, args.cards, blobs)
+        catalog = CardCatalog()
+        await catalog.load(pool)
+        user_id = 7
+        album_page = sorted(card_id for card_id, card in catalog.cards.items() if card['series'] == 'Series 3')[:4]
+
+        async def drop():
+            await fetch_card_sources(pool, catalog.sample(3))
+
+        async def inventory():
+            query = InventoryQuery(user_id)
+            async with pool.acquire() as conn:
+                await query.count(conn)
+                await query.page(conn, None, bot_main.INVENTORY_PAGE_SIZE)
+
+        async def album():
+            async with pool.acquire() as conn:
+                await conn.fetchrow(SERIES_PROGRESS_QUERY, user_id, 'Series 3')
+                await conn.fetch(ALBUM_PAGE_COLLECTED_QUERY, user_id, album_page)
+
+        async def catalog_load():
+            await CardCatalog().load(pool)
+
+        store = bot_main.bot.blob_store
+        bot_main.bot.blob_store = bot_main.PostgresBlobStore()  # the cards were seeded into card_blobs
+        try:
+            for name, func in (('sql_drop', drop), ('sql_inventory', inventory),
+                               ('sql_album', album), ('sql_catalog_load', catalog_load)):
+                await func()
+                results[name] = summarize(await time_queries(args.repeats, func))
+        finally:
+            bot_main.bot.blob_store = store
+    finally:
+        await pool.close()
+        await drop_schema(args.database_url)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Print each case against the baseline; returns the names of regressed cases."""
+    regressed = []
+    print(f"\n{'case':<18} {'p50 ms':>9} {'base':>9} {'change':>8} {'RSS MiB':>8} {'base':>8}")
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print(f"{name:<18} {result['p50_ms']:>9.1f} {'-':>9}")
+            continue
+        change = result['p50_ms'] / base['p50_ms'] - 1 if base['p50_ms'] else 0.0
+        worse = change > threshold
+        rss, base_rss = result['peak_rss_mib'], base.get('peak_rss_mib')
+        if rss is not None and base_rss:
+            worse = worse or rss / base_rss - 1 > threshold
+        if worse:
+            regressed.append(name)
+        print(f"{name:<18} {result['p50_ms']:>9.1f} {base['p50_ms']:>9.1f} {change:>+8.0%} "
+              f"{rss if rss is not None else '-':>8} {base_rss if base_rss is not None else '-':>8}"
+              f"{'  REGRESSED' if worse else ''}")
+    return regressed
+
+
+async def bench_suite(args):
+    """Render and (with a database) query hot paths, compared against a saved baseline."""
+    width, height = (int(part) for part in args.image_size.split('x'))
+    blobs = [image_bytes(make_photo_image(width, height, seed)) for seed in range(8)]
+    print(f"{args.cards} cards, {width}x{height} images, {args.repeats} repeats per case")
+
+    results = {}
+    loop = asyncio.get_running_loop()
+    for name in RENDER_CASES:
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            timings, peak_rss = await loop.run_in_executor(executor, run_render_case, name, blobs, args.repeats)
+        results[name] = summarize(timings, peak_rss)
+    if args.database_url:
+        results.update(await sql_cases(args, blobs))
+    else:
+        print("No database given, skipping the SQL cases")
+
+    print(f"\n{'case':<18} {'p50 ms':>9} {'p95 ms':>9} {'ops/s':>9} {'RSS MiB':>8}")
+    for name, result in results.items():
+        rss = result['peak_rss_mib']
+        print(f"{name:<18} {result['p50_ms']:>9.1f} {result['p95_ms']:>9.1f} {result['ops_per_s']:>9.1f} "
+              f"{rss if rss is not None else '-':>8}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({'cards': args.cards, 'image_size': args.image_size, 'results': results}, f, indent=2)
+        print(f"Baseline saved to {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressed = compare(results, baseline['results'], args.threshold)
+        if regressed:
+            raise SystemExit(f"{len(regressed)} case(s) regressed past {args.threshold:.0%}: {', '.join(regressed)}")
+
+
+BENCHMARKS = {
+    'drop': bench_drop,
+    'encode': bench_encode,
+    'explain': bench_explain,
+    'suite': bench_suite,
+}
+DATABASE_BENCHMARKS = {'drop', 'explain'}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--database-url', default=os.getenv('BENCH_DATABASE_URL'))
+    parser.add_argument('--sizes', default='100,500,1000,2000', help='card counts to measure at')
+    parser.add_argument('--image-size', default='400x600', help='synthetic card size, WxH')
+    parser.add_argument('--cards-dir', help='directory of real card images for the encode benchmark')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--cards', type=int, default=2000, help='synthetic card set size for the suite')
+    parser.add_argument('--save-baseline', help='write the suite results to this JSON file')
+    parser.add_argument('--baseline', help='compare the suite results with this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown/growth, e.g. 0.2 = 20%%')
+    args = parser.parse_args()
+
+    if args.benchmark in DATABASE_BENCHMARKS and not args.database_url:
+        parser.error('set BENCH_DATABASE_URL or pass --database-url (use a throwaway database!)')
+    asyncio.run(BENCHMARKS[args.benchmark](args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,276 @@
+"""Run the bot as a cluster: several processes, each owning a range of shards.
+
+    python cluster.py                       # one worker per core, Discord's recommended shard count
+    python cluster.py --workers 4 --shards 16
+
+Each worker is `python main.py` with SHARD_IDS, SHARD_COUNT and CLUSTER_ID set,
+so gateway events, Pillow renders and queries spread over cores instead of
+sharing one GIL. Workers start one at a time, each once the previous one's
+shards are ready, which keeps identifies within Discord's rate limit.
+
+DB_CONNECTION_BUDGET caps the Postgres connections of the whole cluster: every
+worker's pool gets an equal share, less the connection it keeps for LISTEN.
+Likewise the cores: unless RENDER_WORKERS is set, each worker's Pillow pool
+gets cpu_count // workers processes (at least one).
+
+Memory is per worker, so budget it times --workers: IMAGE_CACHE_BYTES
+(256 MiB) of card images, DROP_BUFFER_BYTES (16 MiB) of pre-rendered drops,
+the card catalog, and RENDER_WORKERS render processes.
+
+Workers serve /health and /metrics on --metrics-port + 1 + their cluster id.
+The launcher polls them, prints a status line every --report-interval seconds,
+restarts workers that exit, and serves the combined state on
+--metrics-port/health (503 until every worker is ready).
+"""
+import argparse
+import asyncio
+import os
+import signal
+import sys
+import time
+
+import aiohttp
+from aiohttp import web
+from dotenv import load_dotenv
+
+GATEWAY_URL = 'https://discord.com/api/v10/gateway/bot'
+MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+READY_SECONDS_PER_SHARD = 15  # how long a worker may take to connect before the next one starts anyway
+RESTART_BACKOFF = (1, 5, 15, 60)  # seconds before restarting a worker, by consecutive crash
+STABLE_SECONDS = 300  # a worker up this long has its crash count reset
+
+
+def shard_ranges(shard_count, workers):
+    """Split shards 0..shard_count-1 into `workers` contiguous, near-equal ranges."""
+    size, extra = divmod(shard_count, workers)
+    ranges, start = [], 0
+    for worker in range(workers):
+        end = start + size + (worker < extra)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+
+def worker_pool_size(budget, workers):
+    """One worker's pool size: its share of the budget, less its LISTEN connection."""
+    size = budget // workers - 1
+    if size < 1:
+        raise SystemExit(f"DB_CONNECTION_BUDGET={budget} is too small for {workers} workers (need {2 * workers})")
+    return size
+
+
+async def recommended_shards(session, token):
+    async with session.get(GATEWAY_URL, headers={'Authorization': f'Bot {token}'}) as response:
+        response.raise_for_status()
+        return (await response.json())['shards']
+
+
+#___________________________________________________________Workers___________________________________________________________
+class Worker:
+    def __init__(self, cluster_id, cluster_count, shard_ids, shard_count, host, port, pool_size=None,
+                 render_workers=None):
+        self.cluster_id = cluster_id
+        self.cluster_count = cluster_count
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.host = host
+        self.port = port
+        self.pool_size = pool_size
+        self.render_workers = render_workers
+        self.process = None
+        self.started_at = None
+        self.crashes = 0  # consecutive, reset once the worker stays up
+        self.health = None  # last /health reply, None while unreachable
+
+    @property
+    def name(self):
+        return f"worker {self.cluster_id} (shards {self.shard_ids[0]}-{self.shard_ids[-1]})"
+
+    def environment(self):
+        env = dict(os.environ,
+                   SHARD_IDS=','.join(map(str, self.shard_ids)),
+                   SHARD_COUNT=str(self.shard_count),
+                   CLUSTER_ID=str(self.cluster_id),
+                   CLUSTER_COUNT=str(self.cluster_count),
+                   METRICS_HOST=self.host,
+                   METRICS_PORT=str(self.port))
+        if self.pool_size is not None:
+            env['DB_POOL_MAX_SIZE'] = str(self.pool_size)
+        if self.render_workers is not None:
+            env['RENDER_WORKERS'] = str(self.render_workers)
+        return env
+
+    async def start(self):
+        self.health = None
+        # A session of its own, so a Ctrl+C in the terminal reaches only the launcher
+        self.process = await asyncio.create_subprocess_exec(sys.executable, MAIN, env=self.environment(),
+                                                            start_new_session=True)
+        self.started_at = time.monotonic()
+        print(f"Started {self.name} as pid {self.process.pid}")
+
+    @property
+    def running(self):
+        return self.process is not None and self.process.returncode is None
+
+    async def poll(self, session):
+        try:
+            async with session.get(f'http://{self.host}:{self.port}/health',
+                                   timeout=aiohttp.ClientTimeout(total=2)) as response:
+                self.health = await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+            self.health = None
+        return self.health
+
+    async def wait_ready(self, session, timeout):
+        deadline = time.monotonic() + timeout
+        while self.running and time.monotonic() < deadline:
+            health = await self.poll(session)
+            if health and health['ready']:
+                return True
+            await asyncio.sleep(1)
+        return False
+
+    async def stop(self, timeout):
+        if not self.running:
+            return
+        # discord.py closes cleanly on KeyboardInterrupt, flushing queued grabs
+        self.process.send_signal(signal.SIGINT)
+        try:
+            await asyncio.wait_for(self.process.wait(), timeout)
+        except asyncio.TimeoutError:
+            print(f"{self.name} did not exit in {timeout:.0f}s, killing it")
+            self.process.kill()
+            await self.process.wait()
+
+    def status(self):
+        if not self.running:
+            return f"{self.name}: down"
+        health = self.health
+        if health is None:
+            return f"{self.name}: starting, pid {self.process.pid}"
+        latencies = '/'.join(f"{shard['latency_ms']:.0f}" if shard['latency_ms'] is not None else '-'
+                             for shard in health['shards'].values())
+        pool = health['db_pool']
+        pool_text = f"{pool['size'] - pool['idle']}/{pool['max']}" if pool else '-'
+        return (f"{self.name}: {'ready' if health['ready'] else 'connecting'}, pid {health['pid']}, "
+                f"{health['guilds']} guilds, latency {latencies or '-'} ms, pool {pool_text} busy, "
+                f"{health['render_pending']} renders pending, loop lag p99 {health['loop_lag_p99_ms']} ms")
+
+
+#___________________________________________________________Cluster___________________________________________________________
+class Cluster:
+    def __init__(self, workers, args):
+        self.workers = workers
+        self.args = args
+        self.stopping = asyncio.Event()
+        self.session = None
+        self._tasks = []
+
+    async def supervise(self, worker):
+        """Restart `worker` whenever it exits, backing off while it keeps crashing."""
+        while not self.stopping.is_set():
+            code = await worker.process.wait()
+            if self.stopping.is_set():
+                return
+            if time.monotonic() - worker.started_at > STABLE_SECONDS:
+                worker.crashes = 0
+            delay = RESTART_BACKOFF[min(worker.crashes, len(RESTART_BACKOFF) - 1)]
+            worker.crashes += 1
+            print(f"{worker.name} exited with code {code}, restarting in {delay}s")
+            try:
+                await asyncio.wait_for(self.stopping.wait(), delay)
+                return
+            except asyncio.TimeoutError:
+                await worker.start()
+
+    async def report(self):
+        while True:
+            await asyncio.gather(*(worker.poll(self.session) for worker in self.workers if worker.running))
+            print('\n'.join(worker.status() for worker in self.workers))
+            await asyncio.sleep(self.args.report_interval)
+
+    async def serve_health(self, request):
+        workers = [{'cluster': worker.cluster_id, 'shard_ids': worker.shard_ids, 'running': worker.running,
+                    'crashes': worker.crashes, 'health': worker.health} for worker in self.workers]
+        ready = all(worker['health'] and worker['health']['ready'] for worker in workers)
+        return web.json_response({'ready': ready, 'workers': workers}, status=200 if ready else 503)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, self.stopping.set)
+
+        app = web.Application()
+        app.router.add_get('/health', self.serve_health)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, self.args.metrics_host, self.args.metrics_port).start()
+
+        self.session = aiohttp.ClientSession()
+        try:
+            for worker in self.workers:
+                if self.stopping.is_set():
+                    break
+                await worker.start()
+                self._tasks.append(asyncio.create_task(self.supervise(worker)))
+                timeout = READY_SECONDS_PER_SHARD * len(worker.shard_ids)
+                if not await worker.wait_ready(self.session, timeout):
+                    print(f"{worker.name} not ready after {timeout}s, starting the next worker anyway")
+            print(f"Cluster health on http://{self.args.metrics_host}:{self.args.metrics_port}/health")
+            self._tasks.append(asyncio.create_task(self.report()))
+            await self.stopping.wait()
+        finally:
+            print("Stopping workers...")
+            self.stopping.set()
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*(worker.stop(self.args.stop_timeout) for worker in self.workers))
+            await self.session.close()
+            await runner.cleanup()
+
+
+async def run(args):
+    shard_count = args.shards
+    if shard_count is None:
+        token = os.getenv('DISCORD_TOKEN')
+        if not token:
+            raise SystemExit("Error: No token found! Set DISCORD_TOKEN or pass --shards")
+        async with aiohttp.ClientSession() as session:
+            shard_count = await recommended_shards(session, token)
+        print(f"Discord recommends {shard_count} shard(s)")
+
+    workers = max(1, min(args.workers, shard_count))
+    pool_size = worker_pool_size(args.connection_budget, workers) if args.connection_budget else None
+    # Every worker would otherwise start a render process per core
+    render_workers = None if os.getenv('RENDER_WORKERS') else max(1, (os.cpu_count() or 1) // workers)
+    print(f"Running {shard_count} shard(s) on {workers} worker(s)"
+          + (f", {pool_size} pooled connections each" if pool_size else '')
+          + (f", {render_workers} render process(es) each" if render_workers else ''))
+
+    cluster = Cluster([
+        Worker(cluster_id, workers, shard_ids, shard_count, args.metrics_host, args.metrics_port + 1 + cluster_id,
+               pool_size, render_workers)
+        for cluster_id, shard_ids in enumerate(shard_ranges(shard_count, workers))
+    ], args)
+    await cluster.run()
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=int(os.getenv('CLUSTER_WORKERS', os.cpu_count() or 1)),
+                        help='worker processes (at most one per shard)')
+    parser.add_argument('--shards', type=int, default=int(os.getenv('SHARD_COUNT')) if os.getenv('SHARD_COUNT') else None,
+                        help="total shards (default: Discord's recommendation)")
+    parser.add_argument('--connection-budget', type=int, default=int(os.getenv('DB_CONNECTION_BUDGET', 0)),
+                        help='Postgres connections for the whole cluster (default: DB_POOL_MAX_SIZE per worker)')
+    parser.add_argument('--metrics-host', default=os.getenv('METRICS_HOST', '127.0.0.1'))
+    parser.add_argument('--metrics-port', type=int, default=int(os.getenv('METRICS_PORT', 9100)),
+                        help='cluster /health port; worker N serves on this + 1 + N')
+    parser.add_argument('--report-interval', type=float, default=60, help='seconds between status lines')
+    parser.add_argument('--stop-timeout', type=float, default=30, help='seconds a worker gets to shut down')
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Dump a table, or one user's collection, to CSV or JSON lines.
+
+    python export.py inventory                      # -> inventory.csv
+    python export.py cards --format jsonl --gzip    # -> cards.jsonl.gz
+    python export.py --user 1234567890 -o alice.csv
+    python export.py inventory --split-mb 100       # -> inventory.part1.csv, inventory.part2.csv, ...
+
+Rows are streamed from a server-side cursor in --chunk-rows batches and
+written out as they arrive, so memory stays flat however big the table is.
+Tables: cards, inventory, series, collection_stats, user_totals.
+"""
+import argparse
+import asyncio
+import os
+import time
+
+import asyncpg
+from dotenv import load_dotenv
+
+from main import EXPORT_CHUNK_ROWS, EXPORT_FORMATS, EXPORT_TABLES, USER_EXPORT_QUERY, ExportWriter, export_rows
+
+
+def part_path(output, number, split):
+    if not split:
+        return output
+    directory, filename = os.path.split(output)
+    base, dot, extension = filename.partition('.')
+    return os.path.join(directory, f"{base}.part{number}{dot}{extension}")
+
+
+async def export(args):
+    started = time.perf_counter()
+    if args.user is not None:
+        query, query_args, name = USER_EXPORT_QUERY, (args.user,), f'collection-{args.user}'
+    else:
+        query, query_args, name = EXPORT_TABLES[args.table], (), args.table
+
+    split = args.split_mb * 1024 * 1024 if args.split_mb else None
+    writer = ExportWriter(args.format, args.gzip, part_bytes=split)
+    output = args.output or f"{name}.{writer.extension}"
+    writer.open_part = lambda number: open(part_path(output, number, split), 'w+b')
+
+    pool = await asyncpg.create_pool(args.database_url, min_size=1, max_size=1)
+    try:
+        rows = await export_rows(pool, query, query_args, writer, args.chunk_rows)
+    finally:
+        await pool.close()
+        for part in writer.parts:
+            part.close()
+
+    elapsed = time.perf_counter() - started
+    paths = [part_path(output, number, split) for number in range(1, len(writer.parts) + 1)]
+    print(f"{rows} row(s) in {elapsed:.1f}s -> {', '.join(paths) or 'nothing written'}")
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('table', nargs='?', choices=sorted(EXPORT_TABLES), help='table to dump')
+    parser.add_argument('--user', type=int, help="export one user's collection instead of a table")
+    parser.add_argument('--format', choices=EXPORT_FORMATS, default='csv')
+    parser.add_argument('--gzip', action='store_true', help='compress while writing')
+    parser.add_argument('-o', '--output', help='output file (default: <table>.<format>[.gz])')
+    parser.add_argument('--split-mb', type=int, help='start a new part file every N MiB')
+    parser.add_argument('--chunk-rows', type=int, default=EXPORT_CHUNK_ROWS, help='rows per cursor fetch')
+    parser.add_argument('--database-url', default=os.getenv('DATABASE_URL'))
+    args = parser.parse_args()
+
+    if (args.table is None) == (args.user is None):
+        parser.error('pass either a table or --user')
+    if not args.database_url:
+        parser.error('set DATABASE_URL or pass --database-url')
+    asyncio.run(export(args))
+
+
+if __name__ == '__main__':
+    main()
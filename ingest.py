@@ -0,0 +1,322 @@
+"""Bulk-load cards from a manifest or a directory of images.
+
+    python ingest.py cards/manifest.csv
+    python ingest.py cards/            # uses cards/manifest.csv or .json if present
+
+A manifest (CSV with a header row, or a JSON list of objects) has the columns
+id, name, date, series, notes, series_emoji and optionally rarity and image
+(a path relative to the manifest; defaults to the file named after the id).
+A directory without a manifest becomes one card per image: the file name is
+the id and name, and the sub-directory it sits in is the series.
+
+Images are EXIF-rotated, clamped to --max-dimension and re-encoded in a process
+pool, and their drop/album variants are rendered into the image cache. Rows are
+loaded with COPY and upserted in one transaction. Cards whose metadata and image
+hash are unchanged are skipped, so re-running is cheap.
+"""
+import argparse
+import asyncio
+import csv
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import asyncpg
+from dotenv import load_dotenv
+from PIL import Image, ImageOps
+
+from main import (CARD_ID_MAX_LENGTH, CARD_VARIANTS, DEFAULT_RARITY, MIGRATIONS, RARITIES, DerivedImageCache,
+                  PostgresBlobStore, create_blob_store, encode_image, has_transparency, parse_card_date,
+                  render_card_variant)
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.gif', '.bmp')
+MANIFEST_NAMES = ('manifest.csv', 'manifest.json')
+CARD_FIELDS = ('id', 'name', 'date', 'series', 'notes', 'series_emoji', 'rarity')
+COPY_BATCH = 200
+
+
+class IngestError(Exception):
+    pass
+
+
+#___________________________________________________________Reading cards___________________________________________________________
+def find_image(directory, card_id):
+    for extension in IMAGE_EXTENSIONS:
+        path = os.path.join(directory, card_id + extension)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def read_manifest(path):
+    directory = os.path.dirname(os.path.abspath(path))
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        if path.endswith('.json'):
+            entries = json.load(f)
+        else:
+            entries = list(csv.DictReader(f))
+    for entry in entries:
+        image = entry.get('image')
+        if image:
+            entry['image'] = os.path.join(directory, image)
+        elif entry.get('id'):
+            entry['image'] = find_image(directory, str(entry['id']).strip())
+    return entries
+
+
+def scan_directory(directory):
+    for name in MANIFEST_NAMES:
+        if os.path.exists(os.path.join(directory, name)):
+            return read_manifest(os.path.join(directory, name))
+
+    entries = []
+    for root, _, files in os.walk(directory):
+        series = os.path.relpath(root, directory)
+        for name in sorted(files):
+            stem, extension = os.path.splitext(name)
+            if extension.lower() in IMAGE_EXTENSIONS:
+                entries.append({
+                    'id': stem,
+                    'name': stem.replace('_', ' '),
+                    'series': None if series == '.' else series,
+                    'image': os.path.join(root, name),
+                })
+    return entries
+
+
+def normalize_date(value):
+    try:
+        return parse_card_date(value)
+    except ValueError as e:
+        raise IngestError(str(e)) from None
+
+
+def normalize_entry(entry):
+    """Clean one manifest entry into a card dict (plus its image path)."""
+    card = {}
+    for field in CARD_FIELDS:
+        value = entry.get(field)
+        value = str(value).strip() if value is not None else ''
+        card[field] = value or None
+
+    if not card['id']:
+        raise IngestError("missing id")
+    if len(card['id']) > CARD_ID_MAX_LENGTH:
+        raise IngestError(f"id longer than {CARD_ID_MAX_LENGTH} characters")
+    if not card['name']:
+        raise IngestError("missing name")
+    if card['date']:
+        card['date'] = normalize_date(card['date'])
+    card['rarity'] = (card['rarity'] or DEFAULT_RARITY).lower()
+    if card['rarity'] not in RARITIES:
+        raise IngestError(f"unknown rarity {card['rarity']!r} (expected one of {', '.join(RARITIES)})")
+
+    image = entry.get('image')
+    if not image or not os.path.exists(image):
+        raise IngestError(f"image not found ({image or 'no file named after the id'})")
+    return card, image
+
+
+#___________________________________________________________Image preparation___________________________________________________________
+def prepare_card(path, max_dimension, known_hash):
+    """Normalize one card image (runs in the process pool).
+
+    Returns (hash, image bytes, [(variant, height, bytes)]); the bytes and
+    variants are None when the image hash is `known_hash`, i.e. unchanged.
+    """
+    with Image.open(path) as img:
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
+        img = img.convert('RGBA')
+        if not has_transparency(img):
+            img = img.convert('RGB')
+    data = encode_image(img, 'source')
+
+    digest = hashlib.sha256(data).hexdigest()
+    if digest == known_hash:
+        return digest, None, None
+    variants = [(variant, height, render_card_variant(data, variant, height)) for variant, height in CARD_VARIANTS]
+    return digest, data, variants
+
+
+#___________________________________________________________Loading___________________________________________________________
+async def check_schema(conn):
+    latest = max(version for version, *_ in MIGRATIONS)
+    current = 0
+    if await conn.fetchval("SELECT to_regclass('schema_version') IS NOT NULL"):
+        current = await conn.fetchval('SELECT COALESCE(MAX(version), 0) FROM schema_version')
+    if current < latest:
+        raise IngestError(f"database schema is at version {current}, expected {latest}: start the bot once to migrate it")
+
+
+async def load_existing(conn, card_ids):
+    rows = await conn.fetch(f'''
+        SELECT {', '.join(CARD_FIELDS)}, image_hash FROM cards WHERE id = ANY($1::text[])
+    ''', card_ids)
+    return {row['id']: dict(row) for row in rows}
+
+
+async def ingest(args):
+    started = time.perf_counter()
+    if os.path.isdir(args.source):
+        entries = scan_directory(args.source)
+    else:
+        entries = read_manifest(args.source)
+
+    cards, errors, seen = [], [], set()
+    for number, entry in enumerate(entries, 1):
+        try:
+            card, image = normalize_entry(entry)
+            if card['id'] in seen:
+                raise IngestError("duplicate id")
+        except IngestError as e:
+            errors.append(f"#{number} {entry.get('id') or '?'}: {e}")
+            continue
+        seen.add(card['id'])
+        cards.append((card, image))
+    print(f"{len(cards)} cards read from {args.source}")
+
+    store = create_blob_store()
+    store_in_postgres = isinstance(store, PostgresBlobStore)
+    image_cache = DerivedImageCache(None, None)
+    loop = asyncio.get_running_loop()
+    limit = asyncio.Semaphore(args.workers * 4)  # bounds the bytes held in memory
+
+    conn = await asyncpg.connect(args.database_url)
+    try:
+        await check_schema(conn)
+        existing = await load_existing(conn, [card['id'] for card, _ in cards])
+
+        async with conn.transaction():
+            await conn.execute('''
+                CREATE TEMP TABLE ingest_cards (
+                    id TEXT, name TEXT, date DATE, series TEXT, notes TEXT,
+                    series_emoji TEXT, rarity TEXT, image_hash TEXT
+                ) ON COMMIT DROP
+            ''')
+            if store_in_postgres:
+                await conn.execute('CREATE TEMP TABLE ingest_blobs (hash TEXT, data BYTEA) ON COMMIT DROP')
+
+            card_rows, blob_rows = [], []
+            processed = changed = unchanged = 0
+
+            async def flush():
+                if card_rows:
+                    await conn.copy_records_to_table('ingest_cards', records=card_rows,
+                                                     columns=[*CARD_FIELDS, 'image_hash'])
+                    card_rows.clear()
+                if blob_rows:
+                    await conn.copy_records_to_table('ingest_blobs', records=blob_rows, columns=['hash', 'data'])
+                    blob_rows.clear()
+
+            async def prepare(card, image):
+                known = existing.get(card['id'], {}).get('image_hash')
+                async with limit:
+                    try:
+                        return card, await loop.run_in_executor(
+                            executor, prepare_card, image, args.max_dimension, known)
+                    except Exception as e:
+                        return card, e
+
+            with ProcessPoolExecutor(args.workers) as executor:
+                for next_card in asyncio.as_completed([prepare(card, image) for card, image in cards]):
+                    card, result = await next_card
+                    processed += 1
+                    if processed % 500 == 0:
+                        print(f"  {processed}/{len(cards)} prepared")
+                    if isinstance(result, Exception):
+                        errors.append(f"{card['id']}: {result}")
+                        continue
+
+                    digest, data, variants = result
+                    row = (*(card[field] for field in CARD_FIELDS), digest)
+                    old = existing.get(card['id'])
+                    if old and row == (*(old[field] for field in CARD_FIELDS), old['image_hash']):
+                        unchanged += 1
+                        continue
+                    changed += 1
+                    card_rows.append(row)
+
+                    if data is not None and not args.dry_run:
+                        if store_in_postgres:
+                            blob_rows.append((digest, data))
+                        else:
+                            await store.put(None, data)
+                        for variant, height, variant_data in variants:
+                            await asyncio.to_thread(
+                                image_cache.write_disk, (card['id'], variant, height, digest), variant_data)
+
+                    if len(card_rows) >= COPY_BATCH:
+                        await flush()
+            await flush()
+
+            if errors and not args.skip_invalid:
+                raise IngestError(f"{len(errors)} invalid card(s), nothing was written:\n  " + '\n  '.join(errors))
+            if args.dry_run:
+                raise IngestError(f"dry run: {changed} card(s) would be written, {unchanged} unchanged")
+
+            if store_in_postgres:
+                await conn.execute('''
+                    INSERT INTO card_blobs (hash, data)
+                    SELECT DISTINCT ON (hash) hash, data FROM ingest_blobs
+                    ON CONFLICT (hash) DO NOTHING
+                ''')
+            await conn.execute('''
+                INSERT INTO series (name, emoji)
+                SELECT series, MAX(series_emoji) FROM ingest_cards
+                WHERE series IS NOT NULL
+                GROUP BY series
+                ON CONFLICT (name) DO NOTHING
+            ''')
+            # The WHERE keeps untouched rows from firing the cards_changed trigger
+            await conn.execute('''
+                INSERT INTO cards (id, name, date, series, notes, series_emoji, rarity, image_hash)
+                SELECT id, name, date, series, notes, series_emoji, rarity, image_hash FROM ingest_cards
+                ON CONFLICT (id) DO UPDATE SET
+                    name = EXCLUDED.name,
+                    date = EXCLUDED.date,
+                    series = EXCLUDED.series,
+                    notes = EXCLUDED.notes,
+                    series_emoji = EXCLUDED.series_emoji,
+                    rarity = EXCLUDED.rarity,
+                    image_hash = EXCLUDED.image_hash,
+                    image = NULL
+                WHERE (cards.name, cards.date, cards.series, cards.notes, cards.series_emoji,
+                       cards.rarity, cards.image_hash, cards.image IS NULL)
+                    IS DISTINCT FROM
+                      (EXCLUDED.name, EXCLUDED.date, EXCLUDED.series, EXCLUDED.notes, EXCLUDED.series_emoji,
+                       EXCLUDED.rarity, EXCLUDED.image_hash, TRUE)
+            ''')
+    finally:
+        await conn.close()
+
+    for error in errors:
+        print(f"Skipped {error}")
+    elapsed = time.perf_counter() - started
+    print(f"Done in {elapsed:.1f}s: {changed} card(s) written, {unchanged} unchanged, {len(errors)} skipped")
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('source', help='manifest (.csv/.json) or directory of card images')
+    parser.add_argument('--database-url', default=os.getenv('DATABASE_URL'))
+    parser.add_argument('--max-dimension', type=int, default=int(os.getenv('INGEST_MAX_DIMENSION', 1200)),
+                        help='longest side of the stored image, in pixels')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--skip-invalid', action='store_true', help='load the valid cards even if some are invalid')
+    parser.add_argument('--dry-run', action='store_true', help='report what would change without writing rows')
+    args = parser.parse_args()
+
+    if not args.database_url:
+        parser.error('set DATABASE_URL or pass --database-url')
+    try:
+        asyncio.run(ingest(args))
+    except IngestError as e:
+        raise SystemExit(str(e))
+
+
+if __name__ == '__main__':
+    main()
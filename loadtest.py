@@ -0,0 +1,446 @@
+"""In-process load test: bursty drop/grab/inventory/view/album traffic without Discord.
+
+Commands and button callbacks are called directly with stub contexts and
+interactions. The stubs record every send and edit and sleep for a fake upload
+(--upload-latency plus bytes / --upload-bandwidth), so nothing leaves the
+machine. Point it at a throwaway local Postgres. A scratch `loadtest` schema
+is migrated, seeded and dropped afterwards:
+
+    LOADTEST_DATABASE_URL=postgresql://localhost/lovebot_bench python loadtest.py --rate 40 --duration 30
+
+Instead of one steady --rate, --script takes a JSON list of phases. Each phase
+has a duration, an arrival rate and optionally its own operation mix:
+
+    [{"seconds": 10, "rate": 5},
+     {"seconds": 5, "rate": 80, "mix": {"drop": 0.4, "grab": 0.6}}]
+
+Requests arrive as a Poisson process and are never held back, so a slow bot
+shows up as queueing in the tail latencies.
+"""
+import argparse
+import asyncio
+import io
+import itertools
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+import traceback
+from collections import Counter, deque
+
+import asyncpg
+from dotenv import load_dotenv
+
+import main as bot_main
+from bench import image_bytes, make_photo_image, seed_schema
+from main import (GrabButton, LatencyHistogram, InstrumentedPool, PostgresBlobStore, bot, instrumented,
+                  prepare_connection, start_instrumentation, stop_instrumentation, warm_up)
+
+LOADTEST_SCHEMA = 'loadtest'
+DEFAULT_MIX = {'drop': 0.25, 'grab': 0.45, 'inventory': 0.12, 'view': 0.08, 'album': 0.05, 'album_page': 0.05}
+BUSY_REPLY = "đang bận"  # what the bot answers when the render queue is full
+
+
+#___________________________________________________________Stubs___________________________________________________________
+class FakeDiscord:
+    """Everything the stubs sent, and the fake upload link they share."""
+
+    def __init__(self, latency, bandwidth):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.sends = 0
+        self.edits = 0
+        self.uploads = 0
+        self.uploaded_bytes = 0
+        self.busy_replies = 0
+        self._message_ids = itertools.count(1)
+        self._attachment_ids = itertools.count(1)
+
+    async def deliver(self, content=None, file=None, files=None, attachments=None):
+        if content and BUSY_REPLY in content:
+            self.busy_replies += 1
+        files = [*(files or ()), *([file] if file else ()), *(attachments or ())]
+        sizes = []
+        for f in files:
+            f.fp.seek(0, io.SEEK_END)
+            sizes.append(f.fp.tell())
+            f.close()
+        await asyncio.sleep(self.latency + sum(sizes) / self.bandwidth if files else self.latency)
+        self.uploads += len(files)
+        self.uploaded_bytes += sum(sizes)
+        expires = int(time.time()) + 24 * 3600
+        return [
+            StubAttachment(f"https://cdn.discordapp.invalid/attachments/0/{next(self._attachment_ids)}/{f.filename}"
+                           f"?ex={expires:x}", size)
+            for f, size in zip(files, sizes)
+        ]
+
+    def message(self, channel, author, **kwargs):
+        return StubMessage(self, next(self._message_ids), channel, author, **kwargs)
+
+
+class StubAttachment:
+    def __init__(self, url, size):
+        self.url = url
+        self.size = size
+
+
+class StubUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.name = f"user{user_id}"
+        self.mention = f"<@{user_id}>"
+
+
+class StubChannel:
+    def __init__(self, channel_id):
+        self.id = channel_id
+
+
+class StubMessage:
+    def __init__(self, discord, message_id, channel, author, content=None, embed=None, view=None, attachments=()):
+        self.discord = discord
+        self.id = message_id
+        self.channel = channel
+        self.author = author
+        self.content = content
+        self.embed = embed
+        self.view = view
+        self.attachments = list(attachments)
+
+    async def edit(self, content=None, embed=None, view=None, attachments=None, **kwargs):
+        self.discord.edits += 1
+        uploaded = await self.discord.deliver(content, attachments=attachments)
+        if attachments is not None:
+            self.attachments = uploaded
+        self.content = content if content is not None else self.content
+        self.embed = embed or self.embed
+        self.view = view or self.view
+        return self
+
+
+class StubContext:
+    def __init__(self, discord, user, channel):
+        self.discord = discord
+        self.author = user
+        self.channel = channel
+        self.guild = None
+        self.messages = []
+
+    async def send(self, content=None, *, embed=None, file=None, files=None, view=None, **kwargs):
+        self.discord.sends += 1
+        attachments = await self.discord.deliver(content, file, files)
+        message = self.discord.message(self.channel, self.author, content=content, embed=embed, view=view,
+                                       attachments=attachments)
+        self.messages.append(message)
+        return message
+
+
+class StubResponse:
+    def __init__(self, interaction):
+        self.interaction = interaction
+        self.done = False
+        self.edited = False
+
+    def is_done(self):
+        return self.done
+
+    async def defer(self, **kwargs):
+        self.done = True
+        await asyncio.sleep(self.interaction.channel_context.discord.latency)
+
+    async def send_message(self, content=None, **kwargs):
+        self.done = True
+        await self.interaction.channel_context.send(content, **kwargs)
+
+    async def edit_message(self, **kwargs):
+        self.done = True
+        self.edited = True
+        await self.interaction.message.edit(**kwargs)
+
+
+class StubFollowup:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def send(self, content=None, **kwargs):
+        return await self.interaction.channel_context.send(content, **kwargs)
+
+
+class StubInteraction:
+    def __init__(self, discord, user, message, custom_id=None):
+        self.user = user
+        self.message = message
+        self.channel_id = message.channel.id
+        self.data = {'custom_id': custom_id} if custom_id else {}
+        self.channel_context = StubContext(discord, user, message.channel)
+        self.response = StubResponse(self)
+        self.followup = StubFollowup(self)
+
+    async def edit_original_response(self, **kwargs):
+        return await self.message.edit(**kwargs)
+
+
+#___________________________________________________________Traffic___________________________________________________________
+class LoadTest:
+    def __init__(self, args, discord):
+        self.args = args
+        self.discord = discord
+        self.rng = random.Random(args.seed)
+        self.latency = {}  # operation -> LatencyHistogram
+        self.errors = Counter()
+        self.error_samples = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.pool_samples = []  # busy connections, sampled
+        self.drops = deque(maxlen=50)  # recent drop messages, for grabs
+        self.albums = deque(maxlen=50)  # (owner, album message), for page flips
+        self.owned = {}  # user id -> card ids they grabbed
+        self.channels = [StubChannel(channel_id) for channel_id in range(1, 11)]
+        self.handlers = {
+            'drop': self.drop,
+            'grab': self.grab,
+            'inventory': self.inventory,
+            'view': self.view,
+            'album': self.album,
+            'album_page': self.album_page,
+        }
+
+    def context(self):
+        user = StubUser(self.rng.randrange(1, self.args.users + 1))
+        return StubContext(self.discord, user, self.rng.choice(self.channels))
+
+    async def command(self, name, ctx, *args, **kwargs):
+        # Commands are timed by the invoke hooks when Discord calls them; do the same here
+        await instrumented(name)(bot.get_command(name).callback)(ctx, *args, **kwargs)
+
+    async def drop(self):
+        ctx = self.context()
+        await self.command('drop', ctx)
+        self.drops.extend(message for message in ctx.messages if message.view is not None)
+
+    async def grab(self):
+        if not self.drops:
+            return await self.drop()
+        message = self.rng.choice(list(self.drops)[-10:])  # crowds pile onto the newest drops
+        button = self.rng.choice(message.view.children)
+        user = StubUser(self.rng.randrange(1, self.args.users + 1))
+        interaction = StubInteraction(self.discord, user, message, button.custom_id)
+        # Rebuild the handler from the custom_id alone, as discord.py's dynamic dispatch does
+        item = await GrabButton.from_custom_id(interaction, button.item, button.template.fullmatch(button.custom_id))
+        await item.callback(interaction)
+        if interaction.response.edited:
+            self.owned.setdefault(user.id, []).append(item.card_id)
+
+    async def inventory(self):
+        await self.command('inventory', self.context(), options=self.rng.choice(['', '', 'qty', 'dupes']))
+
+    async def view(self):
+        ctx = self.context()
+        owned = self.owned.get(ctx.author.id)
+        card_id = self.rng.choice(owned) if owned else bot.catalog.sample(1)[0]
+        await self.command('view', ctx, card_id)
+
+    async def album(self):
+        ctx = self.context()
+        series = self.rng.choice(list(bot.series_index.series))
+        await self.command('album', ctx, series_keyword=series)
+        self.albums.extend((ctx.author, message) for message in ctx.messages if message.view is not None)
+
+    async def album_page(self):
+        if not self.albums:
+            return await self.album()
+        owner, message = self.rng.choice(self.albums)
+        interaction = StubInteraction(self.discord, owner, message, self.rng.choice(['next', 'next', 'previous']))
+        await message.view.interaction_check(interaction)
+
+    async def request(self, operation):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        started = time.perf_counter()
+        try:
+            await self.handlers[operation]()
+        except Exception:
+            self.errors[operation] += 1
+            self.error_samples.setdefault(operation, traceback.format_exc())
+        finally:
+            self.in_flight -= 1
+            self.latency.setdefault(operation, LatencyHistogram()).observe(time.perf_counter() - started)
+
+    async def sample_pool(self):
+        while True:
+            self.pool_samples.append(bot.db.get_size() - bot.db.get_idle_size())
+            await asyncio.sleep(0.05)
+
+    async def run(self, phases):
+        sampler = asyncio.create_task(self.sample_pool())
+        tasks = set()
+        sent = 0
+        started = time.perf_counter()
+        try:
+            for phase in phases:
+                mix = phase.get('mix', self.args.mix)
+                operations, weights = list(mix), list(mix.values())
+                phase_end = time.perf_counter() + phase['seconds']
+                while True:
+                    await asyncio.sleep(self.rng.expovariate(phase['rate']))
+                    if time.perf_counter() >= phase_end:
+                        break
+                    task = asyncio.create_task(self.request(self.rng.choices(operations, weights)[0]))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                    sent += 1
+            traffic_seconds = time.perf_counter() - started
+            if tasks:
+                await asyncio.wait(tasks)
+        finally:
+            sampler.cancel()
+        return sent, traffic_seconds, time.perf_counter() - started
+
+
+def merged(histograms):
+    total = LatencyHistogram()
+    for histogram in histograms:
+        total.counts = [a + b for a, b in zip(total.counts, histogram.counts)]
+        total.count += histogram.count
+        total.sum += histogram.sum
+        total.max = max(total.max, histogram.max)
+    return total
+
+
+def report(test, sent, traffic_seconds, elapsed, phases):
+    ms = lambda seconds: f"{seconds * 1000:>8.0f}"
+    target = sum(phase['rate'] * phase['seconds'] for phase in phases) / sum(phase['seconds'] for phase in phases)
+    print(f"\n{sent} requests over {traffic_seconds:.1f}s ({sent / traffic_seconds:.1f}/s, target {target:.1f}/s), "
+          f"all answered after {elapsed:.1f}s, max {test.max_in_flight} in flight")
+
+    print(f"\n{'operation':<12}{'n':>7}{'errors':>8}{'p50':>8}{'p95':>8}{'p99':>8}{'max':>8}  (ms)")
+    for operation, histogram in sorted(test.latency.items()):
+        print(f"{operation:<12}{histogram.count:>7}{test.errors[operation]:>8}"
+              f"{ms(histogram.percentile(50))}{ms(histogram.percentile(95))}{ms(histogram.percentile(99))}{ms(histogram.max)}")
+
+    metrics = bot.metrics
+    print(f"\n{'phase':<12}{'n':>7}{'p50':>8}{'p95':>8}{'p99':>8}{'max':>8}  (ms, all operations)")
+    for phase in metrics.PHASES:
+        histogram = merged(h for (name, labels), h in metrics.histograms.items()
+                           if name == 'phase_seconds' and dict(labels)['phase'] == phase)
+        print(f"{phase:<12}{histogram.count:>7}{ms(histogram.percentile(50))}{ms(histogram.percentile(95))}"
+              f"{ms(histogram.percentile(99))}{ms(histogram.max)}")
+
+    max_size = bot.db.get_max_size()
+    samples = test.pool_samples or [0]
+    saturated = sum(busy >= max_size for busy in samples) / len(samples)
+    print(f"\ndb pool: {max_size} max, busy mean {sum(samples) / len(samples):.1f} / max {max(samples)}, "
+          f"saturated {saturated:.0%} of the time")
+    lag = metrics.get('loop_lag_seconds') or LatencyHistogram()
+    print(f"event loop lag: p50 {lag.percentile(50) * 1000:.1f} / p99 {lag.percentile(99) * 1000:.1f} / "
+          f"max {lag.max * 1000:.1f} ms")
+    print(f"discord: {test.discord.sends} sends, {test.discord.edits} edits, {test.discord.uploads} uploads "
+          f"({test.discord.uploaded_bytes / 2**20:.1f} MiB), {test.discord.busy_replies} 'busy' replies")
+    print(f"grabs written: {bot.grab_queue.flushed}")
+    drops = bot.drop_buffer
+    print(f"drop buffer: {drops.hits} hits / {drops.misses} misses, {drops.produced} pre-rendered, {drops.discarded} discarded")
+
+    for operation, sample in test.error_samples.items():
+        print(f"\nFirst {operation} error:\n{sample}")
+
+
+#___________________________________________________________Setup___________________________________________________________
+async def setup(args):
+    conn = await asyncpg.connect(args.database_url)
+    try:
+        await conn.execute(f'DROP SCHEMA IF EXISTS {LOADTEST_SCHEMA} CASCADE')
+        await conn.execute(f'CREATE SCHEMA {LOADTEST_SCHEMA}')
+        await conn.execute(f'SET search_path TO {LOADTEST_SCHEMA}')
+        width, height = (int(part) for part in args.image_size.split('x'))
+        blobs = [image_bytes(make_photo_image(width, height, seed)) for seed in range(16)]
+        await seed_schema(conn, args.cards, blobs, users=args.users, per_user=20)
+    finally:
+        await conn.close()
+
+    bot.db = InstrumentedPool(await asyncpg.create_pool(
+        args.database_url,
+        min_size=args.pool_size,
+        max_size=args.pool_size,
+        command_timeout=bot_main.DB_COMMAND_TIMEOUT,
+        init=prepare_connection,
+        server_settings={'search_path': LOADTEST_SCHEMA},
+    ))
+    bot.blob_store = PostgresBlobStore()  # seeded into card_blobs
+    bot.image_cache.directory = tempfile.mkdtemp(prefix='lovebot-loadtest-')
+    bot.attachment_urls.verify_interval = float('inf')  # no HEAD requests to the fake CDN
+    bot_main.LOOP_LAG_INTERVAL = 0.05
+    await warm_up()
+    await start_instrumentation()
+
+
+async def teardown(args):
+    await bot.grab_queue.close()
+    await bot.drop_buffer.close()
+    await stop_instrumentation()
+    await asyncio.to_thread(bot.renderer.shutdown)
+    await bot.db.close()
+    shutil.rmtree(bot.image_cache.directory, ignore_errors=True)
+    conn = await asyncpg.connect(args.database_url)
+    try:
+        await conn.execute(f'DROP SCHEMA IF EXISTS {LOADTEST_SCHEMA} CASCADE')
+    finally:
+        await conn.close()
+
+
+async def run(args):
+    if args.script:
+        with open(args.script) as f:
+            phases = json.load(f)
+    else:
+        phases = [{'seconds': args.duration, 'rate': args.rate}]
+
+    await setup(args)
+    try:
+        test = LoadTest(args, FakeDiscord(args.upload_latency, args.upload_bandwidth))
+        sent, traffic_seconds, elapsed = await test.run(phases)
+        await bot.grab_queue.close()  # count the grabs still queued as written
+        report(test, sent, traffic_seconds, elapsed, phases)
+    finally:
+        await teardown(args)
+    if test.errors:
+        raise SystemExit(f"{sum(test.errors.values())} request(s) failed")
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f"unknown operation {name!r} (expected {', '.join(DEFAULT_MIX)})")
+        mix[name] = float(weight)
+    return mix
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', default=os.getenv('LOADTEST_DATABASE_URL'))
+    parser.add_argument('--rate', type=float, default=20, help='requests per second')
+    parser.add_argument('--duration', type=float, default=20, help='seconds of traffic')
+    parser.add_argument('--script', help='JSON list of {seconds, rate, mix} phases, instead of --rate/--duration')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help='operation weights, e.g. drop=0.3,grab=0.7')
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--cards', type=int, default=2000)
+    parser.add_argument('--image-size', default='400x600', help='synthetic card size, WxH')
+    parser.add_argument('--pool-size', type=int, default=bot_main.DB_POOL_MAX_SIZE)
+    parser.add_argument('--upload-latency', type=float, default=0.15, help='seconds per message sent or edited')
+    parser.add_argument('--upload-bandwidth', type=float, default=4 * 2**20, help='bytes per second of uploads')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if not args.database_url:
+        parser.error('set LOADTEST_DATABASE_URL or pass --database-url (use a throwaway local database!)')
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,13 +3,28 @@ from discord.ext import commands
 from discord.ui import Button, View
 from PIL import Image, ImageFilter, ImageDraw, ImageFont
 import io
+import csv
+import gzip
+import json
 import random
-from datetime import datetime
+import tempfile
+from datetime import date, datetime, timedelta, timezone
 import asyncpg
 from io import BytesIO
 import unicodedata
 import asyncio
 import os
+import hashlib
+import mmap
+import time
+import aiohttp
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, wraps
+from contextlib import contextmanager
+from contextvars import ContextVar
+from aiohttp import web
+from collections import OrderedDict, deque
+from urllib.parse import quote, urlparse, parse_qs
 from dotenv import load_dotenv
  
 # Load environment variables
@@ -17,153 +32,2558 @@ load_dotenv()
 # Bot setup  
 intents = discord.Intents.default()  
 intents.message_content = True  
-bot = commands.Bot(command_prefix=".", intents=intents)  
+
+STARTED_AT = time.perf_counter()
+
+# Cluster mode: cluster.py runs one process per range of shards and passes
+# these; without them a single process runs every shard Discord recommends
+SHARD_COUNT = int(os.getenv('SHARD_COUNT')) if os.getenv('SHARD_COUNT') else None
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv('SHARD_IDS').split(',')] if os.getenv('SHARD_IDS') else None
+CLUSTER_ID = int(os.getenv('CLUSTER_ID', 0))
+CLUSTER_COUNT = int(os.getenv('CLUSTER_COUNT', 1))
+
+class LoveBot(commands.AutoShardedBot):
+    db = None
+    startup_seconds = None  # process start -> setup_hook done (database + caches ready)
+    first_command_seconds = None  # process start -> first command answered
+
+    async def setup_hook(self):
+        # Runs once before the gateway connects, unlike on_ready which fires
+        # again on every reconnect, so no command can see a cold bot
+        await setup_database()
+        await warm_up()
+        await start_instrumentation()
+        # Buttons are matched by custom_id, so drops and memories sent before
+        # a restart (or by another process) keep working
+        self.add_dynamic_items(GrabButton, RevealButton)
+        self.startup_seconds = time.perf_counter() - STARTED_AT
+        print(f"Startup took {self.startup_seconds:.1f}s")
+
+    async def close(self):
+        # Write out grabs that are still queued before the process exits
+        await self.grab_queue.close()
+        await self.attachment_urls.close()
+        await self.catalog.close()
+        await self.drop_buffer.close()
+        await stop_instrumentation()
+        await super().close()
+        await asyncio.to_thread(self.renderer.shutdown)
+        if self.db is not None:
+            try:
+                await asyncio.wait_for(self.db.close(), timeout=DB_CLOSE_TIMEOUT)
+            except asyncio.TimeoutError:
+                print("Database pool did not close in time, terminating connections")
+                self.db.terminate()
+
+bot = LoveBot(command_prefix=".", intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)  
+
+#___________________________________________________________Instrumentation___________________________________________________________
+class LatencyHistogram:
+    """Latency samples in fixed log-spaced buckets (1ms up to ~2 minutes).
+
+    Memory stays constant however many samples arrive, and percentiles are
+    interpolated inside the bucket they fall in (within ~25%).
+    """
+    BOUNDS = tuple(0.001 * 1.25 ** i for i in range(53))
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)  # last bucket: above every bound
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        low, high = 0, len(self.BOUNDS)
+        while low < high:
+            mid = (low + high) // 2
+            if seconds <= self.BOUNDS[mid]:
+                high = mid
+            else:
+                low = mid + 1
+        self.counts[low] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p):
+        if not self.count:
+            return 0.0
+        rank = p / 100 * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.BOUNDS[index - 1] if index else 0.0
+                upper = self.BOUNDS[index] if index < len(self.BOUNDS) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / count, self.max)
+            seen += count
+        return self.max
+
+
+# Which command or component the running task is serving; DB, render and
+# upload timings are attributed to it
+current_operation = ContextVar('current_operation', default='background')
+
+class Metrics:
+    """Latency histograms and counters, keyed by metric name and labels."""
+    PHASES = ('acquire', 'query', 'render', 'upload')
+
+    def __init__(self):
+        self.histograms = {}  # (name, ((label, value), ...)) -> LatencyHistogram
+        self.counters = {}
+        self.gauges = {}  # (name, ((label, value), ...)) -> zero-argument callable
+
+    def histogram(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = LatencyHistogram()
+        return histogram
+
+    def get(self, name, **labels):
+        return self.histograms.get((name, tuple(sorted(labels.items()))))
+
+    def observe(self, name, seconds, **labels):
+        self.histogram(name, **labels).observe(seconds)
+
+    def inc(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + 1
+
+    def gauge(self, name, func, **labels):
+        self.gauges[(name, tuple(sorted(labels.items())))] = func
+
+    def phase(self, phase, seconds):
+        self.observe('phase_seconds', seconds, operation=current_operation.get(), phase=phase)
+
+    def prometheus(self):
+        """Everything in the Prometheus text exposition format."""
+        def label_text(labels, **extra):
+            items = [*labels, *extra.items()]
+            if not items:
+                return ''
+            return '{' + ','.join(f'{key}="{value}"' for key, value in items) + '}'
+
+        lines = []
+        for name in sorted({name for name, _ in self.histograms}):
+            lines.append(f'# TYPE lovebot_{name} histogram')
+            for (metric, labels), histogram in sorted(self.histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(histogram.BOUNDS, histogram.counts):
+                    cumulative += count
+                    lines.append(f'lovebot_{name}_bucket{label_text(labels, le=f"{bound:.6g}")} {cumulative}')
+                lines.append(f'lovebot_{name}_bucket{label_text(labels, le="+Inf")} {histogram.count}')
+                lines.append(f'lovebot_{name}_sum{label_text(labels)} {histogram.sum:.6f}')
+                lines.append(f'lovebot_{name}_count{label_text(labels)} {histogram.count}')
+        for name in sorted({name for name, _ in self.counters}):
+            lines.append(f'# TYPE lovebot_{name}_total counter')
+            for (metric, labels), value in sorted(self.counters.items()):
+                if metric == name:
+                    lines.append(f'lovebot_{name}_total{label_text(labels)} {value}')
+        for name in sorted({name for name, _ in self.gauges}):
+            lines.append(f'# TYPE lovebot_{name} gauge')
+            for (metric, labels), func in sorted(self.gauges.items(), key=lambda item: item[0]):
+                if metric == name:
+                    lines.append(f'lovebot_{name}{label_text(labels)} {func()}')
+        return '\n'.join(lines) + '\n'
+
+bot.metrics = Metrics()
+
+@contextmanager
+def timed(phase):
+    """Time a block as `phase` ('render', 'upload', ...) of the current operation."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        bot.metrics.phase(phase, time.perf_counter() - started)
+
+def instrumented(name):
+    """Time a component callback as operation `name` (commands are timed by the invoke hooks)."""
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            token = current_operation.set(name)
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                bot.metrics.inc('errors', operation=name)
+                raise
+            finally:
+                bot.metrics.observe('operation_seconds', time.perf_counter() - started, operation=name)
+                current_operation.reset(token)
+        return wrapper
+    return decorator
+
+@bot.before_invoke
+async def start_command_timer(ctx):
+    ctx.instrumentation = (time.perf_counter(), current_operation.set(ctx.command.qualified_name))
+
+@bot.after_invoke
+async def stop_command_timer(ctx):
+    started, token = ctx.instrumentation
+    name = ctx.command.qualified_name
+    bot.metrics.observe('operation_seconds', time.perf_counter() - started, operation=name)
+    if ctx.command_failed:
+        bot.metrics.inc('errors', operation=name)
+    current_operation.reset(token)
+
+
+class InstrumentedPool:
+    """Wraps the asyncpg pool to time how long acquire() waits for a connection."""
+
+    def __init__(self, pool):
+        self._pool = pool
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+    def acquire(self):
+        return TimedAcquire(self._pool.acquire())
+
+
+class TimedAcquire:
+    def __init__(self, context):
+        self._context = context
+
+    async def __aenter__(self):
+        started = time.perf_counter()
+        conn = await self._context.__aenter__()
+        bot.metrics.phase('acquire', time.perf_counter() - started)
+        return conn
+
+    async def __aexit__(self, *exc_info):
+        return await self._context.__aexit__(*exc_info)
+
+
+def record_query(record):
+    """asyncpg query logger; runs in the context of the task that sent the query."""
+    if record.query.lstrip().startswith('SELECT pg_advisory_unlock_all()'):
+        return  # the pool's reset on release, not a query anybody asked for
+    bot.metrics.observe('phase_seconds', record.elapsed, operation=current_operation.get(), phase='query')
+
+
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', 0.5))  # seconds between loop-lag samples
+METRICS_PORT = os.getenv('METRICS_PORT')  # set to serve /metrics for Prometheus
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+
+async def sample_loop_lag():
+    """How late the event loop wakes us: time it spent blocked by someone else."""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        bot.metrics.observe('loop_lag_seconds', max(0.0, time.perf_counter() - started - LOOP_LAG_INTERVAL))
+
+async def serve_metrics(request):
+    return web.Response(text=bot.metrics.prometheus(), content_type='text/plain', charset='utf-8')
+
+def health():
+    """This process's state, as served on /health (cluster.py polls it)."""
+    lag = bot.metrics.get('loop_lag_seconds') or LatencyHistogram()
+    shards = {}
+    for shard_id, shard in sorted(bot.shards.items()):
+        latency = shard.latency
+        shards[shard_id] = {
+            'latency_ms': round(latency * 1000, 1) if latency != float('inf') else None,
+            'connected': not shard.is_closed(),
+        }
+    return {
+        'cluster': CLUSTER_ID,
+        'pid': os.getpid(),
+        'ready': bot.is_ready(),
+        'uptime_seconds': round(time.perf_counter() - STARTED_AT, 1),
+        'shard_count': bot.shard_count,
+        'shards': shards,
+        'guilds': len(bot.guilds),
+        'db_pool': {'size': bot.db.get_size(), 'idle': bot.db.get_idle_size(), 'max': bot.db.get_max_size()}
+                   if bot.db else None,
+        'render_pending': bot.renderer.pending,
+        'loop_lag_p99_ms': round(lag.percentile(99) * 1000, 1),
+    }
+
+async def serve_health(request):
+    return web.json_response(health())
+
+@bot.event
+async def on_shard_connect(shard_id):
+    bot.metrics.gauge('shard_latency_seconds', lambda: bot.get_shard(shard_id).latency, shard=shard_id)
+
+async def start_instrumentation():
+    bot.metrics.gauge('db_pool_size', lambda: bot.db.get_size() if bot.db else 0)
+    bot.metrics.gauge('db_pool_idle', lambda: bot.db.get_idle_size() if bot.db else 0)
+    bot.metrics.gauge('render_pending', lambda: bot.renderer.pending)
+    bot.metrics.gauge('drop_buffer_depth', lambda: len(bot.drop_buffer))
+    bot.metrics.gauge('drop_buffer_bytes', lambda: bot.drop_buffer.size)
+    bot.loop_lag_task = asyncio.create_task(sample_loop_lag())
+    bot.metrics_runner = None
+    if METRICS_PORT:
+        app = web.Application()
+        app.router.add_get('/metrics', serve_metrics)
+        app.router.add_get('/health', serve_health)
+        bot.metrics_runner = web.AppRunner(app, access_log=None)
+        await bot.metrics_runner.setup()
+        await web.TCPSite(bot.metrics_runner, METRICS_HOST, int(METRICS_PORT)).start()
+        print(f"Serving metrics and health on http://{METRICS_HOST}:{METRICS_PORT}/")
+
+async def stop_instrumentation():
+    task = getattr(bot, 'loop_lag_task', None)
+    if task is not None:
+        task.cancel()
+    if getattr(bot, 'metrics_runner', None) is not None:
+        await bot.metrics_runner.cleanup()
+        bot.metrics_runner = None
+
+
+
+#___________________________________________________________Migrations___________________________________________________________
+# Forward-only schema changes, applied in version order by run_migrations()
+# and recorded in schema_version. Never edit a migration that has shipped;
+# add a new one instead.
+MIGRATIONS = []
+MIGRATION_LOCK_ID = 0x6C6F7665  # pg advisory lock held while migrating
+
+def migration(version, description, transaction=True):
+    """Register a migration. Ones with `transaction=False` (CREATE INDEX
+    CONCURRENTLY) must be idempotent: they re-run if the bot dies before
+    the version is recorded."""
+    def register(func):
+        MIGRATIONS.append((version, description, transaction, func))
+        return func
+    return register
+
+async def create_index_concurrently(conn, name, definition):
+    # A failed concurrent build leaves an INVALID index behind; rebuild it
+    invalid = await conn.fetchval(
+        'SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass($1)', name
+    )
+    if invalid:
+        await conn.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+    await conn.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition}')
+
+async def run_migrations(conn):
+    """Apply every pending migration on `conn`; returns the versions applied."""
+    # Poll instead of blocking on the lock: a session waiting inside
+    # pg_advisory_lock() would stall another process's CREATE INDEX CONCURRENTLY
+    while not await conn.fetchval('SELECT pg_try_advisory_lock($1)', MIGRATION_LOCK_ID):
+        await asyncio.sleep(1)
+    try:
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )
+        ''')
+        applied = {row['version'] for row in await conn.fetch('SELECT version FROM schema_version')}
+        done = []
+        for version, description, transaction, func in sorted(MIGRATIONS, key=lambda m: m[0]):
+            if version in applied:
+                continue
+            print(f"Applying migration {version}: {description}")
+            if transaction:
+                async with conn.transaction():
+                    await func(conn)
+                    await conn.execute(
+                        'INSERT INTO schema_version (version, description) VALUES ($1, $2)', version, description
+                    )
+            else:
+                await func(conn)
+                await conn.execute(
+                    'INSERT INTO schema_version (version, description) VALUES ($1, $2)', version, description
+                )
+            done.append(version)
+        return done
+    finally:
+        await conn.execute('SELECT pg_advisory_unlock($1)', MIGRATION_LOCK_ID)
+
+@migration(1, "Baseline: cards, inventory, blobs, boosts, attachment URLs, change trigger")
+async def migrate_baseline(conn):
+    # Everything setup_database() used to create, so existing databases pass through unchanged
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS cards (
+            id TEXT PRIMARY KEY,
+            name TEXT,
+            date TEXT,
+            series TEXT,
+            image BYTEA,
+            notes TEXT,
+            series_emoji TEXT
+        )
+    ''')
+    
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS inventory (
+            user_id BIGINT,
+            card_id TEXT,
+            quantity INTEGER,
+            grabbed_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, card_id),
+            FOREIGN KEY (card_id) REFERENCES cards(id)
+        )
+    ''')
+
+    # Rarity decides how often a card drops (see RARITIES)
+    await conn.execute("ALTER TABLE cards ADD COLUMN IF NOT EXISTS rarity TEXT NOT NULL DEFAULT 'common'")
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS series_boosts (
+            series TEXT PRIMARY KEY,
+            multiplier REAL NOT NULL,
+            ends_at TIMESTAMPTZ NOT NULL
+        )
+    ''')
+    # Images live in the blob store; cards only keep the SHA-256 of theirs
+    await conn.execute('ALTER TABLE cards ADD COLUMN IF NOT EXISTS image_hash TEXT')
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS card_blobs (
+            hash TEXT PRIMARY KEY,
+            data BYTEA NOT NULL
+        )
+    ''')
+
+    # Discord CDN URLs of card images that were already uploaded
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS attachment_urls (
+            card_id TEXT,
+            variant TEXT,
+            url TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            expires_at TIMESTAMPTZ,
+            PRIMARY KEY (card_id, variant)
+        )
+    ''')
+
+    # Tell listeners (the card catalog) which card changed
+    await conn.execute('''
+        CREATE OR REPLACE FUNCTION notify_card_change() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                PERFORM pg_notify('cards_changed', OLD.id);
+                RETURN OLD;
+            END IF;
+            IF TG_OP = 'UPDATE' AND OLD.id <> NEW.id THEN
+                PERFORM pg_notify('cards_changed', OLD.id);
+            END IF;
+            PERFORM pg_notify('cards_changed', NEW.id);
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+    ''')
+    await conn.execute('DROP TRIGGER IF EXISTS cards_changed ON cards')
+    await conn.execute('''
+        CREATE TRIGGER cards_changed
+        AFTER INSERT OR UPDATE OR DELETE ON cards
+        FOR EACH ROW EXECUTE FUNCTION notify_card_change()
+    ''')
+
+# Card dates as they appear in manifests (and in cards.date before migration 2)
+DATE_FORMATS = ('%Y-%m-%d', '%d/%m/%Y', '%d/%m/%y', '%Y/%m/%d')
+
+def parse_card_date(value):
+    """A date in one of DATE_FORMATS; ValueError otherwise."""
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt).date()
+        except ValueError:
+            pass
+    raise ValueError(f"unrecognised date {value!r} (expected YYYY-MM-DD)")
+
+@migration(2, "cards.date TEXT -> DATE")
+async def migrate_card_dates(conn):
+    # Rewrite every date as ISO first; one that cannot be read stops the
+    # migration rather than being thrown away
+    ids, dates, unreadable = [], [], []
+    for row in await conn.fetch("SELECT id, date FROM cards WHERE date IS NOT NULL"):
+        value = row['date'].strip()
+        try:
+            parsed = parse_card_date(value).isoformat() if value else None
+        except ValueError:
+            unreadable.append(f"{row['id']} ({value!r})")
+            continue
+        if parsed != row['date']:
+            ids.append(row['id'])
+            dates.append(parsed)
+    if unreadable:
+        raise ValueError(f"{len(unreadable)} card date(s) are not in a known format, fix them and restart: "
+                         + ', '.join(unreadable))
+    await conn.execute('''
+        UPDATE cards SET date = fixed.date
+        FROM UNNEST($1::text[], $2::text[]) AS fixed(id, date)
+        WHERE cards.id = fixed.id
+    ''', ids, dates)
+    await conn.execute('ALTER TABLE cards ALTER COLUMN date TYPE DATE USING date::date')
+
+@migration(3, "series table, referenced by cards.series")
+async def migrate_series_table(conn):
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS series (
+            name TEXT PRIMARY KEY,
+            emoji TEXT
+        )
+    ''')
+    await conn.execute('''
+        INSERT INTO series (name, emoji)
+        SELECT series, MAX(series_emoji) FROM cards
+        WHERE series IS NOT NULL
+        GROUP BY series
+        ON CONFLICT (name) DO NOTHING
+    ''')
+    await conn.execute('''
+        ALTER TABLE cards ADD CONSTRAINT cards_series_fkey
+        FOREIGN KEY (series) REFERENCES series (name) ON UPDATE CASCADE
+    ''')
+
+@migration(4, "Index inventory by user, newest grab first", transaction=False)
+async def migrate_inventory_index(conn):
+    # Matches InventoryQuery's keyset order (grabbed_time DESC, card_id DESC)
+    await create_index_concurrently(conn, 'inventory_user_grabbed_idx', 'inventory (user_id, grabbed_time DESC, card_id DESC)')
+
+@migration(5, "Index cards by series", transaction=False)
+async def migrate_series_index(conn):
+    # Album lookups (card_id IN (SELECT id FROM cards WHERE series = $2)) and series FK checks
+    await create_index_concurrently(conn, 'cards_series_idx', 'cards (series)')
+
+@migration(6, "Store open drops")
+async def migrate_drops(conn):
+    # Drop buttons only carry ids; who grabbed what is settled here, so open
+    # drops outlive the process that sent them
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS drops (
+            id BIGSERIAL PRIMARY KEY,
+            channel_id BIGINT NOT NULL,
+            card_ids TEXT[] NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            expires_at TIMESTAMPTZ NOT NULL,
+            claimed_by BIGINT,
+            claimed_card TEXT
+        )
+    ''')
+    await conn.execute('CREATE INDEX IF NOT EXISTS drops_expires_idx ON drops (expires_at)')
+
+@migration(7, "Store cooldown windows")
+async def migrate_cooldowns(conn):
+    # Used by PostgresCooldowns; `granted` is how many uses the last lease took
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS cooldowns (
+            key TEXT PRIMARY KEY,
+            window_end TIMESTAMPTZ NOT NULL,
+            used INTEGER NOT NULL,
+            granted INTEGER NOT NULL
+        )
+    ''')
+    await conn.execute('CREATE INDEX IF NOT EXISTS cooldowns_window_end_idx ON cooldowns (window_end)')
+
+@migration(8, "Collection stats and leaderboard totals")
+async def migrate_collection_stats(conn):
+    # No foreign key to series: a rename reaches these rows through the trigger below
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS collection_stats (
+            user_id BIGINT,
+            series TEXT,
+            owned INTEGER NOT NULL,  -- distinct cards of the series
+            copies INTEGER NOT NULL,
+            PRIMARY KEY (user_id, series)
+        )
+    ''')
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_totals (
+            user_id BIGINT PRIMARY KEY,
+            owned INTEGER NOT NULL,
+            copies INTEGER NOT NULL
+        )
+    ''')
+    await conn.execute('CREATE INDEX IF NOT EXISTS user_totals_rank_idx ON user_totals (owned DESC, copies DESC, user_id)')
+    await rebuild_collection_stats(conn)
+
+    # Moving a card to another series moves its owners' counts with it
+    await conn.execute('''
+        CREATE OR REPLACE FUNCTION move_collection_stats() RETURNS trigger AS $$
+        BEGIN
+            IF OLD.series IS NOT NULL THEN
+                UPDATE collection_stats
+                SET owned = collection_stats.owned - 1, copies = collection_stats.copies - inventory.quantity
+                FROM inventory
+                WHERE inventory.card_id = OLD.id
+                  AND collection_stats.user_id = inventory.user_id AND collection_stats.series = OLD.series;
+            END IF;
+            IF NEW.series IS NOT NULL THEN
+                INSERT INTO collection_stats (user_id, series, owned, copies)
+                SELECT user_id, NEW.series, 1, quantity FROM inventory WHERE card_id = NEW.id
+                ON CONFLICT (user_id, series) DO UPDATE
+                SET owned = collection_stats.owned + 1, copies = collection_stats.copies + EXCLUDED.copies;
+            END IF;
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+    ''')
+    await conn.execute('DROP TRIGGER IF EXISTS cards_series_moved ON cards')
+    await conn.execute('''
+        CREATE TRIGGER cards_series_moved
+        AFTER UPDATE OF series ON cards
+        FOR EACH ROW WHEN (OLD.series IS DISTINCT FROM NEW.series)
+        EXECUTE FUNCTION move_collection_stats()
+    ''')
+
+@migration(9, "Record the image each attachment URL was uploaded from")
+async def migrate_attachment_image_hash(conn):
+    # Card changes used to delete a card's URLs, so the ones left match the current image
+    await conn.execute('ALTER TABLE attachment_urls ADD COLUMN IF NOT EXISTS image_hash TEXT')
+    await conn.execute('''
+        UPDATE attachment_urls SET image_hash = cards.image_hash
+        FROM cards WHERE cards.id = attachment_urls.card_id
+    ''')
+
+
 
 # Database setup  
 # Modified database setup
 # Database setup  
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', 10))  # cluster.py sets this from DB_CONNECTION_BUDGET
+DB_POOL_MIN_SIZE = min(int(os.getenv('DB_POOL_MIN_SIZE', 2)), DB_POOL_MAX_SIZE)
+DB_COMMAND_TIMEOUT = float(os.getenv('DB_COMMAND_TIMEOUT', 30))  # seconds per query
+DB_CLOSE_TIMEOUT = float(os.getenv('DB_CLOSE_TIMEOUT', 10))  # seconds to wait for queries on shutdown
+
+async def prepare_connection(conn):
+    """Pool `init`: prime each new connection's statement cache with the hot reads.
+
+    asyncpg prepares statements per connection and caches them by query
+    text, so running each once here (with ids that match nothing) spares
+    commands the parse/plan round trip on first use.
+    """
+    conn.add_query_logger(record_query)
+    await conn.fetch(CardCatalog.REFRESH_QUERY, [])
+    await conn.fetch(CARD_SOURCES_QUERY, [])
+    await conn.fetch(ALBUM_COLLECTED_QUERY, 0, '')
+    await conn.fetch(ALBUM_PAGE_COLLECTED_QUERY, 0, [])
+    await conn.fetchrow(SERIES_PROGRESS_QUERY, 0, '')
+    query = InventoryQuery(0)
+    await query.count(conn)
+    await query.page(conn, None, INVENTORY_PAGE_SIZE)
+
 async def setup_database():
     try:
         # Get DATABASE_URL from environment variable
         database_url = os.getenv('DATABASE_URL')
         if not database_url:
             raise ValueError("No DATABASE_URL environment variable found")
-        
-        # Create connection pool
-        bot.db = await asyncpg.create_pool(database_url)
+
+        # Migrate on a connection of its own: the pool's init needs the tables
+        conn = await asyncpg.connect(database_url)
+        try:
+            await run_migrations(conn)
+        finally:
+            await conn.close()
+        print("Database schema up to date!")
+
+        bot.db = InstrumentedPool(await asyncpg.create_pool(
+            database_url,
+            min_size=DB_POOL_MIN_SIZE,
+            max_size=DB_POOL_MAX_SIZE,
+            command_timeout=DB_COMMAND_TIMEOUT,
+            init=prepare_connection,
+        ))
         print("Connected to PostgreSQL database!")
-        
-        # Create tables
-        async with bot.db.acquire() as conn:  # Changed from bot.conn to bot.db
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS cards (
-                    id TEXT PRIMARY KEY,
-                    name TEXT,
-                    date TEXT,
-                    series TEXT,
-                    image BYTEA,
-                    notes TEXT,
-                    series_emoji TEXT
-                )
-            ''')
-            
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS inventory (
-                    user_id BIGINT,
-                    card_id TEXT,
-                    quantity INTEGER,
-                    grabbed_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    PRIMARY KEY (user_id, card_id),
-                    FOREIGN KEY (card_id) REFERENCES cards(id)
-                )
-            ''')
-            print("Database tables created/verified!")
-            
+
+        # Keep card metadata in sync from here on
+        await bot.catalog.listen(database_url, bot.db)
+
     except Exception as e:
         print(f"Database setup error: {str(e)}")
         raise
 
-@bot.event  
-async def on_ready():  
-    print(f'Bot is ready as {bot.user}')  
-    await setup_database()
+async def warm_up():
+    """Fill the in-memory caches before the first command arrives."""
+    started = time.perf_counter()
+    await bot.catalog.load(bot.db)  # also builds the series index and drop tables
+    await bot.drop_engine.load_boosts(bot.db)
+    await bot.attachment_urls.load(bot.db)
+    await bot.leaderboard.load(bot.db)
+    await bot.renderer.start()
+    bot.drop_buffer.start()  # fills in the background, after the caches above
+    print(f"Card catalog loaded ({len(bot.catalog)} cards), caches warm in {time.perf_counter() - started:.1f}s")
+
+@bot.event  
+async def on_ready():  
+    print(f'Bot is ready as {bot.user}')  
+
+@bot.listen('on_command_completion')
+async def record_first_command(ctx):
+    if bot.first_command_seconds is None:
+        bot.first_command_seconds = time.perf_counter() - STARTED_AT
+        print(f"First command (.{ctx.command}) answered {bot.first_command_seconds:.1f}s after start")
+
+
+
+#___________________________________________________________Card Catalog___________________________________________________________
+class CardCatalog:
+    """In-memory copy of every card's metadata (everything except the image).
+
+    Loaded once at startup and kept in sync through the `cards_changed`
+    NOTIFY channel, so commands can pick cards without touching the images.
+    """
+    # Rows not yet moved to the blob store fall back to the md5 of their BYTEA
+    COLUMNS = 'id, name, date, series, notes, series_emoji, rarity, COALESCE(image_hash, md5(image)) AS image_hash'
+    REFRESH_QUERY = f'SELECT {COLUMNS} FROM cards WHERE id = ANY($1::text[])'
+
+    def __init__(self):
+        self.cards = {}  # card id -> metadata dict
+        self._ids = []  # dense list of ids so sampling stays O(k)
+        self._positions = {}  # card id -> index in self._ids
+        self._listener = None
+        self._pending = set()  # ids notified but not refreshed yet
+        self._change_callbacks = []
+        self._subscriptions = {}  # other NOTIFY channels to follow on the same connection
+        self._tasks = set()
+        self.version = 0  # bumped on every change
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, card_id):
+        return card_id in self.cards
+
+    def get(self, card_id):
+        return self.cards.get(card_id)
+
+    def sample(self, k):
+        return random.sample(self._ids, k)
+
+    def on_change(self, callback):
+        """Register `callback(card_id, card_or_None)`, called after each change.
+
+        A full reload calls it once with `card_id=None`.
+        """
+        self._change_callbacks.append(callback)
+        return callback
+
+    def _put(self, row):
+        card = dict(row)
+        card_id = card['id']
+        if card_id not in self._positions:
+            self._positions[card_id] = len(self._ids)
+            self._ids.append(card_id)
+        self.cards[card_id] = card
+
+    def _remove(self, card_id):
+        position = self._positions.pop(card_id, None)
+        if position is None:
+            return
+        # Swap the last id into the hole so removal is O(1)
+        last_id = self._ids.pop()
+        if last_id != card_id:
+            self._ids[position] = last_id
+            self._positions[last_id] = position
+        del self.cards[card_id]
+
+    async def load(self, pool):
+        async with pool.acquire() as conn:
+            rows = await conn.fetch(f'SELECT {self.COLUMNS} FROM cards')
+        self.cards, self._ids, self._positions = {}, [], {}
+        for row in rows:
+            self._put(row)
+        await self._changed(None)
+
+    async def refresh(self, pool, card_id):
+        await self.refresh_many(pool, [card_id])
+
+    async def refresh_many(self, pool, card_ids):
+        async with pool.acquire() as conn:
+            rows = await conn.fetch(self.REFRESH_QUERY, list(card_ids))
+        found = {row['id'] for row in rows}
+        for row in rows:
+            self._put(row)
+        for card_id in card_ids:
+            if card_id not in found:
+                self._remove(card_id)
+        for card_id in card_ids:
+            await self._changed(card_id)
+
+    async def _changed(self, card_id):
+        self.version += 1
+        for callback in self._change_callbacks:
+            try:
+                result = callback(card_id, self.cards.get(card_id))
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception as e:
+                print(f"Error in catalog change callback: {e}")
+
+    async def listen(self, database_url, pool):
+        """Follow `cards_changed` on a dedicated connection (LISTEN needs one)."""
+        await self.close()
+        self._database_url, self._pool = database_url, pool
+        self._listener = await asyncpg.connect(database_url)
+        self._listener.add_termination_listener(self._on_terminate)
+        await self._listener.add_listener('cards_changed', self._on_notify)
+        for channel, callback in self._subscriptions.items():
+            await self._listener.add_listener(channel, callback)
+
+    def subscribe(self, channel, callback):
+        """Follow another NOTIFY channel on the listener connection (kept across reconnects)."""
+        self._subscriptions[channel] = callback
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _on_notify(self, connection, pid, channel, card_id):
+        # Bulk writes (ingest) notify once per row; refresh them in batches
+        if not self._pending:
+            self._spawn(self._refresh_pending())
+        self._pending.add(card_id)
+
+    async def _refresh_pending(self):
+        await asyncio.sleep(0.1)
+        while self._pending:
+            card_ids = [self._pending.pop() for _ in range(min(len(self._pending), 1000))]
+            try:
+                await self.refresh_many(self._pool, card_ids)
+            except Exception as e:
+                print(f"Error refreshing cards from the catalog: {e}")
+
+    def _on_terminate(self, connection):
+        # Changes may have been missed while disconnected, so reload everything
+        self._spawn(self._relisten())
+
+    async def _relisten(self):
+        while True:
+            try:
+                await self.listen(self._database_url, self._pool)
+                await self.load(self._pool)
+                return
+            except Exception as e:
+                print(f"Card catalog reconnect failed: {e}")
+                await asyncio.sleep(5)
+
+    async def close(self):
+        if self._listener and not self._listener.is_closed():
+            self._listener.remove_termination_listener(self._on_terminate)
+            await self._listener.close()
+
+bot.catalog = CardCatalog()
+
+
+
+#___________________________________________________________Render Engine___________________________________________________________
+class RenderQueueFull(Exception):
+    """Raised when too many renders are already waiting for a worker."""
+
+
+class RenderEngine:
+    """Runs Pillow work in a process pool so it never blocks the event loop.
+
+    Jobs are plain functions that take and return bytes. At most `workers`
+    jobs are handed to the pool at once; the rest wait here, and once
+    `queue_limit` jobs are pending new ones are rejected with RenderQueueFull.
+    """
+
+    def __init__(self, workers=None, queue_limit=None):
+        self.workers = workers or int(os.getenv('RENDER_WORKERS', os.cpu_count() or 1))
+        self.queue_limit = queue_limit or int(os.getenv('RENDER_QUEUE_LIMIT', 64))
+        self.pending = 0
+        self._slots = asyncio.Semaphore(self.workers)
+        self._executor = None
+
+    async def run(self, func, *args):
+        if self.pending >= self.queue_limit:
+            raise RenderQueueFull()
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+
+        self.pending += 1
+        try:
+            with timed('render'):  # includes waiting for a free worker
+                async with self._slots:
+                    loop = asyncio.get_running_loop()
+                    return await loop.run_in_executor(self._executor, func, *args)
+        finally:
+            self.pending -= 1
+
+    async def start(self):
+        """Spawn the worker processes now rather than on the first render."""
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(self._executor, os.getpid) for _ in range(self.workers)))
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+bot.renderer = RenderEngine()
+
+
+
+#___________________________________________________________Image Encoding___________________________________________________________
+# How each rendered output is encoded: (format, quality, max bytes or None).
+# Override with e.g. ENCODE_DROP="jpeg:85:4000000"; a missing quality means the
+# format's default. Formats, with their default and valid quality:
+#   png            lossless; quality is the zlib compress_level (6, 0-9)
+#   png8           256-colour palette PNG; quality is the compress_level (9, 0-9)
+#   webp           lossy WebP, keeps transparency (90, 1-100)
+#   webp-lossless  lossless WebP; quality is the compression effort (80, 0-100)
+#   jpeg           lossy, opaque only; images with transparency use webp (90, 1-95)
+ENCODE_FORMATS = {
+    'png': (6, 0, 9),
+    'png8': (9, 0, 9),
+    'webp': (90, 1, 100),
+    'webp-lossless': (80, 0, 100),
+    'jpeg': (90, 1, 95),
+}
+ENCODE_DEFAULTS = {
+    'drop': ('webp', 90, 8 * 1024 * 1024),
+    'album': ('webp', 90, 8 * 1024 * 1024),
+    'variant': ('png', 1, None),  # cached card variants: fast to write and to decode again
+    'source': ('png', 6, None),  # card images as ingested into the blob store
+}
+
+def parse_encode_policy(output, override):
+    """The policy for `output` with an ENCODE_<OUTPUT> override applied; ValueError if it is invalid."""
+    fmt, quality, max_bytes = ENCODE_DEFAULTS[output]
+    if not override:
+        return fmt, quality, max_bytes
+
+    name = f"ENCODE_{output.upper()}={override!r}"
+    parts = override.split(':')
+    if len(parts) > 3:
+        raise ValueError(f"{name}: expected format[:quality[:max bytes]]")
+    if parts[0] != fmt:
+        fmt = parts[0]
+        if fmt not in ENCODE_FORMATS:
+            raise ValueError(f"{name}: unknown format (expected one of {', '.join(ENCODE_FORMATS)})")
+        quality = ENCODE_FORMATS[fmt][0]
+    _, lowest, highest = ENCODE_FORMATS[fmt]
+    try:
+        if len(parts) > 1 and parts[1]:
+            quality = int(parts[1])
+        if len(parts) > 2:
+            max_bytes = int(parts[2]) if parts[2] else None
+    except ValueError:
+        raise ValueError(f"{name}: quality and max bytes must be integers") from None
+    if not lowest <= quality <= highest:
+        raise ValueError(f"{name}: {fmt} quality must be between {lowest} and {highest}")
+    if max_bytes is not None and max_bytes <= 0:
+        raise ValueError(f"{name}: max bytes must be positive")
+    return fmt, quality, max_bytes
+
+# Checked once at import, so a bad override stops the bot at startup instead of failing every render
+ENCODE_POLICIES = {output: parse_encode_policy(output, os.getenv(f'ENCODE_{output.upper()}'))
+                   for output in ENCODE_DEFAULTS}
+
+def encode_policy(output):
+    return ENCODE_POLICIES[output]
+
+def has_transparency(img):
+    return img.mode in ('RGBA', 'LA', 'PA') and img.getchannel('A').getextrema()[0] < 255
+
+def encode_as(img, fmt, quality):
+    with io.BytesIO() as output:
+        if fmt == 'png':
+            img.save(output, 'PNG', compress_level=quality)
+        elif fmt == 'png8':
+            img.quantize(colors=256, method=Image.Quantize.FASTOCTREE).save(output, 'PNG', compress_level=quality)
+        elif fmt == 'webp':
+            img.save(output, 'WEBP', quality=quality, method=4)
+        elif fmt == 'webp-lossless':
+            img.save(output, 'WEBP', lossless=True, quality=quality, method=4)
+        elif fmt == 'jpeg':
+            img.convert('RGB').save(output, 'JPEG', quality=quality, optimize=True)
+        else:
+            raise ValueError(f"Unknown image format {fmt!r}")
+        return output.getvalue()
+
+def encode_image(img, output):
+    """Encode `img` with the policy for `output`, stepping down until it fits the byte budget.
+
+    Lossy formats lower their quality first, PNG falls back to a palette,
+    and as a last resort the image is scaled down.
+    """
+    fmt, quality, max_bytes = encode_policy(output)
+    if fmt == 'jpeg' and has_transparency(img):
+        fmt = 'webp'
+    data = encode_as(img, fmt, quality)
+    if max_bytes is None or len(data) <= max_bytes:
+        return data
+
+    if fmt in ('webp', 'jpeg'):
+        for lower in range(quality - 10, 39, -10):
+            data = encode_as(img, fmt, lower)
+            if len(data) <= max_bytes:
+                return data
+            quality = lower
+        # Scale down at the lowest quality tried (the configured one if that was already under 50)
+    elif fmt in ('png', 'webp-lossless'):
+        fmt, quality = 'png8', 9
+        data = encode_as(img, fmt, quality)
+
+    while len(data) > max_bytes and img.width > 64:
+        img = img.resize((int(img.width * 0.8), int(img.height * 0.8)), Image.Resampling.LANCZOS)
+        data = encode_as(img, fmt, quality)
+    return data
+
+def image_extension(data):
+    """File extension for encoded image bytes."""
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    if data[:3] == b'\xff\xd8\xff':
+        return 'jpg'
+    return 'png'
+
+
+
+#___________________________________________________________Blob Store___________________________________________________________
+class LocalBlobStore:
+    """Content-addressed image files under BLOB_DIR, named by their SHA-256.
+
+    Identical images are stored once. Sources are file paths, so render
+    workers memory-map the file and discord.File streams it, instead of the
+    bytes being copied through the bot. Needs a persistent disk shared by
+    every bot process.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory or os.getenv('BLOB_DIR', 'blobs')
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def _write(self, digest, data):
+        path = self.path(digest)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    async def put(self, pool, data):
+        digest = hashlib.sha256(data).hexdigest()
+        await asyncio.to_thread(self._write, digest, data)
+        return digest
+
+    async def sources(self, pool, digests):
+        return {digest: self.path(digest) for digest in digests if os.path.exists(self.path(digest))}
+
+
+class PostgresBlobStore:
+    """Blobs in the card_blobs table, for deployments without a persistent disk."""
+
+    async def put(self, pool, data):
+        digest = hashlib.sha256(data).hexdigest()
+        async with pool.acquire() as conn:
+            await conn.execute(
+                'INSERT INTO card_blobs (hash, data) VALUES ($1, $2) ON CONFLICT (hash) DO NOTHING',
+                digest, data
+            )
+        return digest
+
+    async def sources(self, pool, digests):
+        if not digests:
+            return {}
+        async with pool.acquire() as conn:
+            rows = await conn.fetch('SELECT hash, data FROM card_blobs WHERE hash = ANY($1::text[])', list(digests))
+        return {row['hash']: row['data'] for row in rows}
+
+
+def create_blob_store():
+    backend = os.getenv('BLOB_STORE', 'postgres')
+    if backend == 'local':
+        return LocalBlobStore()
+    if backend == 'postgres':
+        return PostgresBlobStore()
+    raise ValueError(f"Unknown BLOB_STORE {backend!r} (expected 'local' or 'postgres')")
+
+bot.blob_store = create_blob_store()
+
+def source_size(source):
+    return os.path.getsize(source) if isinstance(source, str) else len(source)
+
+CARD_SOURCES_QUERY = '''
+    SELECT id, image_hash, CASE WHEN image_hash IS NULL THEN image END AS image
+    FROM cards
+    WHERE id = ANY($1::text[])
+'''
+
+async def fetch_card_sources(pool, card_ids):
+    """Map card id -> image source: a blob store path, or bytes.
+
+    Cards not migrated to the blob store yet still read their BYTEA column.
+    """
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(CARD_SOURCES_QUERY, list(card_ids))
+    sources = {row['id']: row['image'] for row in rows if row['image'] is not None}
+    hashed = {row['id']: row['image_hash'] for row in rows if row['image_hash']}
+    blobs = await bot.blob_store.sources(pool, set(hashed.values()))
+    for card_id, digest in hashed.items():
+        if digest in blobs:
+            sources[card_id] = blobs[digest]
+    return sources
+
+async def migrate_images_to_blobs(pool, store, batch_size=50):
+    """Move cards.image BYTEA into the blob store, a batch at a time. Returns cards moved."""
+    moved = 0
+    while True:
+        async with pool.acquire() as conn:
+            rows = await conn.fetch('''
+                SELECT id, image FROM cards
+                WHERE image IS NOT NULL AND image_hash IS NULL
+                LIMIT $1
+            ''', batch_size)
+        if not rows:
+            return moved
+
+        updates = [(row['id'], await store.put(pool, row['image'])) for row in rows]
+        async with pool.acquire() as conn:
+            await conn.executemany('UPDATE cards SET image_hash = $2, image = NULL WHERE id = $1', updates)
+        moved += len(updates)
+
+
+
+#___________________________________________________________Derived Image Cache___________________________________________________________
+# Every card is pre-rendered at the sizes the bot actually displays
+CARD_VARIANTS = (
+    ('drop', 500),    # resized for the drop strip
+    ('album', 400),   # resized for album collages
+    ('locked', 400),  # blurred + darkened, for cards missing from an album
+)
+
+def render_card_variant(image_blob, variant, height):
+    """Render one derived image of a card as PNG bytes (runs in the render pool)."""
+    if variant == 'locked':
+        img = create_blurred_card(image_blob, height)
+    else:
+        img = blob_to_image(image_blob)
+        if variant == 'album':
+            if img.mode != 'RGBA':
+                img = img.convert('RGBA')
+            img = img.resize((int(height * img.width / img.height), height), Image.Resampling.LANCZOS)
+        else:
+            img = img.resize((int(img.width * height/img.height), height))
+
+    return encode_image(img, 'variant')
+
+
+class BytesLRU:
+    """LRU mapping of keys to bytes, bounded by the total size of the values."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def keys(self):
+        return list(self._items)
+
+    def get(self, key):
+        data = self._items.get(key)
+        if data is not None:
+            self._items.move_to_end(key)
+        return data
+
+    def put(self, key, data):
+        self.pop(key)
+        self._items[key] = data
+        self.size += len(data)
+        while self.size > self.max_bytes and self._items:
+            _, evicted = self._items.popitem(last=False)
+            self.size -= len(evicted)
+
+    def pop(self, key):
+        data = self._items.pop(key, None)
+        if data is not None:
+            self.size -= len(data)
+        return data
+
+
+class DerivedImageCache:
+    """Two-tier cache of rendered card variants.
+
+    Entries are keyed by (card_id, variant, height, image_hash), so a new image
+    never serves a stale variant. Hot entries live in an in-memory LRU bounded
+    by IMAGE_CACHE_BYTES; everything is also written under IMAGE_CACHE_DIR.
+    """
+
+    def __init__(self, catalog, renderer, max_bytes=None, directory=None):
+        self.catalog = catalog
+        self.renderer = renderer
+        self.directory = directory or os.getenv('IMAGE_CACHE_DIR', 'image_cache')
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = BytesLRU(max_bytes or int(os.getenv('IMAGE_CACHE_BYTES', 256 * 1024 * 1024)))
+        self._inflight = {}
+        self._tasks = set()
+
+    def _path(self, key):
+        card_id, variant, height, image_hash = key
+        return os.path.join(self.directory, quote(card_id, safe=''), f"{variant}-{height}-{image_hash}")
+
+    def _read_disk(self, keys):
+        found = {}
+        for key in keys:
+            try:
+                with open(self._path(key), 'rb') as f:
+                    found[key] = f.read()
+            except OSError:
+                pass
+        return found
+
+    def write_disk(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename so readers never see a half-written file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    async def _render(self, key, image_blob):
+        if key in self._inflight:
+            return await asyncio.shield(self._inflight[key])
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            card_id, variant, height, _ = key
+            data = await self.renderer.run(render_card_variant, image_blob, variant, height)
+            await asyncio.to_thread(self.write_disk, key, data)
+            self._memory.put(key, data)
+            future.set_result(data)
+            return data
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # mark retrieved when nobody else is waiting
+            raise
+        finally:
+            if not future.done():
+                future.cancel()
+            del self._inflight[key]
+
+    async def get_many(self, pool, requests):
+        """Return the variant bytes for each `(card_id, variant, height)`, in order.
+
+        Cards that no longer exist come back as None. Source images are only
+        fetched (in one query) for entries that are in neither tier.
+        """
+        results = [None] * len(requests)
+        keys = {}
+        for index, (card_id, variant, height) in enumerate(requests):
+            card = self.catalog.get(card_id)
+            if card is None:
+                continue
+            key = (card_id, variant, height, card['image_hash'])
+            data = self._memory.get(key)
+            if data is not None:
+                self.hits += 1
+                results[index] = data
+            else:
+                keys[index] = key
+
+        if keys:
+            from_disk = await asyncio.to_thread(self._read_disk, set(keys.values()))
+            for key, data in from_disk.items():
+                self._memory.put(key, data)
+            self.disk_hits += len(from_disk)
+
+            to_render = {index: key for index, key in keys.items() if key not in from_disk}
+            sources = {}
+            if to_render:
+                self.misses += len(set(to_render.values()))
+                card_ids = list({key[0] for key in to_render.values()})
+                sources = await fetch_card_sources(pool, card_ids)
+
+            pending = list({key for key in to_render.values() if key[0] in sources})
+            outputs = await asyncio.gather(*(self._render(key, sources[key[0]]) for key in pending))
+            rendered = dict(zip(pending, outputs))
+
+            for index, key in keys.items():
+                results[index] = from_disk.get(key) or rendered.get(key)
+
+        return results
+
+    def invalidate(self, card_id, keep_hash=None):
+        """Forget every variant of `card_id` except those rendered from `keep_hash`."""
+        for key in self._memory.keys():
+            if key[0] == card_id and key[3] != keep_hash:
+                self._memory.pop(key)
+
+        card_dir = os.path.dirname(self._path((card_id, '', 0, '')))
+        try:
+            names = os.listdir(card_dir)
+        except OSError:
+            return
+        for name in names:
+            if keep_hash is None or not name.endswith(f"-{keep_hash}"):
+                try:
+                    os.remove(os.path.join(card_dir, name))
+                except OSError:
+                    pass
+
+    def card_changed(self, pool, card_id, card):
+        """Catalog hook: drop stale variants and pre-render the new ones."""
+        if card_id is None:  # full reload, nothing specific changed
+            return
+        self.invalidate(card_id, keep_hash=card['image_hash'] if card else None)
+        if card is not None:
+            task = asyncio.create_task(self.pregenerate(pool, [card_id]))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def pregenerate(self, pool, card_ids):
+        try:
+            await self.get_many(pool, [
+                (card_id, variant, height)
+                for card_id in card_ids
+                for variant, height in CARD_VARIANTS
+            ])
+        except RenderQueueFull:
+            pass  # rendered on first use instead
+        except Exception as e:
+            print(f"Error pre-rendering card variants: {e}")
+
+bot.image_cache = DerivedImageCache(bot.catalog, bot.renderer)
+bot.catalog.on_change(lambda card_id, card: bot.image_cache.card_changed(bot.db, card_id, card))
+
+
+
+#___________________________________________________________Attachment URL Cache___________________________________________________________
+class AttachmentUrlCache:
+    """Discord CDN URLs of card images the bot has already uploaded.
+
+    Embeds point at the stored URL instead of uploading the image again.
+    Entries end when Discord's signed URL expires (its `ex` parameter), and
+    every ATTACHMENT_VERIFY_SECONDS a HEAD request checks the file is still
+    there (messages get deleted); a stale entry just means one re-upload.
+    Each entry remembers the image_hash it was uploaded from and is dropped
+    once the card's image changes.
+    """
+    EXPIRY_MARGIN = timedelta(hours=1)
+
+    def __init__(self, verify_interval=None):
+        self.verify_interval = verify_interval or int(os.getenv('ATTACHMENT_VERIFY_SECONDS', 600))
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self._entries = {}  # (card_id, variant) -> [url, size, expires_at, last verified, image_hash]
+        self._session = None
+        self._stale = set()  # card ids whose rows are still to be deleted
+        self._delete_task = None
+
+    @staticmethod
+    def url_expiry(url):
+        try:
+            expires = parse_qs(urlparse(url).query)['ex'][0]
+            return datetime.fromtimestamp(int(expires, 16), timezone.utc)
+        except (KeyError, ValueError):
+            return None  # unsigned URLs don't expire
+
+    async def load(self, pool):
+        async with pool.acquire() as conn:
+            rows = await conn.fetch('''
+                SELECT card_id, variant, url, size, expires_at, image_hash
+                FROM attachment_urls
+                WHERE expires_at IS NULL OR expires_at > NOW()
+            ''')
+        self._entries = {
+            (row['card_id'], row['variant']): [row['url'], row['size'], row['expires_at'], 0.0, row['image_hash']]
+            for row in rows
+        }
+
+    async def _still_there(self, url):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=3))
+        try:
+            async with self._session.head(url) as response:
+                return response.status < 400
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return True  # can't tell; let Discord try
+
+    async def get(self, card_id, variant='card'):
+        """Return a usable URL for the image, or None if it has to be uploaded."""
+        entry = self._entries.get((card_id, variant))
+        if entry is not None:
+            url, size, expires_at, verified_at = entry
+            if expires_at is not None and expires_at - self.EXPIRY_MARGIN <= datetime.now(timezone.utc):
+                entry = None
+            elif time.monotonic() - verified_at > self.verify_interval:
+                if await self._still_there(url):
+                    entry[3] = time.monotonic()
+                else:
+                    entry = None
+        if entry is None:
+            self._entries.pop((card_id, variant), None)
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.bytes_saved += entry[1]
+        return entry[0]
+
+    async def remember(self, pool, card_id, variant, message, size):
+        """Record the CDN URL of the image that `message` just uploaded."""
+        if not message.attachments:
+            return
+        url = message.attachments[0].url
+        expires_at = self.url_expiry(url)
+        card = bot.catalog.get(card_id)
+        image_hash = card['image_hash'] if card else None
+        self._entries[(card_id, variant)] = [url, size, expires_at, time.monotonic(), image_hash]
+        async with pool.acquire() as conn:
+            await conn.execute('''
+                INSERT INTO attachment_urls (card_id, variant, url, size, expires_at, image_hash)
+                VALUES ($1, $2, $3, $4, $5, $6)
+                ON CONFLICT (card_id, variant) DO UPDATE
+                SET url = EXCLUDED.url,
+                    size = EXCLUDED.size,
+                    expires_at = EXCLUDED.expires_at,
+                    image_hash = EXCLUDED.image_hash
+            ''', card_id, variant, url, size, expires_at, image_hash)
+
+    def card_changed(self, pool, card_id, card):
+        """Catalog hook: forget the URLs of images that changed (or of deleted cards).
+
+        Only memory is touched here; the table rows go in one batched DELETE
+        shortly after, so a bulk change does not queue a query per card.
+        """
+        stale = []
+        for key, entry in self._entries.items():
+            if card_id is not None and key[0] != card_id:
+                continue
+            current = card if card_id is not None else bot.catalog.get(key[0])  # None: full reload
+            if current is None or current['image_hash'] != entry[4]:
+                stale.append(key)
+        if not stale:
+            return
+        for key in stale:
+            del self._entries[key]
+            self._stale.add(key[0])
+        if self._delete_task is None or self._delete_task.done():
+            self._delete_task = asyncio.create_task(self._delete_stale(pool))
+
+    async def _delete_stale(self, pool):
+        await asyncio.sleep(0.1)  # let a burst of changes gather
+        while self._stale:
+            card_ids = list(self._stale)
+            self._stale.clear()
+            try:
+                async with pool.acquire() as conn:
+                    # Rows re-uploaded from the new image in the meantime stay
+                    await conn.execute('''
+                        DELETE FROM attachment_urls
+                        WHERE card_id = ANY($1::text[])
+                          AND image_hash IS DISTINCT FROM (SELECT image_hash FROM cards WHERE cards.id = attachment_urls.card_id)
+                    ''', card_ids)
+            except Exception as e:
+                print(f"Error deleting stale attachment URLs: {e}")
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+bot.attachment_urls = AttachmentUrlCache()
+bot.catalog.on_change(lambda card_id, card: bot.attachment_urls.card_changed(bot.db, card_id, card))
+
+async def send_card_image(ctx, card_id, embed, **kwargs):
+    """Send `embed` showing the card's image, reusing Discord's copy when there is one.
+
+    Returns the URL the embed's image points at (None if the card has no image).
+    """
+    url = await bot.attachment_urls.get(card_id)
+    if url:
+        embed.set_image(url=url)
+        await ctx.send(embed=embed, **kwargs)
+        return url
+
+    source = (await fetch_card_sources(bot.db, [card_id])).get(card_id)
+    if source is None:
+        await ctx.send(embed=embed, **kwargs)
+        return None
+
+    # A blob store path is streamed from disk; bytes come from Postgres
+    file = discord.File(source if isinstance(source, str) else io.BytesIO(source), filename="card.png")
+    embed.set_image(url="attachment://card.png")
+    with timed('upload'):
+        message = await ctx.send(embed=embed, file=file, **kwargs)
+    await bot.attachment_urls.remember(bot.db, card_id, 'card', message, source_size(source))
+    return "attachment://card.png"
+
+
+
+#___________________________________________________________Series Index___________________________________________________________
+def fold_vietnamese(text):
+    """Lowercase and strip diacritics so "tinh yeu" matches "Tình Yêu"."""
+    decomposed = unicodedata.normalize('NFD', text.lower().replace('đ', 'd'))
+    stripped = ''.join(ch for ch in decomposed if not unicodedata.combining(ch))
+    return ' '.join(stripped.split())
+
+def trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i+3] for i in range(len(padded) - 2)}
+
+
+class SeriesIndex:
+    """Accent-insensitive series lookup, maintained from the card catalog.
+
+    Matches are ranked exact, then prefix, then substring, then by trigram
+    similarity, so a search can pick the best series instead of asking the
+    user to be more specific.
+    """
+    EXACT, PREFIX, WORD_PREFIX, SUBSTRING, FUZZY = range(5)
+    MIN_SIMILARITY = 0.3
+
+    def __init__(self):
+        self.series = {}  # series name -> set of card ids
+        self._folded = {}  # series name -> folded name
+        self._trigrams = {}  # trigram -> set of series names
+        self._card_series = {}  # card id -> series name
+
+    def build(self, catalog):
+        self.series, self._folded, self._trigrams, self._card_series = {}, {}, {}, {}
+        for card in catalog.cards.values():
+            self._add_card(card['id'], card['series'])
+
+    def _add_card(self, card_id, series_name):
+        if not series_name:
+            return
+        self._card_series[card_id] = series_name
+        if series_name not in self.series:
+            self.series[series_name] = set()
+            folded = fold_vietnamese(series_name)
+            self._folded[series_name] = folded
+            for gram in trigrams(folded):
+                self._trigrams.setdefault(gram, set()).add(series_name)
+        self.series[series_name].add(card_id)
+
+    def _remove_card(self, card_id):
+        series_name = self._card_series.pop(card_id, None)
+        if series_name is None:
+            return
+        card_ids = self.series[series_name]
+        card_ids.discard(card_id)
+        if not card_ids:
+            del self.series[series_name]
+            for gram in trigrams(self._folded.pop(series_name)):
+                names = self._trigrams[gram]
+                names.discard(series_name)
+                if not names:
+                    del self._trigrams[gram]
+
+    def card_changed(self, catalog, card_id, card):
+        """Catalog hook: move the card to its (possibly new) series."""
+        if card_id is None:
+            self.build(catalog)
+            return
+        self._remove_card(card_id)
+        if card is not None:
+            self._add_card(card_id, card['series'])
+
+    def cards_in(self, series_name):
+        return self.series.get(series_name, set())
+
+    def search(self, query, limit=5):
+        """Return up to `limit` series names, best match first."""
+        folded = fold_vietnamese(query)
+        if not folded:
+            return []
+
+        ranked = []
+        for series_name, name in self._folded.items():
+            if name == folded:
+                rank = self.EXACT
+            elif name.startswith(folded):
+                rank = self.PREFIX
+            elif f" {folded}" in f" {name}":
+                rank = self.WORD_PREFIX
+            elif folded in name:
+                rank = self.SUBSTRING
+            else:
+                continue
+            ranked.append((rank, 0.0, len(name), series_name))
+
+        # Fall back to trigram similarity for typos and partial words
+        if len(ranked) < limit:
+            query_grams = trigrams(folded)
+            shared = {}
+            for gram in query_grams:
+                for series_name in self._trigrams.get(gram, ()):
+                    shared[series_name] = shared.get(series_name, 0) + 1
+            matched = {entry[3] for entry in ranked}
+            for series_name, count in shared.items():
+                if series_name in matched:
+                    continue
+                name_grams = len(trigrams(self._folded[series_name]))
+                similarity = count / (len(query_grams) + name_grams - count)
+                if similarity >= self.MIN_SIMILARITY:
+                    ranked.append((self.FUZZY, -similarity, len(self._folded[series_name]), series_name))
+
+        ranked.sort()
+        return [entry[3] for entry in ranked[:limit]]
+
+    def best(self, query):
+        matches = self.search(query, limit=1)
+        return matches[0] if matches else None
+
+bot.series_index = SeriesIndex()
+bot.catalog.on_change(lambda card_id, card: bot.series_index.card_changed(bot.catalog, card_id, card))
+
+
+
+#___________________________________________________________Drop Engine___________________________________________________________
+RARITIES = {
+    # name: (drop weight, label, label colour)
+    'common': (60, 'Common', (210, 210, 210)),
+    'rare': (25, 'Rare', (90, 170, 255)),
+    'epic': (10, 'Epic', (190, 120, 255)),
+    'legendary': (4, 'Legendary', (255, 195, 60)),
+    'mythic': (1, 'Mythic', (255, 95, 130)),
+}
+DEFAULT_RARITY = 'common'
+
+def card_rarity(card):
+    rarity = card.get('rarity') if card else None
+    return rarity if rarity in RARITIES else DEFAULT_RARITY
+
+def build_alias_table(weights):
+    """Vose's alias method: O(n) to build, O(1) per weighted draw.
+
+    Weights that are all zero draw uniformly instead of dividing by zero.
+    """
+    n = len(weights)
+    total = sum(weights)
+    if total <= 0:
+        return [1.0] * n, list(range(n))
+    prob = [weight * n / total for weight in weights]
+    alias = list(range(n))
+    small = [i for i, p in enumerate(prob) if p < 1]
+    large = [i for i, p in enumerate(prob) if p >= 1]
+    while small and large:
+        less, more = small.pop(), large.pop()
+        alias[less] = more
+        prob[more] -= 1 - prob[less]
+        (small if prob[more] < 1 else large).append(more)
+    for i in small + large:
+        prob[i] = 1.0
+    return prob, alias
+
+
+class DropEngine:
+    """Weighted card picker for drops.
+
+    A card's weight is its rarity weight times its series' event boost, so
+    cards fall into a handful of weight classes. An alias table over the
+    classes picks a class in O(1) and a uniform pick inside it picks the
+    card. A card change only moves one id between classes; the alias table
+    is rebuilt lazily and only covers the classes, so it stays tiny.
+    """
+
+    def __init__(self, catalog, series_index):
+        self.catalog = catalog
+        self.series_index = series_index
+        self.boosts = {}  # series -> (multiplier, ends_at)
+        self._classes = {}  # (rarity, boosted series or None) -> list of card ids
+        self._positions = {}  # card id -> (class key, index in that list)
+        self._table = None  # (class keys, prob, alias), None when stale
+        self._next_expiry = None
+        self.generation = 0  # bumped whenever any card's weight changes
+        self._boosts_stale = False
+        self._reload_task = None
+
+    def _class_of(self, card):
+        series_name = card['series'] if card['series'] in self.boosts else None
+        return (card_rarity(card), series_name)
+
+    def class_weight(self, key):
+        rarity, series_name = key
+        weight = RARITIES[rarity][0]
+        if series_name is not None:
+            weight *= self.boosts[series_name][0]
+        return weight
+
+    def _add(self, card):
+        key = self._class_of(card)
+        members = self._classes.setdefault(key, [])
+        self._positions[card['id']] = (key, len(members))
+        members.append(card['id'])
+        self._table = None
+        self.generation += 1
+
+    def _remove(self, card_id):
+        if card_id not in self._positions:
+            return
+        key, position = self._positions.pop(card_id)
+        members = self._classes[key]
+        last_id = members.pop()
+        if last_id != card_id:
+            members[position] = last_id
+            self._positions[last_id] = (key, position)
+        if not members:
+            del self._classes[key]
+        self._table = None
+        self.generation += 1
+
+    def rebuild(self):
+        self._classes, self._positions, self._table = {}, {}, None
+        for card in self.catalog.cards.values():
+            self._add(card)
+
+    def card_changed(self, card_id, card):
+        """Catalog hook: move the card to its new weight class."""
+        if card_id is None:
+            self.rebuild()
+            return
+        self._remove(card_id)
+        if card is not None:
+            self._add(card)
+
+    def set_boost(self, series_name, multiplier, ends_at):
+        """Boost (or with multiplier None, unboost) one series; only its cards move."""
+        if multiplier is None or multiplier == 1:
+            self.boosts.pop(series_name, None)
+        else:
+            self.boosts[series_name] = (multiplier, ends_at)
+        self._next_expiry = min((ends_at for _, ends_at in self.boosts.values()), default=None)
+        for card_id in list(self.series_index.cards_in(series_name)):
+            self._remove(card_id)
+            self._add(self.catalog.get(card_id))
+
+    async def load_boosts(self, pool):
+        async with pool.acquire() as conn:
+            rows = await conn.fetch('SELECT series, multiplier, ends_at FROM series_boosts WHERE ends_at > NOW()')
+        for series_name in list(self.boosts):
+            self.set_boost(series_name, None, None)
+        for row in rows:
+            if row['multiplier'] > 0:  # .boost rejects anything else
+                self.set_boost(row['series'], row['multiplier'], row['ends_at'])
+
+    def boosts_changed(self, connection, pid, channel, payload):
+        """NOTIFY callback: a cluster process changed a boost, so reload them all (there are few)."""
+        self._boosts_stale = True
+        if self._reload_task is None or self._reload_task.done():
+            self._reload_task = asyncio.create_task(self._reload_boosts())
+
+    async def _reload_boosts(self):
+        while self._boosts_stale:
+            self._boosts_stale = False
+            try:
+                await self.load_boosts(bot.db)
+            except Exception as e:
+                print(f"Error reloading series boosts: {e}")
+
+    def _expire_boosts(self):
+        if self._next_expiry is None or datetime.now(timezone.utc) < self._next_expiry:
+            return
+        now = datetime.now(timezone.utc)
+        for series_name, (_, ends_at) in list(self.boosts.items()):
+            if ends_at <= now:
+                self.set_boost(series_name, None, None)
+
+    def current_generation(self):
+        """The generation after expiring boosts that ran out, for comparing draws over time."""
+        self._expire_boosts()
+        return self.generation
+
+    def draw(self, k):
+        """Pick `k` distinct card ids by weight (None if there aren't enough cards)."""
+        self._expire_boosts()
+        if len(self._positions) < k:
+            return None
+        if self._table is None:
+            keys = list(self._classes)
+            prob, alias = build_alias_table([self.class_weight(key) * len(self._classes[key]) for key in keys])
+            self._table = (keys, prob, alias)
+        keys, prob, alias = self._table
+
+        # Redrawing duplicates gives the same odds as removing picked cards
+        chosen = []
+        for _ in range(k * 50):
+            index = random.randrange(len(keys))
+            if random.random() >= prob[index]:
+                index = alias[index]
+            card_id = random.choice(self._classes[keys[index]])
+            if card_id not in chosen:
+                chosen.append(card_id)
+                if len(chosen) == k:
+                    return chosen
+
+        # A few cards hold almost all of the weight: finish with a plain weighted pick
+        while len(chosen) < k:
+            remaining = [card_id for card_id in self._positions if card_id not in chosen]
+            weights = [self.class_weight(self._positions[card_id][0]) for card_id in remaining]
+            chosen.append(random.choices(remaining, weights if sum(weights) > 0 else None)[0])
+        return chosen
+
+bot.drop_engine = DropEngine(bot.catalog, bot.series_index)
+bot.catalog.subscribe('boosts_changed', bot.drop_engine.boosts_changed)
+bot.catalog.on_change(bot.drop_engine.card_changed)
+
+
+
+#___________________________________________________________Drop & Grab___________________________________________________________
+class GrabQueue:
+    """Write-behind queue for grabs.
+
+    Buttons acknowledge a grab immediately and queue it; a background task
+    flushes the queue every GRAB_FLUSH_MS or GRAB_BATCH_SIZE grabs as one
+    UNNEST upsert. Grabs are deduplicated by grab id and coalesced per
+    (user, card). Each batch commits in a single transaction, so it is
+    written whole or kept for the next flush. Grabs still queued when the
+    process dies are lost.
+
+    At most GRAB_QUEUE_SIZE grabs wait at once, failed ones included; while
+    `full`, buttons turn grabs away instead of queueing them.
+    """
+
+    def __init__(self, flush_interval=None, batch_size=None, max_size=None, retries=None):
+        self.flush_interval = flush_interval or int(os.getenv('GRAB_FLUSH_MS', 250)) / 1000
+        self.batch_size = batch_size or int(os.getenv('GRAB_BATCH_SIZE', 200))
+        self.max_size = max_size or int(os.getenv('GRAB_QUEUE_SIZE', 5000))
+        self.retries = retries or int(os.getenv('GRAB_FLUSH_RETRIES', 3))
+        self.flushed = 0
+        self._queue = None
+        self._task = None
+        self._closing = False
+        self._seen = OrderedDict()  # recent grab ids, for deduplication
+        self._failed = []  # grabs from a batch that could not be written yet
+
+    @property
+    def pending(self):
+        return (self._queue.qsize() if self._queue else 0) + len(self._failed)
+
+    @property
+    def full(self):
+        return self.pending >= self.max_size
+
+    def submit(self, user_id, card_id, grab_id):
+        """Queue one grab. Returns False if it was already queued before."""
+        if grab_id in self._seen:
+            return False
+        self._seen[grab_id] = None
+        while len(self._seen) > self.max_size * 2:
+            self._seen.popitem(last=False)
+
+        if self._task is None:
+            self._queue = asyncio.Queue(maxsize=self.max_size)
+            self._task = asyncio.create_task(self._run())
+        try:
+            self._queue.put_nowait((user_id, card_id))
+        except asyncio.QueueFull:
+            # Only grabs already claimed when the queue filled up get here (callers
+            # check `full` first): park them with the failed ones for the next flush
+            self._failed.append((user_id, card_id))
+        return True
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if self._closing and self._queue.empty():
+                if self._failed:
+                    await self._flush([])  # one last try
+                return
+
+            batch = []
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            if batch or self._failed:
+                await self._flush(batch)
+
+    async def _flush(self, batch):
+        batch = self._failed + batch
+        self._failed = []
+
+        # The same card grabbed twice by one user becomes a single +2 row;
+        # ON CONFLICT cannot touch one row twice in a statement
+        quantities = {}
+        for key in batch:
+            quantities[key] = quantities.get(key, 0) + 1
+        user_ids = [user_id for user_id, _ in quantities]
+        card_ids = [card_id for _, card_id in quantities]
+
+        for attempt in range(self.retries):
+            try:
+                async with bot.db.acquire() as conn:
+                    async with conn.transaction():
+                        # One statement writes the grabs and bumps the collection stats;
+                        # xmax = 0 marks rows that were inserted, i.e. a user's first copy
+                        totals = await conn.fetch('''
+                            WITH grab AS (
+                                SELECT * FROM UNNEST($1::bigint[], $2::text[], $3::int[]) AS grab(user_id, card_id, quantity)
+                            ), written AS (
+                                INSERT INTO inventory (user_id, card_id, quantity, grabbed_time)
+                                SELECT user_id, card_id, quantity, CURRENT_TIMESTAMP FROM grab
+                                ON CONFLICT (user_id, card_id) DO UPDATE
+                                SET quantity = inventory.quantity + EXCLUDED.quantity,
+                                    grabbed_time = EXCLUDED.grabbed_time
+                                RETURNING user_id, card_id, xmax = 0 AS first_copy
+                            ), deltas AS (
+                                SELECT written.user_id, cards.series, written.first_copy::int AS owned, grab.quantity AS copies
+                                FROM written
+                                JOIN grab USING (user_id, card_id)
+                                JOIN cards ON cards.id = written.card_id
+                            ), series_stats AS (
+                                INSERT INTO collection_stats (user_id, series, owned, copies)
+                                SELECT user_id, series, SUM(owned), SUM(copies) FROM deltas
+                                WHERE series IS NOT NULL
+                                GROUP BY user_id, series
+                                ON CONFLICT (user_id, series) DO UPDATE
+                                SET owned = collection_stats.owned + EXCLUDED.owned,
+                                    copies = collection_stats.copies + EXCLUDED.copies
+                            )
+                            INSERT INTO user_totals (user_id, owned, copies)
+                            SELECT user_id, SUM(owned), SUM(copies) FROM deltas
+                            GROUP BY user_id
+                            ON CONFLICT (user_id) DO UPDATE
+                            SET owned = user_totals.owned + EXCLUDED.owned,
+                                copies = user_totals.copies + EXCLUDED.copies
+                            RETURNING user_id, owned, copies
+                        ''', user_ids, card_ids, list(quantities.values()))
+                        if CLUSTER_COUNT > 1:
+                            # Other processes may have these users' pages cached; sent on commit
+                            notified = sorted(set(user_ids))
+                            for start in range(0, len(notified), 300):  # NOTIFY payloads stop at 8000 bytes
+                                await conn.execute("SELECT pg_notify('inventory_changed', array_to_string($1::bigint[], ','))",
+                                                   notified[start:start + 300])
+                break
+            except Exception as e:
+                print(f"Error flushing {len(batch)} grabs (attempt {attempt + 1}): {e}")
+                await asyncio.sleep(0.5 * 2 ** attempt)
+        else:
+            self._failed = batch + self._failed  # keep them, and any parked meanwhile, for the next flush
+            return
+
+        self.flushed += len(batch)
+        bot.leaderboard.update(totals)
+        for user_id in set(user_ids):
+            bot.inventory_pages.invalidate(user_id)
+
+    async def close(self):
+        """Flush everything still queued and stop the background task."""
+        if self._task is None:
+            return
+        self._closing = True
+        await self._task
+        self._task = None
+        if self._failed:
+            print(f"Lost {len(self._failed)} grabs that could not be written: {self._failed}")
+
+bot.grab_queue = GrabQueue()
+
+
+#___________________________________________________________Cooldowns___________________________________________________________
+class TTLMap:
+    """A dict whose entries expire, checked lazily on read.
+
+    Entries stay in insertion order and every write sweeps expired ones off
+    the front, so no timer is needed and memory is bounded by live entries.
+    Each map holds one cooldown rule, whose expiries grow with insertion
+    time, which keeps the sweep O(1) amortized.
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= now:
+            del self._entries[key]
+            return None
+        return entry[1]
+
+    def set(self, key, value, expires_at, now):
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while self._entries:
+            first_expiry, _ = next(iter(self._entries.values()))
+            if first_expiry > now:
+                break
+            self._entries.popitem(last=False)
+
+
+class CooldownRule:
+    """At most `rate` uses per `per` seconds of `action`, per user or per channel."""
+
+    def __init__(self, action, bucket, rate, per):
+        self.action = action
+        self.bucket = bucket  # 'user' or 'channel'
+        self.rate = rate
+        self.per = per
+
+    def key(self, user_id, channel_id):
+        return f"{self.action}:{self.bucket}:{user_id if self.bucket == 'user' else channel_id}"
+
+def cooldown_rules(action, **defaults):
+    """Rules for `action` from COOLDOWN_<ACTION>_<BUCKET>="rate/seconds"; "0" turns one off."""
+    rules = []
+    for bucket, default in defaults.items():
+        value = os.getenv(f'COOLDOWN_{action.upper()}_{bucket.upper()}', default)
+        if value and value != '0':
+            rate, per = value.split('/')
+            rules.append(CooldownRule(action, bucket, int(rate), float(per)))
+    return rules
+
+COOLDOWN_RULES = {
+    'drop': cooldown_rules('drop', user='1/120', channel='0'),
+    'grab': cooldown_rules('grab', user='0', channel='0'),
+    'export': cooldown_rules('export', user='1/300'),
+}
+
+
+class MemoryCooldowns:
+    """Fixed windows in this process only; they reset when it restarts."""
+
+    def __init__(self):
+        self._windows = {}  # rule -> TTLMap of key -> [uses, window end]
+
+    def _map(self, rule):
+        return self._windows.setdefault(rule, TTLMap())
+
+    def peek(self, rule, key):
+        now = time.monotonic()
+        window = self._map(rule).get(key, now)
+        return window[1] - now if window and window[0] >= rule.rate else 0.0
+
+    async def retry_after(self, rule, key):
+        return self.peek(rule, key)
+
+    async def hit(self, rule, key):
+        now = time.monotonic()
+        windows = self._map(rule)
+        window = windows.get(key, now)
+        if window is None:
+            windows.set(key, [1, now + rule.per], now + rule.per, now)
+            return 0.0
+        if window[0] >= rule.rate:
+            return window[1] - now
+        window[0] += 1
+        return 0.0
+
+    def refund(self, rule, key):
+        window = self._map(rule).get(key, time.monotonic())
+        if window and window[0] > 0:
+            window[0] -= 1
+
+
+class PostgresCooldowns:
+    """Fixed windows shared by every process through the `cooldowns` table.
+
+    A process leases up to rate / CLUSTER_COUNT uses of a window at once and
+    spends them locally, and remembers keys the table reports exhausted until
+    their window ends. Only the first use of a window per process costs a
+    round trip. Uses a process leased but did not spend are lost to the
+    others until the window ends.
+    """
+
+    def __init__(self, lease_share=None, purge_every=1000):
+        self.lease_share = lease_share or CLUSTER_COUNT
+        self.purge_every = purge_every
+        self.round_trips = 0
+        self._leases = {}  # rule -> TTLMap of key -> [uses left, window end, exhausted]
+        self._purge_task = None
+
+    def _map(self, rule):
+        return self._leases.setdefault(rule, TTLMap())
+
+    def peek(self, rule, key):
+        now = time.time()
+        lease = self._map(rule).get(key, now)
+        return lease[1] - now if lease and lease[2] else 0.0
+
+    async def retry_after(self, rule, key):
+        now = time.time()
+        lease = self._map(rule).get(key, now)
+        if lease:
+            return lease[1] - now if lease[2] else 0.0
+        async with bot.db.acquire() as conn:
+            row = await conn.fetchrow('SELECT window_end, used FROM cooldowns WHERE key = $1', key)
+        if row is None or row['used'] < rule.rate:
+            return 0.0
+        return max(0.0, row['window_end'].timestamp() - now)
+
+    async def hit(self, rule, key):
+        now = time.time()
+        leases = self._map(rule)
+        lease = leases.get(key, now)
+        if lease:
+            if lease[0] > 0:
+                lease[0] -= 1
+                return 0.0
+            if lease[2]:
+                return lease[1] - now
+
+        # Open a window or take more of the current one, whichever applies
+        size = max(1, rule.rate // self.lease_share)
+        self.round_trips += 1
+        if self.round_trips % self.purge_every == 0 and (self._purge_task is None or self._purge_task.done()):
+            self._purge_task = asyncio.create_task(self.purge())
+        async with bot.db.acquire() as conn:
+            row = await conn.fetchrow('''
+                INSERT INTO cooldowns AS c (key, window_end, used, granted)
+                VALUES ($1, now() + make_interval(secs => $2), $3, $3)
+                ON CONFLICT (key) DO UPDATE SET
+                    window_end = CASE WHEN c.window_end <= now() THEN EXCLUDED.window_end ELSE c.window_end END,
+                    granted = CASE WHEN c.window_end <= now() THEN $3 ELSE LEAST($3, $4 - c.used) END,
+                    used = CASE WHEN c.window_end <= now() THEN $3 ELSE LEAST(c.used + $3, $4) END
+                RETURNING window_end, granted
+            ''', key, float(rule.per), size, rule.rate)
+        window_end = row['window_end'].timestamp()
+        granted = row['granted']
+        leases.set(key, [max(granted - 1, 0), window_end, granted == 0], window_end, now)
+        return window_end - now if granted == 0 else 0.0
+
+    def refund(self, rule, key):
+        # Back into the local lease, where this process will spend it next
+        lease = self._map(rule).get(key, time.time())
+        if lease:
+            lease[0] += 1
+            lease[2] = False
+
+    async def purge(self):
+        try:
+            async with bot.db.acquire() as conn:
+                await conn.execute('DELETE FROM cooldowns WHERE window_end < now()')
+        except Exception as e:
+            print(f"Error purging expired cooldowns: {e}")
+
 
+class Cooldowns:
+    """Checks every rule of an action against one backend.
 
+    All rules are peeked locally first, so a use blocked by the channel does
+    not also spend the user's window; a rule that still refuses in `hit`
+    hands the uses already taken back.
+    """
 
+    def __init__(self, backend, rules):
+        self.backend = backend
+        self.rules = rules
 
-#___________________________________________________________Drop & Grab___________________________________________________________
-class CardButton(discord.ui.Button):  
-    def __init__(self, index, card_data):  
-        super().__init__(style=discord.ButtonStyle.primary, label=str(index + 1))  
-        self.card_data = card_data  
+    async def hit(self, action, user_id, channel_id):
+        """Use `action` once. Returns (0.0, None) or (seconds to wait, the rule that refused)."""
+        rules = self.rules.get(action, ())
+        for rule in rules:
+            retry_after = self.backend.peek(rule, rule.key(user_id, channel_id))
+            if retry_after > 0:
+                return retry_after, rule
+        for taken, rule in enumerate(rules):
+            retry_after = await self.backend.hit(rule, rule.key(user_id, channel_id))
+            if retry_after > 0:
+                for earlier in rules[:taken]:
+                    self.backend.refund(earlier, earlier.key(user_id, channel_id))
+                return retry_after, rule
+        return 0.0, None
+
+    async def retry_after(self, action, user_id, channel_id):
+        waits = [await self.backend.retry_after(rule, rule.key(user_id, channel_id)) for rule in self.rules.get(action, ())]
+        return max(waits, default=0.0)
+
+    def refund(self, action, user_id, channel_id):
+        """Give back a use whose action did not happen after all (a grab that lost the race)."""
+        for rule in self.rules.get(action, ()):
+            self.backend.refund(rule, rule.key(user_id, channel_id))
+
+# Shared across processes (and restarts) by default once there is more than one
+COOLDOWN_BACKEND = os.getenv('COOLDOWN_BACKEND', 'postgres' if CLUSTER_COUNT > 1 else 'memory')
+bot.cooldowns = Cooldowns(PostgresCooldowns() if COOLDOWN_BACKEND == 'postgres' else MemoryCooldowns(), COOLDOWN_RULES)
+
+BUCKET_TYPES = {'user': commands.BucketType.user, 'channel': commands.BucketType.channel}
+
+def use_cooldown(action):
+    """Spend one use of `action`'s cooldowns before the command runs; raises CommandOnCooldown like commands.cooldown.
+
+    A before_invoke hook rather than a check: checks also run for `.help`
+    (can_run), which must not spend anything.
+    """
+    async def hook(ctx):
+        retry_after, rule = await bot.cooldowns.hit(action, ctx.author.id, ctx.channel.id)
+        if retry_after > 0:
+            raise commands.CommandOnCooldown(commands.Cooldown(rule.rate, rule.per), retry_after, BUCKET_TYPES[rule.bucket])
+    return commands.before_invoke(hook)
+
+def format_cooldown(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 60}m {seconds % 60}s"
+
+
+DROP_TTL = int(os.getenv('DROP_TTL_SECONDS', 180))  # how long a drop can be grabbed
+CARD_ID_MAX_LENGTH = 64  # card ids travel in button custom_ids (100 characters at most)
+
+class DropStore:
+    """Open drops, kept in the `drops` table instead of in View objects.
+
+    A drop's buttons carry only its id and a card id, so any process can
+    settle a grab with one conditional UPDATE and memory does not grow with
+    the number of open drops. Settled drop ids are remembered (up to
+    `max_settled`) so repeat clicks are answered without a query.
+    """
+
+    def __init__(self, ttl=DROP_TTL, max_settled=5000, purge_every=500):
+        self.ttl = ttl
+        self.max_settled = max_settled
+        self.purge_every = purge_every
+        self.created = 0
+        self._settled = OrderedDict()  # drop id -> "claimed" | "expired"
+        self._purge_task = None
 
+    async def create(self, pool, channel_id, card_ids):
+        """Open a drop for `card_ids` and return its id."""
+        self.created += 1
+        if self.created % self.purge_every == 0 and (self._purge_task is None or self._purge_task.done()):
+            self._purge_task = asyncio.create_task(self.purge(pool))
+        async with pool.acquire() as conn:
+            return await conn.fetchval('''
+                INSERT INTO drops (channel_id, card_ids, expires_at)
+                VALUES ($1, $2, now() + make_interval(secs => $3))
+                RETURNING id
+            ''', channel_id, card_ids, float(self.ttl))
+
+    async def claim(self, pool, drop_id, user_id, card_id):
+        """Grab `card_id` from a drop for `user_id`.
+
+        Returns (card ids of the drop, None) for the first click, or
+        (None, "claimed" | "expired") for every other one.
+        """
+        reason = self._settled.get(drop_id)
+        if reason:
+            return None, reason
+        async with pool.acquire() as conn:
+            card_ids = await conn.fetchval('''
+                UPDATE drops SET claimed_by = $2, claimed_card = $3
+                WHERE id = $1 AND claimed_by IS NULL AND expires_at > now() AND $3 = ANY(card_ids)
+                RETURNING card_ids
+            ''', drop_id, user_id, card_id)
+            if card_ids is not None:
+                self.settle(drop_id, 'claimed')
+                return card_ids, None
+            # A statement of its own, so it sees a claim committed while the UPDATE waited
+            # on the row; a subquery of the UPDATE would still read the older snapshot
+            row = await conn.fetchrow('SELECT claimed_by IS NOT NULL AS claimed FROM drops WHERE id = $1', drop_id)
+        reason = 'claimed' if row and row['claimed'] else 'expired'
+        self.settle(drop_id, reason)
+        return None, reason
+
+    def settle(self, drop_id, reason):
+        self._settled[drop_id] = reason
+        while len(self._settled) > self.max_settled:
+            self._settled.popitem(last=False)
+
+    async def purge(self, pool):
+        try:
+            async with pool.acquire() as conn:
+                await conn.execute('DELETE FROM drops WHERE expires_at < now()')
+        except Exception as e:
+            print(f"Error purging expired drops: {e}")
+
+bot.drops = DropStore()
+
+class GrabButton(discord.ui.DynamicItem[discord.ui.Button], template=r'drop:(?P<drop_id>[0-9]+):(?P<card_id>.+)'):
+    def __init__(self, drop_id, card_id, label=None, style=discord.ButtonStyle.primary, disabled=False):
+        super().__init__(discord.ui.Button(style=style, label=label, disabled=disabled,
+                                           custom_id=f'drop:{drop_id}:{card_id}'))
+        self.drop_id = drop_id
+        self.card_id = card_id
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(int(match['drop_id']), match['card_id'], label=item.label)
+
+    @instrumented('grab')
     async def callback(self, interaction: discord.Interaction):  
         user_id = interaction.user.id  
-        card_id = self.card_data['id']  
-        
-        # Change this button's style to green  
-        self.style = discord.ButtonStyle.success  
-        
-        # Disable all buttons in the view  
-        for item in self.view.children:  
-            item.disabled = True  
-        
-        async with bot.db.acquire() as conn:  
-            # Modified the SQL query to be more explicit
-            await conn.execute('''  
-                INSERT INTO inventory (user_id, card_id, quantity, grabbed_time)  
-                VALUES ($1, $2, 1, CURRENT_TIMESTAMP)  
-                ON CONFLICT (user_id, card_id) DO UPDATE 
-                SET quantity = inventory.quantity + 1,  
-                    grabbed_time = CURRENT_TIMESTAMP  
-            ''', user_id, card_id)  
-            # Remove await conn.commit() as asyncpg auto-commits
-
-        # Update the message with disabled buttons  
-        await interaction.response.edit_message(view=self.view)  
+
+        # Acknowledge before any round trip (claim, shared cooldowns) so the
+        # 3-second interaction deadline never depends on the database
+        await interaction.response.defer()
+
+        if bot.grab_queue.full:
+            # Inventory writes are falling behind; leave the drop open rather than lose the grab
+            await interaction.followup.send("Bot đang bận quá, thử nhặt lại sau chút nhé 😭", ephemeral=True)
+            return
+
+        retry_after, _ = await bot.cooldowns.hit('grab', user_id, interaction.channel_id)
+        if retry_after > 0:
+            await interaction.followup.send(
+                f"Nhặt nhanh quá rồi, đợi {format_cooldown(retry_after)} nữa nhé 😭", ephemeral=True)
+            return
+
+        # Only the first click on a drop counts, whichever process receives it
+        card_ids, reason = await bot.drops.claim(bot.db, self.drop_id, user_id, self.card_id)
+        if card_ids is None:
+            bot.cooldowns.refund('grab', user_id, interaction.channel_id)
+            if reason == 'claimed':
+                await interaction.followup.send("Thẻ đã có người nhặt mất rồi 😢", ephemeral=True)
+            else:
+                await interaction.followup.send("Drop này hết hạn rồi 😢", ephemeral=True)
+            return
+
+        # The inventory write happens in the next flush
+        bot.grab_queue.submit(user_id, self.card_id, grab_id=self.drop_id)
+        bot.inventory_pages.invalidate(user_id)
+
+        # Update the message: all buttons disabled, the grabbed one green
+        await interaction.edit_original_response(view=drop_view(self.drop_id, card_ids, claimed=self.card_id))  
         
         # Send the grab confirmation message  
+        card = bot.catalog.get(self.card_id)
+        name = card['name'] if card else self.card_id
         await interaction.followup.send(  
-            f"{interaction.user.mention} Em iu đã nhặt được thẻ **{self.card_data['name']}**  💕"  
+            f"{interaction.user.mention} Em iu đã nhặt được thẻ **{name}**  💕"  
         )
 
-@bot.command(aliases=['d'])  
-#@commands.cooldown(1, 120, commands.BucketType.user)  # 1 use every 120 seconds (2 minutes)
-async def drop(ctx):  
-    async with bot.db.acquire() as conn:  
-        # Use fetch instead of execute for SELECT queries
-        all_cards = await conn.fetch('SELECT * FROM cards')
-        
-        if len(all_cards) < 3:  
-            await ctx.send("Not enough cards in the database!")  
-            return  
-            
-        selected_cards = random.sample(all_cards, 3)  
-        images = []  
-        card_data = []  
-        
-        for card in selected_cards:  
-            img = Image.open(BytesIO(card['image']))  # Use dictionary access
-            img = img.resize((int(img.width * 500/img.height), 500))  
-            images.append(img)  
-            card_data.append({  
-                'id': card['id'],
-                'name': card['name'],
-                'date': card['date'],
-                'series': card['series'],
-                'notes': card['notes']
-            })  
+def drop_view(drop_id, card_ids, claimed=None):
+    """The buttons of a drop. Every item is dynamic, so discord.py keeps no per-message state."""
+    view = discord.ui.View(timeout=None)
+    for i, card_id in enumerate(card_ids):
+        style = discord.ButtonStyle.success if card_id == claimed else discord.ButtonStyle.primary
+        view.add_item(GrabButton(drop_id, card_id, label=str(i + 1), style=style, disabled=claimed is not None))
+    return view
+
+def compose_drop_strip(image_blobs, height=500, labels=None):
+    """Resize the dropped cards to `height` and lay them out with 20px gaps.
+
+    `labels` is an optional `(text, rgb)` per card, written underneath it.
+    """
+    images = []
+    for blob in image_blobs:
+        img = Image.open(BytesIO(blob))
+        if img.height != height:
+            img = img.resize((int(img.width * height/img.height), height))
+        images.append(img)
 
     # Combine images  
-    total_width = sum(img.width for img in images) + 40  # 20px spacing between images  
-    max_height = 500  
-    
-    combined = Image.new('RGBA', (total_width, max_height), (0, 0, 0, 0))  
+    total_width = sum(img.width for img in images) + 20 * (len(images) - 1)  # 20px spacing between images  
+    label_height = 30 if labels else 0
+    combined = Image.new('RGBA', (total_width, height + label_height), (0, 0, 0, 0))  
+    draw = ImageDraw.Draw(combined)
+    font = load_font(18)
     x_offset = 0  
-    
-    for img in images:  
+
+    for idx, img in enumerate(images):  
         combined.paste(img, (x_offset, 0))  
+        if labels:
+            text, colour = labels[idx]
+            text_width = draw.textlength(text, font=font)
+            draw.text((x_offset + (img.width - text_width) // 2, height + 5), text, fill=colour, font=font)
         x_offset += img.width + 20  
 
-    # Save combined image  
-    with BytesIO() as image_binary:  
-        combined.save(image_binary, 'PNG')  
-        image_binary.seek(0)  
-        
-        # Create view with buttons  
-        view = discord.ui.View()  
-        for i in range(3):  
-            view.add_item(CardButton(i, card_data[i]))  
-            
-        file = discord.File(fp=image_binary, filename='cards.png')  
+    return combined
+
+def render_drop_strip(image_blobs, height=500, labels=None):
+    """Compose and encode the drop strip (runs in the render pool)."""
+    return encode_image(compose_drop_strip(image_blobs, height, labels), 'drop')
+
+async def render_drop(card_ids):
+    """The encoded strip for `card_ids`, or None if one of them was deleted meanwhile."""
+    images = await bot.image_cache.get_many(bot.db, [(card_id, 'drop', 500) for card_id in card_ids])
+    if None in images:
+        return None
+    labels = [RARITIES[card_rarity(bot.catalog.get(card_id))][1:] for card_id in card_ids]
+    return await bot.renderer.run(render_drop_strip, images, 500, labels)
+
+class DropBuffer:
+    """Drops drawn and rendered ahead of time, ready to upload.
+
+    A background task keeps up to `depth` drops (and stops at `max_bytes`
+    of encoded strips), rendering at most `rate` per second and only while
+    no other render is waiting, in the render pool like every other strip.
+    Each drop remembers the DropEngine generation it was drawn under; any
+    catalog change or boost moves the generation on and stale drops are
+    thrown away, so buffered drops always follow the current weights.
+    """
+
+    def __init__(self, engine, depth=None, max_bytes=None, rate=None):
+        self.engine = engine
+        self.depth = depth if depth is not None else int(os.getenv('DROP_BUFFER_SIZE', 8))
+        self.max_bytes = max_bytes or int(os.getenv('DROP_BUFFER_BYTES', 16 * 1024 * 1024))
+        self.rate = rate or float(os.getenv('DROP_BUFFER_RATE', 2))  # drops rendered per second at most
+        self.size = 0  # bytes of buffered strips
+        self.hits = 0
+        self.misses = 0
+        self.produced = 0
+        self.discarded = 0
+        self._drops = deque()  # (generation, card ids, strip), oldest first
+        self._wake = asyncio.Event()
+        self._task = None
+
+    def __len__(self):
+        return len(self._drops)
+
+    def _discard_stale(self):
+        generation = self.engine.current_generation()
+        while self._drops and self._drops[0][0] != generation:
+            _, _, strip = self._drops.popleft()
+            self.size -= len(strip)
+            self.discarded += 1
+
+    def pop(self):
+        """A ready (card ids, strip), or None when the buffer is empty."""
+        if not self.depth:
+            return None
+        self._discard_stale()
+        self._wake.set()
+        if not self._drops:
+            self.misses += 1
+            return None
+        _, card_ids, strip = self._drops.popleft()
+        self.size -= len(strip)
+        self.hits += 1
+        return card_ids, strip
+
+    def card_changed(self, card_id, card):
+        """Catalog hook: the weights moved, so everything buffered is stale."""
+        self._discard_stale()
+        self._wake.set()
+
+    def full(self):
+        return len(self._drops) >= self.depth or self.size >= self.max_bytes
+
+    async def _fill(self):
+        while True:
+            self._discard_stale()
+            if self.full():
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+            if bot.renderer.pending:  # commands first
+                await asyncio.sleep(0.05)
+                continue
+
+            generation = self.engine.current_generation()
+            card_ids = self.engine.draw(3)
+            try:
+                strip = await render_drop(card_ids) if card_ids else None
+            except RenderQueueFull:
+                await asyncio.sleep(1)
+                continue
+            except Exception as e:
+                print(f"Error pre-rendering a drop: {e}")
+                await asyncio.sleep(5)
+                continue
+            if strip is None:  # too few cards, or one was deleted: wait for the catalog
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+
+            if generation == self.engine.current_generation():
+                self._drops.append((generation, card_ids, strip))
+                self.size += len(strip)
+                self.produced += 1
+            else:
+                self.discarded += 1
+            await asyncio.sleep(1 / self.rate)
+
+    def start(self):
+        if self.depth and self._task is None:
+            self._task = asyncio.create_task(self._fill())
+
+    async def close(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+bot.drop_buffer = DropBuffer(bot.drop_engine)
+bot.catalog.on_change(bot.drop_buffer.card_changed)
+
+@bot.command(aliases=['d'])  
+@use_cooldown('drop')  # COOLDOWN_DROP_USER, default 1 use every 120 seconds (2 minutes)
+async def drop(ctx):  
+    # Every return before the drop is sent hands the cooldown use back
+    if len(bot.catalog) < 3:  
+        bot.cooldowns.refund('drop', ctx.author.id, ctx.channel.id)
+        await ctx.send("Not enough cards in the database!")  
+        return  
+
+    # Usually a drop is already rendered and waiting in the buffer
+    ready = bot.drop_buffer.pop()
+    if ready is not None:
+        selected_ids, strip = ready
+    else:
+        # Pick by rarity in memory; images come pre-resized from the cache
+        selected_ids = bot.drop_engine.draw(3)
+        try:
+            strip = await render_drop(selected_ids)
+        except RenderQueueFull:
+            bot.cooldowns.refund('drop', ctx.author.id, ctx.channel.id)
+            await ctx.send("Em iu đang bận vẽ thẻ, thử lại sau chút nhé 😭")
+            return
+        if strip is None:  # A card was deleted since it was sampled
+            bot.cooldowns.refund('drop', ctx.author.id, ctx.channel.id)
+            await ctx.send("Not enough cards in the database!")  
+            return  
+
+    # Create view with buttons; the drop itself lives in the database
+    drop_id = await bot.drops.create(bot.db, ctx.channel.id, selected_ids)
+    view = drop_view(drop_id, selected_ids)
+
+    file = discord.File(fp=BytesIO(strip), filename=f'cards.{image_extension(strip)}')  
+    with timed('upload'):
         await ctx.send(file=file, view=view)
 @drop.error  
 async def drop_error(ctx, error):  
     if isinstance(error, commands.CommandOnCooldown):  
-        remaining_time = int(error.retry_after)  
-        minutes = remaining_time // 60  
-        seconds = remaining_time % 60  
-        await ctx.send(f"Drop is on cooldown! Try again in {minutes}m {seconds}s")
+        await ctx.send(f"Drop is on cooldown! Try again in {format_cooldown(error.retry_after)}")
+    elif isinstance(error, commands.CommandInvokeError):
+        bot.cooldowns.refund('drop', ctx.author.id, ctx.channel.id)
+        print(f"Error in drop command: {error}")
+        await ctx.send("An error occurred while dropping cards.")
+
+@bot.command()
+@commands.is_owner()
+async def boost(ctx, multiplier: float, hours: float, *, series_keyword: str):
+    """Multiply a series' drop weight for a while: `.boost 3 24 tình yêu` (multiplier 1 ends it)."""
+    if not 0 < multiplier < float('inf'):  # also rejects nan
+        await ctx.send("Hệ số boost phải lớn hơn 0 nhé (dùng 1 để tắt boost)")
+        return
+    series_name = bot.series_index.best(series_keyword)
+    if series_name is None:
+        await ctx.send(f"Không tìm thấy series nào có từ khóa '{series_keyword}' 😢")
+        return
+
+    ends_at = datetime.now(timezone.utc) + timedelta(hours=hours)
+    async with bot.db.acquire() as conn:
+        if multiplier == 1 or hours <= 0:
+            await conn.execute('DELETE FROM series_boosts WHERE series = $1', series_name)
+        else:
+            await conn.execute('''
+                INSERT INTO series_boosts (series, multiplier, ends_at)
+                VALUES ($1, $2, $3)
+                ON CONFLICT (series) DO UPDATE
+                SET multiplier = EXCLUDED.multiplier,
+                    ends_at = EXCLUDED.ends_at
+            ''', series_name, multiplier, ends_at)
+        if CLUSTER_COUNT > 1:
+            # The other processes' drop tables still have the old weights
+            await conn.execute("SELECT pg_notify('boosts_changed', $1)", series_name)
+
+    if multiplier == 1 or hours <= 0:
+        bot.drop_engine.set_boost(series_name, None, None)
+        await ctx.send(f"Đã tắt boost cho **{series_name}**")
+    else:
+        bot.drop_engine.set_boost(series_name, multiplier, ends_at)
+        await ctx.send(f"**{series_name}** rơi nhiều gấp {multiplier:g} lần trong {hours:g} giờ tới 💕")
 
 
 
@@ -173,24 +2593,158 @@ from discord.ext import commands
 from discord.ui import View, Button  
 from datetime import datetime  
 
-class PaginationView(View):  
-    def __init__(self, inventory_list):  
+def format_series_emoji(series_emoji):
+    # Format the emoji properly if it's just an ID  
+    if series_emoji and series_emoji.isdigit():  
+        return f"<:card:{series_emoji}>"  
+    return series_emoji or "🃏"  # Default emoji if none is set  
+
+def format_card_date(release_date, fmt='%d/%m/%y'):
+    return release_date.strftime(fmt) if release_date else release_date
+
+def format_inventory_line(card_id, quantity):
+    card = bot.catalog.get(card_id) or {'series': '?', 'name': '?', 'date': None, 'series_emoji': None}
+    series_emoji = format_series_emoji(card['series_emoji'])
+    formatted_date = format_card_date(card['date'])
+    return f"`{quantity}x` {series_emoji} `{card_id}` {card['series']} **{card['name']}** `{formatted_date}`"
+
+
+class InventoryQuery:
+    """One user's inventory, filtered and sorted, read a page at a time.
+
+    Pages are keyset-paginated on (sort column, card_id), so page N costs the
+    same as page 1 and only the rows on screen leave the database.
+    """
+    SORTS = {
+        'recent': 'grabbed_time',
+        'qty': 'quantity',
+    }
+
+    def __init__(self, user_id, sort='recent', series_name=None, dupes=False):
+        self.user_id = user_id
+        self.sort = sort
+        self.series_name = series_name
+        self.dupes = dupes
+
+    @property
+    def key(self):
+        return (self.sort, self.series_name, self.dupes)
+
+    def describe(self):
+        parts = []
+        if self.series_name:
+            parts.append(self.series_name)
+        if self.dupes:
+            parts.append("chỉ thẻ trùng")
+        if self.sort == 'qty':
+            parts.append("theo số lượng")
+        return " · ".join(parts)
+
+    def _where(self):
+        conditions, args = ['user_id = $1'], [self.user_id]
+        if self.series_name:
+            args.append(list(bot.series_index.cards_in(self.series_name)))
+            conditions.append(f'card_id = ANY(${len(args)}::text[])')
+        if self.dupes:
+            conditions.append('quantity > 1')
+        return conditions, args
+
+    async def count(self, conn):
+        conditions, args = self._where()
+        return await conn.fetchval(f'SELECT COUNT(*) FROM inventory WHERE {" AND ".join(conditions)}', *args)
+
+    async def page(self, conn, cursor, limit):
+        """Fetch `limit` rows after `cursor`; returns (rows, cursor of the next page)."""
+        column = self.SORTS[self.sort]
+        conditions, args = self._where()
+        if cursor is not None:
+            args.extend(cursor)
+            conditions.append(f'({column}, card_id) < (${len(args) - 1}, ${len(args)})')
+        rows = await conn.fetch(f'''
+            SELECT card_id, quantity, {column} AS sort_key
+            FROM inventory
+            WHERE {" AND ".join(conditions)}
+            ORDER BY {column} DESC, card_id DESC
+            LIMIT {limit + 1}
+        ''', *args)
+        next_cursor = (rows[limit - 1]['sort_key'], rows[limit - 1]['card_id']) if len(rows) > limit else None
+        return rows[:limit], next_cursor
+
+
+class InventoryPageCache:
+    """Recently viewed inventory pages per user, dropped when that user grabs a card."""
+
+    def __init__(self, max_users=None):
+        self.max_users = max_users or int(os.getenv('INVENTORY_CACHE_USERS', 500))
+        self._users = OrderedDict()  # user id -> {key: page}
+
+    def get(self, user_id, key):
+        pages = self._users.get(user_id)
+        if pages is None:
+            return None
+        self._users.move_to_end(user_id)
+        return pages.get(key)
+
+    def put(self, user_id, key, page):
+        self._users.setdefault(user_id, {})[key] = page
+        self._users.move_to_end(user_id)
+        while len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+
+    def invalidate(self, user_id):
+        self._users.pop(user_id, None)
+
+    def clear(self):
+        self._users.clear()
+
+bot.inventory_pages = InventoryPageCache()
+
+def on_inventory_changed(connection, pid, channel, payload):
+    # Grabs flushed by another cluster process
+    for user_id in payload.split(','):
+        bot.inventory_pages.invalidate(int(user_id))
+
+bot.catalog.subscribe('inventory_changed', on_inventory_changed)
+bot.catalog.on_change(lambda card_id, card: bot.inventory_pages.clear())  # names/series shown on pages may change
+
+
+INVENTORY_PAGE_SIZE = 10
+
+class InventoryView(View):  
+    def __init__(self, query, total_items):  
         super().__init__(timeout=60)  
-        self.inventory_list = inventory_list  
+        self.query = query
         self.current_page = 0  
-        self.items_per_page = 10  
-        self.total_pages = len(inventory_list) // self.items_per_page + (1 if len(inventory_list) % self.items_per_page else 0)  
-        
+        self.items_per_page = INVENTORY_PAGE_SIZE
+        self.total_pages = max(1, -(-total_items // self.items_per_page))
+        self.cursors = [None]  # keyset cursor that starts each page seen so far
+
         # Add buttons  
         self.add_item(Button(label="◀", custom_id="previous", style=discord.ButtonStyle.primary))  
         self.add_item(Button(label="▶", custom_id="next", style=discord.ButtonStyle.primary))  
 
-    def get_current_page_embed(self, author_name):  
-        start_idx = self.current_page * self.items_per_page  
-        end_idx = start_idx + self.items_per_page  
-        current_items = self.inventory_list[start_idx:end_idx]  
+    async def load_current_page(self):
+        """Return the formatted lines of the current page, from cache or the database."""
+        cursor = self.cursors[self.current_page]
+        key = (self.query.key, cursor)
+        page = bot.inventory_pages.get(self.query.user_id, key)
+        if page is None:
+            async with bot.db.acquire() as conn:
+                rows, next_cursor = await self.query.page(conn, cursor, self.items_per_page)
+            page = ([format_inventory_line(row['card_id'], row['quantity']) for row in rows], next_cursor)
+            bot.inventory_pages.put(self.query.user_id, key, page)
+
+        lines, next_cursor = page
+        if next_cursor is not None and len(self.cursors) == self.current_page + 1:
+            self.cursors.append(next_cursor)
+        return lines
+
+    async def get_current_page_embed(self, author_name):  
+        current_items = await self.load_current_page()
 
         embed = discord.Embed(title=f"Bộ sưu tập của {author_name} 💕", color=discord.Color.blue())  
+        if self.query.describe():
+            embed.description = self.query.describe()
         embed.add_field(  
             name=f"Page {self.current_page + 1}/{self.total_pages}",  
             value="\n".join(current_items) if current_items else "No items found.",  
@@ -200,64 +2754,55 @@ class PaginationView(View):
 
     async def interaction_check(self, interaction: discord.Interaction) -> bool:  
         button_id = interaction.data["custom_id"]  
-        
+
         if button_id == "previous" and self.current_page > 0:  
             self.current_page -= 1  
-        elif button_id == "next" and self.current_page < self.total_pages - 1:  
+        elif button_id == "next" and self.current_page < len(self.cursors) - 1:  
             self.current_page += 1  
-        
+
         await interaction.response.edit_message(  
-            embed=self.get_current_page_embed(interaction.user.name)  
+            embed=await self.get_current_page_embed(interaction.user.name)  
         )  
         return True  
 
 @bot.command(aliases=['c'])  
-async def inventory(ctx):  
-    async with bot.db.acquire() as conn:  
-        rows = await conn.fetch('''  
-            SELECT   
-                cards.id,  
-                inventory.quantity,  
-                cards.series,  
-                cards.name,  
-                cards.date,  
-                cards.series_emoji,   
-                inventory.grabbed_time  
-            FROM inventory  
-            JOIN cards ON inventory.card_id = cards.id  
-            WHERE inventory.user_id = $1  
-            ORDER BY inventory.grabbed_time DESC  
-        ''', ctx.author.id)   
-        
-        if not rows:  
+async def inventory(ctx, *, options: str = ''):  
+    """Show your collection: `.c [qty] [dupes] [series]`."""
+    sort, dupes, series_words = 'recent', False, []
+    for word in options.split():
+        if word.lower() in ('qty', 'quantity'):
+            sort = 'qty'
+        elif word.lower() in ('dupes', 'dup'):
+            dupes = True
+        else:
+            series_words.append(word)
+
+    series_name = None
+    if series_words:
+        series_name = bot.series_index.best(' '.join(series_words))
+        if series_name is None:
+            await ctx.send(f"Không tìm thấy series nào có từ khóa '{' '.join(series_words)}' 😢")
+            return
+
+    query = InventoryQuery(ctx.author.id, sort, series_name, dupes)
+    total = bot.inventory_pages.get(ctx.author.id, (query.key, 'count'))
+    if total is None:
+        async with bot.db.acquire() as conn:  
+            total = await query.count(conn)
+        bot.inventory_pages.put(ctx.author.id, (query.key, 'count'), total)
+
+    if not total:  
+        if query.describe():
+            await ctx.send("Không có thẻ nào phù hợp 😭")
+        else:
             await ctx.send("Eiu chưa sưu tập thẻ nào cả 😭")  
-            return  
+        return  
 
-        # Create inventory list  
-        inventory_list = []  
-        for row in rows:  
-            card_id, quantity, series, name, release_date, series_emoji, grabbed_time = row  
-            
-            try:  
-                date_obj = datetime.strptime(release_date, '%Y-%m-%d')  
-                formatted_date = date_obj.strftime('%d/%m/%y')  
-            except:  
-                formatted_date = release_date  
-            
-            # Format the emoji properly if it's just an ID  
-            if series_emoji and series_emoji.isdigit():  
-                series_emoji = f"<:card:{series_emoji}>"  
-            elif not series_emoji:  
-                series_emoji = "🃏"  # Default emoji if none is set  
-            
-            formatted_line = f"`{quantity}x` {series_emoji} `{card_id}` {series} **{name}** `{formatted_date}`"  
-            inventory_list.append(formatted_line)  
+    # Create view with pagination  
+    view = InventoryView(query, total)  
+    initial_embed = await view.get_current_page_embed(ctx.author.name)  
 
-        # Create view with pagination  
-        view = PaginationView(inventory_list)  
-        initial_embed = view.get_current_page_embed(ctx.author.name)  
-        
-        await ctx.send(embed=initial_embed, view=view)
+    await ctx.send(embed=initial_embed, view=view)
 #__________________________________________________________________________VIEW CARD__________________________________________________________________________
 @bot.command(aliases=['v'])  
 async def view(ctx, card_id=None):  
@@ -281,9 +2826,10 @@ async def view(ctx, card_id=None):
             SELECT cards.name,   
                 cards.series,   
                 cards.date,   
-                cards.image,   
+                (cards.image_hash IS NOT NULL OR cards.image IS NOT NULL) AS has_image,   
                 cards.notes,  
                 cards.series_emoji,  
+                cards.rarity,  
                 inventory.quantity  
             FROM cards  
             LEFT JOIN inventory ON cards.id = inventory.card_id   
@@ -296,7 +2842,7 @@ async def view(ctx, card_id=None):
             await ctx.send("Card not found!")  
             return  
             
-        name, series, date, image_data, notes, series_emoji, quantity = row  
+        name, series, date, has_image, notes, series_emoji, rarity, quantity = row  
         
         # Format the emoji  
         if series_emoji and series_emoji.isdigit():  
@@ -304,8 +2850,7 @@ async def view(ctx, card_id=None):
         elif not series_emoji:  
             series_emoji = "🃏"  
 
-        # Convert date format  
-        formatted_date = datetime.strptime(date, '%Y-%m-%d').strftime('%d/%m/%Y')  
+        formatted_date = format_card_date(date, '%d/%m/%Y')
 
         embed = discord.Embed(color=discord.Color.blue())  
         embed.title = f"{series_emoji} {name}"  
@@ -314,47 +2859,169 @@ async def view(ctx, card_id=None):
         embed.add_field(name="ID", value=f"`{card_id}`", inline=True)  
         embed.add_field(name="Series", value=series, inline=True)  
         embed.add_field(name="Release Date", value=formatted_date, inline=True)  
+        embed.add_field(name="Rarity", value=RARITIES[card_rarity({'rarity': rarity})][1], inline=True)
             
-        if image_data:  
-            file = discord.File(io.BytesIO(image_data), filename="card.png")  
-            embed.set_image(url="attachment://card.png")  
+        if has_image:  
             # Add copies owned as footer  
             embed.set_footer(text=f"Copies owned: {quantity}")  
         
         if notes:  
             embed.add_field(name="Notes", value=notes, inline=False)  
             
-        if image_data:  
-            await ctx.send(file=file, embed=embed)  
-        else:  
-            await ctx.send(embed=embed)
+    if has_image:  
+        await send_card_image(ctx, card_id, embed)
+    else:  
+        await ctx.send(embed=embed)
 #__________________________________________________________________________COOLDOWN__________________________________________________________________________
 @bot.command(aliases=['cd'])  
 async def cooldown(ctx):  
-    # Get the drop command  
-    drop_command = bot.get_command('drop')  
-    
     # Check if the command is on cooldown  
-    if drop_command._buckets.valid:  
-        bucket = drop_command._buckets.get_bucket(ctx)  
-        retry_after = bucket.get_retry_after()  
-        
-        if retry_after:  
-            minutes = int(retry_after) // 60  
-            seconds = int(retry_after) % 60  
-            await ctx.send(f"Drop cooldown: {minutes}m {seconds}s remaining")  
+    lines = []
+    for action in ('drop', 'grab'):
+        if not bot.cooldowns.rules[action]:
+            continue
+        retry_after = await bot.cooldowns.retry_after(action, ctx.author.id, ctx.channel.id)
+        if retry_after > 0:  
+            lines.append(f"{action.capitalize()} cooldown: {format_cooldown(retry_after)} remaining")  
         else:  
-            await ctx.send("Drop is ready!")  
-    else:  
-        await ctx.send("Drop is ready!")
+            lines.append(f"{action.capitalize()} is ready!")
+    await ctx.send('\n'.join(lines) or "Drop is ready!")
+
+
+#___________________________________________________________STATS___________________________________________________________
+# collection_stats and user_totals are kept up to date by the grab flush
+# (and by a trigger when a card changes series), so nothing here scans inventory
+SERIES_PROGRESS_QUERY = 'SELECT owned, copies FROM collection_stats WHERE user_id = $1 AND series = $2'
+USER_PROGRESS_QUERY = 'SELECT series, owned, copies FROM collection_stats WHERE user_id = $1'
+LEADERBOARD_QUERY = '''
+    SELECT user_id, owned, copies FROM user_totals
+    ORDER BY owned DESC, copies DESC, user_id
+    LIMIT $1
+'''
+LEADERBOARD_SHOWN = 10
+PROGRESS_SHOWN = 15
+
+class Leaderboard:
+    """The top users by distinct cards owned, kept in memory.
+
+    Loaded from user_totals at startup and updated with the totals each
+    grab flush returns, so reading it costs nothing. Totals only grow, so
+    the kept `size` entries stay exact for this process; grabs written by
+    other cluster processes show up at the next reload, at most `refresh`
+    seconds later.
+    """
+
+    def __init__(self, size=None, refresh=None):
+        self.size = size or int(os.getenv('LEADERBOARD_SIZE', 100))
+        self.refresh = refresh if refresh is not None else float(os.getenv('LEADERBOARD_REFRESH', 60))
+        self.entries = []  # [(user_id, owned, copies)], best first
+        self.loaded_at = None
+
+    @staticmethod
+    def rank_key(entry):
+        user_id, owned, copies = entry
+        return (-owned, -copies, user_id)
+
+    async def load(self, pool):
+        async with pool.acquire() as conn:
+            rows = await conn.fetch(LEADERBOARD_QUERY, self.size)
+        self.entries = [(row['user_id'], row['owned'], row['copies']) for row in rows]
+        self.loaded_at = time.monotonic()
+
+    def update(self, rows):
+        """Merge the new totals of users who just grabbed."""
+        if not rows:
+            return
+        entries = {user_id: (user_id, owned, copies) for user_id, owned, copies in self.entries}
+        for row in rows:
+            entries[row['user_id']] = (row['user_id'], row['owned'], row['copies'])
+        self.entries = sorted(entries.values(), key=self.rank_key)[:self.size]
+
+    async def top(self, pool, count):
+        if CLUSTER_COUNT > 1 and (self.loaded_at is None or time.monotonic() - self.loaded_at > self.refresh):
+            await self.load(pool)
+        return self.entries[:count]
+
+bot.leaderboard = Leaderboard()
+
+async def rebuild_collection_stats(conn):
+    """Recount collection_stats and user_totals from inventory (migration backfill, bulk loads)."""
+    await conn.execute('TRUNCATE collection_stats, user_totals')
+    await conn.execute('''
+        INSERT INTO collection_stats (user_id, series, owned, copies)
+        SELECT inventory.user_id, cards.series, COUNT(*), COALESCE(SUM(inventory.quantity), 0)
+        FROM inventory
+        JOIN cards ON cards.id = inventory.card_id
+        WHERE cards.series IS NOT NULL
+        GROUP BY inventory.user_id, cards.series
+    ''')
+    await conn.execute('''
+        INSERT INTO user_totals (user_id, owned, copies)
+        SELECT user_id, COUNT(*), COALESCE(SUM(quantity), 0)
+        FROM inventory
+        GROUP BY user_id
+    ''')
+
+@bot.command(aliases=['lb', 'top'])
+async def leaderboard(ctx):
+    """Top collectors by distinct cards owned."""
+    entries = await bot.leaderboard.top(bot.db, LEADERBOARD_SHOWN)
+    if not entries:
+        await ctx.send("Chưa có ai nhặt thẻ nào cả 😢")
+        return
+
+    lines = [
+        f"**{rank}.** <@{user_id}> — {owned} thẻ ({copies} bản)"
+        for rank, (user_id, owned, copies) in enumerate(entries, 1)
+    ]
+    embed = discord.Embed(title="Bảng xếp hạng 🏆", description="\n".join(lines), color=discord.Color.gold())
+    await ctx.send(embed=embed)
+
+@bot.command(aliases=['p'])
+async def progress(ctx):
+    """Your completion of every series you have cards from."""
+    async with bot.db.acquire() as conn:
+        rows = await conn.fetch(USER_PROGRESS_QUERY, ctx.author.id)
+
+    series_progress = []
+    for row in rows:
+        total = len(bot.series_index.cards_in(row['series']))
+        if total:
+            series_progress.append((row['owned'] / total, row['series'], row['owned'], total))
+    if not series_progress:
+        await ctx.send("Bạn chưa có thẻ nào cả, thử `.drop` nhé 💕")
+        return
+
+    series_progress.sort(key=lambda item: (-item[0], item[1]))
+    lines = [
+        f"**{series_name}** {owned}/{total} ({ratio:.0%}){' ✅' if owned >= total else ''}"
+        for ratio, series_name, owned, total in series_progress[:PROGRESS_SHOWN]
+    ]
+    embed = discord.Embed(title=f"Tiến độ của {ctx.author.name} 💕", description="\n".join(lines), color=discord.Color.pink())
+    completed = sum(1 for _, _, owned, total in series_progress if owned >= total)
+    embed.set_footer(text=f"{completed}/{len(series_progress)} series hoàn thành")
+    await ctx.send(embed=embed)
 
 
 #________________________________________________________ALBUM________________________________________________________
 
 
-def normalize_vietnamese(text):  
-    return unicodedata.normalize('NFC', text) 
+@lru_cache(maxsize=None)
+def load_font(size):
+    # Try to load a font, fall back to default if not found  
+    try:  
+        return ImageFont.truetype(os.path.join(os.path.dirname(os.path.abspath(__file__)), "ggsans.ttf"), size)
+    except OSError:  
+        return ImageFont.load_default()  
+
 def blob_to_image(blob_data):  
+    if isinstance(blob_data, str):  # path into the local blob store
+        with open(blob_data, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        img = Image.open(mapped)
+        img.load()
+        mapped.close()
+        return img
     return Image.open(io.BytesIO(blob_data))  
 
 def create_blurred_card(image_blob, target_height):  
@@ -377,7 +3044,7 @@ def create_blurred_card(image_blob, target_height):
     
     return blurred  
 
-def create_collage(collected_blobs, card_ids, target_height=400):  
+def create_collage(card_images, card_ids, target_height=400):  
     spacing = 10  # Spacing between cards  
     resized_images = []  
     
@@ -386,16 +3053,16 @@ def create_collage(collected_blobs, card_ids, target_height=400):
     
     # Process each card slot (4 slots total)  
     for i in range(4):  
-        if i < len(collected_blobs):  
-            # Process collected card  
-            img = blob_to_image(collected_blobs[i])  
+        if i < len(card_images):  
+            img = card_images[i]
             if img.mode != 'RGBA':  
                 img = img.convert('RGBA')  
             
             # Resize while maintaining aspect ratio  
-            aspect_ratio = img.width / img.height  
-            new_width = int(target_height * aspect_ratio)  
-            img = img.resize((new_width, target_height), Image.Resampling.LANCZOS)  
+            if img.height != target_height:
+                aspect_ratio = img.width / img.height  
+                new_width = int(target_height * aspect_ratio)  
+                img = img.resize((new_width, target_height), Image.Resampling.LANCZOS)  
             
         else:  # Empty slot  
             # Create transparent placeholder  
@@ -412,11 +3079,7 @@ def create_collage(collected_blobs, card_ids, target_height=400):
     # Create a draw object  
     draw = ImageDraw.Draw(collage)  
     
-    # Try to load a font, fall back to default if not found  
-    try:  
-        font = ImageFont.truetype("ggsans.ttf", 16)  # You might need to adjust the font path and size  
-    except:  
-        font = ImageFont.load_default()  
+    font = load_font(16)
     
     # Paste images and add text with spacing  
     x_offset = 0  
@@ -436,137 +3099,293 @@ def create_collage(collected_blobs, card_ids, target_height=400):
     
     return collage   
 
-@bot.command(aliases=['a'])  
-async def album(ctx, *, series_keyword: str):  
+def render_album_group(cards, target_height=400):
+    """Render one album collage from `(card_id, variant_blob)` pairs (runs in the render pool).
+
+    The blobs are the cached 'album'/'locked' variants, already at `target_height`.
+    """
+    images = [blob_to_image(image_blob) for _, image_blob in cards]
+    collage = create_collage(images, [card_id for card_id, _ in cards], target_height=target_height)
+
+    return encode_image(collage, 'album')
+
+ALBUM_FILES_PER_MESSAGE = 10  # Discord's attachment limit per message
+ALBUM_RENDER_AHEAD = ALBUM_FILES_PER_MESSAGE  # collages rendering ahead of the upload
+ALBUM_UPLOAD_LIMIT = 10 * 1024 * 1024  # Discord's default per-message upload limit outside guilds
+
+async def render_album_collage(group, collected_ids):
+    """Render one album collage (up to 4 cards) from cached variants."""
+    requests = [
+        (card['id'], 'album' if card['id'] in collected_ids else 'locked', 400)
+        for card in group
+    ]
+    images = await bot.image_cache.get_many(bot.db, requests)
+    cards = [(card['id'], image) for card, image in zip(group, images) if image is not None]
+    return await bot.renderer.run(render_album_group, cards, 400)
+
+class AlbumPageCache:
+    """Rendered album pages, shared between users whose page looks the same.
+
+    A page is keyed by its cards, their image hashes and which of them are
+    collected, so fully collected and fully locked pages are rendered once
+    for everybody and flipping back to a page costs no Pillow work.
+    """
+
+    def __init__(self, max_bytes=None):
+        self._pages = BytesLRU(max_bytes or int(os.getenv('ALBUM_PAGE_CACHE_BYTES', 64 * 1024 * 1024)))
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(series_name, page, group, collected_ids):
+        signature = []
+        for card in group:
+            catalog_card = bot.catalog.get(card['id']) or {}
+            signature.append((card['id'], catalog_card.get('image_hash'), card['id'] in collected_ids))
+        return (series_name, page, hashlib.sha1(repr(signature).encode()).hexdigest())
+
+    async def get(self, series_name, page, group, collected_ids):
+        key = self.key(series_name, page, group, collected_ids)
+        collage = self._pages.get(key)
+        if collage is not None:
+            self.hits += 1
+            return collage
+
+        self.misses += 1
+        collage = await render_album_collage(group, collected_ids)
+        self._pages.put(key, collage)
+        return collage
+
+bot.album_pages = AlbumPageCache()
+
+
+class AlbumView(View):
+    def __init__(self, author_id, series_name, cards, embed):
+        super().__init__(timeout=120)
+        self.author_id = author_id
+        self.series_name = series_name
+        self.collected_ids = {}  # page -> ids the author owns on it, looked up when first shown
+        self.embed = embed
+        self.pages = [cards[i:i+4] for i in range(0, len(cards), 4)]  # Group cards into sets of 4
+        self.current_page = 0
+
+        # Add buttons
+        self.add_item(Button(label="◀", custom_id="previous", style=discord.ButtonStyle.primary))
+        self.add_item(Button(label="▶", custom_id="next", style=discord.ButtonStyle.primary))
+
+    async def render_current_page(self):
+        """Render (or reuse) only the page being viewed and point the embed at it."""
+        group = self.pages[self.current_page]
+        collected_ids = self.collected_ids.get(self.current_page)
+        if collected_ids is None:
+            async with bot.db.acquire() as conn:
+                rows = await conn.fetch(ALBUM_PAGE_COLLECTED_QUERY, self.author_id, [card['id'] for card in group])
+            collected_ids = self.collected_ids[self.current_page] = {row['card_id'] for row in rows}
+        collage = await bot.album_pages.get(self.series_name, self.current_page, group, collected_ids)
+        filename = f'album.{image_extension(collage)}'
+        self.embed.set_image(url=f"attachment://{filename}")
+        self.embed.set_footer(text=f"Page {self.current_page + 1}/{len(self.pages)}")
+        return discord.File(fp=io.BytesIO(collage), filename=filename)
+
+    @instrumented('album_page')
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        if interaction.user.id != self.author_id:
+            await interaction.response.send_message("Đây là album của người khác nha 💕", ephemeral=True)
+            return False
+
+        button_id = interaction.data["custom_id"]
+        page = self.current_page
+        if button_id == "previous" and page > 0:
+            page -= 1
+        elif button_id == "next" and page < len(self.pages) - 1:
+            page += 1
+
+        # A cold page may take longer than the interaction deadline to render
+        await interaction.response.defer()
+        if page == self.current_page:
+            return True
+
+        self.current_page = page
+        try:
+            file = await self.render_current_page()
+        except RenderQueueFull:
+            await interaction.followup.send("Em iu đang bận vẽ thẻ, thử lại sau chút nhé 😭", ephemeral=True)
+            return True
+        with timed('upload'):
+            await interaction.edit_original_response(embed=self.embed, attachments=[file], view=self)
+        return True
+
+ALBUM_COLLECTED_QUERY = '''
+    SELECT card_id
+    FROM inventory
+    WHERE user_id = $1 AND card_id IN (
+        SELECT id FROM cards WHERE series = $2
+    )
+'''
+ALBUM_PAGE_COLLECTED_QUERY = 'SELECT card_id FROM inventory WHERE user_id = $1 AND card_id = ANY($2::text[])'
+
+async def load_album(ctx, series_keyword):
+    """Find the series and the author's progress in it.
+
+    Returns (series_name, cards, embed), or None when the
+    search already answered the user.
+    """
+    series_name = bot.series_index.best(series_keyword)
+    if series_name is None:
+        await ctx.send(f"Không tìm thấy series nào có từ khóa '{series_keyword}' 😢")  
+        return None
+
+    # Cards of the series come straight from the catalog
+    all_cards = sorted(
+        (bot.catalog.get(card_id) for card_id in bot.series_index.cards_in(series_name)),
+        key=lambda card: card['id']
+    )
+
     async with bot.db.acquire() as conn:  
-        # Get all series first  
-        all_series = await conn.fetch('SELECT DISTINCT series FROM cards ORDER BY series')
-        
-        # Normalize the search keyword  
-        normalized_keyword = normalize_vietnamese(series_keyword.lower())  
+        # Progress is one row of the collection stats, however big the series
+        stats = await conn.fetchrow(SERIES_PROGRESS_QUERY, ctx.author.id, series_name)
         
-        # Filter series using normalized comparison  
-        matching_series = [  
-            series['series'] for series in all_series   
-            if normalized_keyword in normalize_vietnamese(series['series'].lower())  
-        ]  
-        
-        if not matching_series:  
-            await ctx.send(f"Không tìm thấy series nào có từ khóa '{series_keyword}' 😢")  
-            return  
-        
-        if len(matching_series) > 1:  
-            series_list = '\n'.join([f"• {series}" for series in matching_series])  
-            await ctx.send(f"Tìm thấy nhiều series phù hợp với từ khóa '{series_keyword}':\n{series_list}\nVui lòng chọn một series cụ thể.")  
-            return  
-        
-        series_name = matching_series[0]  
-        
-        # Get all cards from the matched series  
-        all_cards = await conn.fetch('''  
-            SELECT id, image, series_emoji  
-            FROM cards  
-            WHERE series = $1  
-            ORDER BY id  
-        ''', series_name)  
-        
-        # Get user's collected cards from this series  
-        collected_rows = await conn.fetch('''  
-            SELECT card_id  
-            FROM inventory  
-            WHERE user_id = $1 AND card_id IN (  
-                SELECT id FROM cards WHERE series = $2  
-            )  
-        ''', ctx.author.id, series_name)  
-        
-        collected_ids = [row['card_id'] for row in collected_rows]  
-        
-        # Calculate progress  
-        total_cards = len(all_cards)  
-        collected_count = len(collected_ids)  
-        
-        # Get series emoji  
-        series_emoji = all_cards[0]['series_emoji'] if all_cards and all_cards[0]['series_emoji'] else "🃏"  
-        if series_emoji and series_emoji.isdigit():  
-            series_emoji = f"<:card:{series_emoji}>"  
-        
-        progress = f"{series_emoji} Progress: {collected_count}/{total_cards}"  
-        # Create and send embed  
-        embed = discord.Embed(  
-            title=f"Album {series_name}",  
-            description=progress,  
-            color=discord.Color.pink()  
-        )  
+    # Calculate progress  
+    total_cards = len(all_cards)  
+    collected_count = stats['owned'] if stats else 0
+    
+    # Get series emoji  
+    series_emoji = all_cards[0]['series_emoji'] if all_cards and all_cards[0]['series_emoji'] else "🃏"  
+    if series_emoji and series_emoji.isdigit():  
+        series_emoji = f"<:card:{series_emoji}>"  
+    
+    progress = f"{series_emoji} Progress: {collected_count}/{total_cards}"  
+    # Create embed  
+    embed = discord.Embed(  
+        title=f"Album {series_name}",  
+        description=progress,  
+        color=discord.Color.pink()  
+    )  
+    return series_name, all_cards, embed
+
+@bot.command(aliases=['a'])  
+async def album(ctx, *, series_keyword: str):  
+    loaded = await load_album(ctx, series_keyword)
+    if loaded is None:
+        return
+    series_name, all_cards, embed = loaded
+
+    if not all_cards:
         await ctx.send(embed=embed)
+        return
 
-        # Group cards into sets of 4  
-        for i in range(0, len(all_cards), 4):  
-            group = all_cards[i:i+4]  
-            group_images = []  
-            group_ids = []  # Store card IDs  
-            
-            for card in group:  
-                if card['id'] in collected_ids:  # If card is collected  
-                    group_images.append(card['image'])  # Use original image  
-                else:  # If card is not collected  
-                    blurred = create_blurred_card(card['image'], 400)  
-                    with io.BytesIO() as img_byte:  
-                        blurred.save(img_byte, 'PNG')  
-                        group_images.append(img_byte.getvalue())  
-                group_ids.append(card['id'])  # Add card ID to the list  
-            
-            collage = create_collage(group_images, group_ids, target_height=400)  
-            
-            # Convert collage to bytes for sending  
-            with io.BytesIO() as image_binary:  
-                collage.save(image_binary, 'PNG')  
-                image_binary.seek(0)  
-                await ctx.send(file=discord.File(fp=image_binary, filename='collage.png'))      
+    view = AlbumView(ctx.author.id, series_name, all_cards, embed)
+    try:
+        file = await view.render_current_page()
+    except RenderQueueFull:
+        await ctx.send("Em iu đang bận vẽ thẻ, thử lại sau chút nhé 😭")
+        return
+    with timed('upload'):
+        await ctx.send(embed=embed, file=file, view=view)
+
+@bot.command(aliases=['aa'])
+async def albumall(ctx, *, series_keyword: str):
+    """Post every page of the album at once."""
+    loaded = await load_album(ctx, series_keyword)
+    if loaded is None:
+        return
+    series_name, all_cards, embed = loaded
+    async with bot.db.acquire() as conn:
+        # Every page is shown, so fetch the whole series' collected cards at once
+        collected_ids = {row['card_id'] for row in await conn.fetch(ALBUM_COLLECTED_QUERY, ctx.author.id, series_name)}
+    groups = [all_cards[i:i+4] for i in range(0, len(all_cards), 4)]  # Group cards into sets of 4
+
+    if groups:
+        embed.set_footer(text=f"Đang tải album... 0/{len(groups)}")
+    message = await ctx.send(embed=embed)
+
+    # Later collages render while earlier ones upload; the lookahead bounds how
+    # much of one album can sit in the render queue at once
+    upload_limit = ctx.guild.filesize_limit if ctx.guild else ALBUM_UPLOAD_LIMIT
+    pending = deque()
+    next_group = 0
+    sent = 0
+
+    def schedule():
+        nonlocal next_group
+        while next_group < len(groups) and len(pending) < ALBUM_RENDER_AHEAD:
+            pending.append(asyncio.create_task(
+                bot.album_pages.get(series_name, next_group, groups[next_group], collected_ids)
+            ))
+            next_group += 1
+
+    try:
+        schedule()
+        while sent < len(groups):
+            # Pack as many collages into one message as Discord allows
+            batch, batch_bytes = [], 0
+            while pending and len(batch) < ALBUM_FILES_PER_MESSAGE:
+                collage = await pending[0]
+                if batch and batch_bytes + len(collage) > upload_limit:
+                    break
+                pending.popleft()
+                batch.append(discord.File(fp=io.BytesIO(collage), filename=f'collage_{sent + len(batch) + 1}.{image_extension(collage)}'))
+                batch_bytes += len(collage)
+
+            schedule()  # the next message renders while this one uploads
+            with timed('upload'):
+                await ctx.send(files=batch)
+            sent += len(batch)
+            if sent < len(groups):
+                embed.set_footer(text=f"Đang tải album... {sent}/{len(groups)}")
+            else:
+                embed.remove_footer()
+            await message.edit(embed=embed)
+    except RenderQueueFull:
+        await ctx.send("Em iu đang bận vẽ thẻ, thử lại sau chút nhé 😭")
+    finally:
+        for task in pending:
+            task.cancel()
 
 
 #___________________________________________________________Memories___________________________________________________________
 
 
 
-class RevealButton(Button):  
-    def __init__(self, card_info):  
-        super().__init__(label="Tiết lộ", style=discord.ButtonStyle.primary)  
-        self.card_info = card_info  
+class RevealButton(discord.ui.DynamicItem[Button], template=r'memories:(?P<card_id>.+)'):
+    def __init__(self, card_id):  
+        super().__init__(Button(label="Tiết lộ", style=discord.ButtonStyle.primary, custom_id=f'memories:{card_id}'))
+        self.card_id = card_id
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(match['card_id'])
 
+    @instrumented('reveal')
     async def callback(self, interaction: discord.Interaction):  
         await interaction.response.defer()  
 
         try:  
-            # Format the date  
-            try:  
-                # Convert string to datetime object and then format it  
-                date_obj = datetime.strptime(self.card_info['date'], '%Y-%m-%d')  # Assuming the date in DB is in YYYY-MM-DD  
-                formatted_date = date_obj.strftime('%d/%m/%Y')  
-            except:  
-                # If date conversion fails, use the original date  
-                formatted_date = self.card_info['date']  
+            card = bot.catalog.get(self.card_id)
+            if card is None:
+                await interaction.followup.send("Thẻ này không còn nữa rồi 😢", ephemeral=True)
+                return
+            formatted_date = format_card_date(card['date'], '%d/%m/%Y')
 
             # Create embed with card name as title  
             embed = discord.Embed(  
-                title=self.card_info['name'],  
+                title=card['name'],  
                 color=discord.Color.pink()  
             )  
             
             # Add card information fields with modified layout and formatted date  
-            embed.add_field(name="ID", value=f"`{self.card_info['id']}`", inline=True)  
-            embed.add_field(name="Series", value=self.card_info['series'], inline=True)  
+            embed.add_field(name="ID", value=f"`{card['id']}`", inline=True)  
+            embed.add_field(name="Series", value=card['series'], inline=True)  
             embed.add_field(name="Date", value=formatted_date, inline=True)  
             
-            if self.card_info['notes']:  
-                embed.add_field(name="Notes", value=self.card_info['notes'], inline=False)  
+            if card['notes']:  
+                embed.add_field(name="Notes", value=card['notes'], inline=False)  
 
-            # Add the image  
-            if self.card_info['image']:  
-                file = discord.File(io.BytesIO(self.card_info['image']), filename="card.png")  
-                embed.set_image(url="attachment://card.png")  
-                await interaction.edit_original_response(embed=embed, attachments=[file], view=None)  
-            else:  
-                await interaction.edit_original_response(embed=embed, view=None)  
+            # Point at the image the message already shows instead of uploading it again  
+            embeds = interaction.message.embeds
+            if embeds and embeds[0].image.url:  
+                embed.set_image(url=embeds[0].image.url)  
+            await interaction.edit_original_response(embed=embed, view=None)  
 
         except Exception as e:  
             print(f"Error in reveal button callback: {e}")  
@@ -575,64 +3394,306 @@ class RevealButton(Button):
                 ephemeral=True  
             )  
 
-class MemoriesView(View):  
-    def __init__(self, card_info):  
-        super().__init__(timeout=180.0)  # Added timeout of 3 minutes  
-        self.add_item(RevealButton(card_info))  
+class CardPicker:
+    """Uniform random cards from the catalog, without repeats per channel.
+
+    Each channel keeps a ring buffer of its last MEMORIES_NO_REPEAT picks;
+    a pick that hits the buffer is simply redrawn.
+    """
+
+    def __init__(self, catalog, history=None):
+        self.catalog = catalog
+        self.history = history if history is not None else int(os.getenv('MEMORIES_NO_REPEAT', 20))
+        self._recent = {}  # channel id -> deque of recent card ids
+
+    def pick(self, channel_id):
+        if not len(self.catalog):
+            return None
+        recent = self._recent.get(channel_id)
+        if recent is None:
+            recent = self._recent[channel_id] = deque(maxlen=self.history)
+
+        # Only the newest len(catalog) - 1 picks can be avoided
+        avoid = set(list(recent)[-(len(self.catalog) - 1):]) if len(self.catalog) > 1 else set()
+        card_id = self.catalog.sample(1)[0]
+        for _ in range(16):
+            if card_id not in avoid:
+                break
+            card_id = self.catalog.sample(1)[0]
+        else:
+            # Nearly the whole catalog is in the buffer: choose among what is left
+            card_id = random.choice([card_id for card_id in self.catalog.cards if card_id not in avoid])
+
+        if self.history:
+            recent.append(card_id)
+        return card_id
+
+bot.card_picker = CardPicker(bot.catalog)
 
 @bot.command(aliases=['m'])  
 async def memories(ctx):  
     try:  
-        async with bot.db.acquire() as conn:  
-            # Get total number of cards  
-            total_cards = await conn.fetchval('SELECT COUNT(*) FROM cards')
-                
-            if total_cards == 0:  
-                await ctx.send("No cards found in the database.")  
-                return  
-                
-            # Get a random card  
-            card = await conn.fetchrow('''  
-                SELECT id, name, date, series, image, notes, series_emoji  
-                FROM cards  
-                ORDER BY RANDOM()  
-                LIMIT 1  
-            ''')
-                
-            if not card:  
-                await ctx.send("Could not fetch a card.")  
-                return  
-                
-            # Create card info dictionary  
-            card_info = {  
-                'id': card['id'],
-                'name': card['name'],
-                'date': card['date'],
-                'series': card['series'],
-                'image': card['image'],
-                'notes': card['notes'],
-                'series_emoji': card['series_emoji']
-            }  
-
-            # Create initial embed with just the card image  
-            embed = discord.Embed(  
-                title="Memories",   
-                color=discord.Color.pink()  
-            )  
+        # Pick in memory, avoiding the channel's recent memories  
+        card_id = bot.card_picker.pick(ctx.channel.id)
+        card = bot.catalog.get(card_id) if card_id else None
+            
+        if card is None:  
+            await ctx.send("No cards found in the database.")  
+            return  
             
-            # Add the image to the initial embed  
-            if card_info['image']:  
-                file = discord.File(io.BytesIO(card_info['image']), filename="card.png")  
-                embed.set_image(url="attachment://card.png")  
-                view = MemoriesView(card_info)  
-                await ctx.send(embed=embed, file=file, view=view)  
-            else:  
-                view = MemoriesView(card_info)  
-                await ctx.send(embed=embed, view=view)  
+        # Create initial embed with just the card image  
+        embed = discord.Embed(  
+            title="Memories",   
+            color=discord.Color.pink()  
+        )  
+        # The button only carries the card id; the reveal reads the rest from the catalog
+        view = View(timeout=None)
+        view.add_item(RevealButton(card_id))
+        
+        # Add the image to the initial embed  
+        if card['image_hash']:  # md5(image) is NULL only when there is no image
+            await send_card_image(ctx, card_id, embed, view=view)
+        else:  
+            await ctx.send(embed=embed, view=view)  
 
     except Exception as e:  
         print(f"Error in memories command: {e}")  
         await ctx.send("An error occurred while fetching the card.")
+
+
+#___________________________________________________________Export___________________________________________________________
+EXPORT_FORMATS = ('csv', 'jsonl')
+EXPORT_CHUNK_ROWS = int(os.getenv('EXPORT_CHUNK_ROWS', 2000))  # rows per cursor fetch
+EXPORT_SPOOL_BYTES = int(os.getenv('EXPORT_SPOOL_BYTES', 1024 * 1024))  # a part spills to disk past this
+EXPORT_PART_SLACK = 256 * 1024  # room for what the text and gzip buffers have not written yet
+
+USER_EXPORT_QUERY = '''
+    SELECT inventory.card_id, cards.name, cards.series, cards.rarity, cards.date,
+           inventory.quantity, inventory.grabbed_time
+    FROM inventory
+    JOIN cards ON cards.id = inventory.card_id
+    WHERE inventory.user_id = $1
+    ORDER BY inventory.grabbed_time DESC, inventory.card_id DESC
+'''
+# Whole tables for export.py; images stay in the blob store
+EXPORT_TABLES = {
+    'cards': 'SELECT id, name, date, series, notes, series_emoji, rarity, image_hash FROM cards ORDER BY id',
+    'inventory': 'SELECT user_id, card_id, quantity, grabbed_time FROM inventory ORDER BY user_id, card_id',
+    'series': 'SELECT name, emoji FROM series ORDER BY name',
+    'collection_stats': 'SELECT user_id, series, owned, copies FROM collection_stats ORDER BY user_id, series',
+    'user_totals': 'SELECT user_id, owned, copies FROM user_totals ORDER BY user_id',
+}
+
+def export_value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+class ExportWriter:
+    """Rows to CSV or JSON lines, gzipped on the fly, split into parts.
+
+    Rows go straight through to the current part's file, so only the chunk
+    being written is in memory. A part is closed once it nears `part_bytes`
+    (after compression) and the next one starts with its own header, so
+    every part opens on its own. Parts are SpooledTemporaryFiles unless
+    `open_part(number)` supplies the file.
+    """
+
+    def __init__(self, fmt='csv', compress=False, part_bytes=None, open_part=None):
+        self.fmt = fmt
+        self.compress = compress
+        self.part_bytes = part_bytes
+        self.open_part = open_part or (lambda number: tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES))
+        self.parts = []  # finished part files, rewound
+        self.rows = 0
+        self._columns = None
+        self._raw = self._text = self._csv = None
+
+    @property
+    def extension(self):
+        return self.fmt + ('.gz' if self.compress else '')
+
+    def _start_part(self):
+        self._raw = self.open_part(len(self.parts) + 1)
+        stream = gzip.GzipFile(fileobj=self._raw, mode='wb') if self.compress else self._raw
+        # The BOM lets spreadsheet apps see the CSV (and its Vietnamese names) as UTF-8
+        self._text = io.TextIOWrapper(stream, encoding='utf-8-sig' if self.fmt == 'csv' else 'utf-8', newline='')
+        if self.fmt == 'csv':
+            self._csv = csv.writer(self._text)
+            self._csv.writerow(self._columns)
+
+    def _finish_part(self):
+        self._text.flush()
+        stream = self._text.detach()
+        if self.compress:
+            stream.close()  # writes the gzip trailer; leaves the part file open
+        if isinstance(self._raw, tempfile.SpooledTemporaryFile):
+            self._raw.rollover()  # finished parts wait on disk, not in memory
+        self._raw.seek(0)
+        self.parts.append(self._raw)
+        self._raw = self._text = self._csv = None
+
+    def write_rows(self, rows):
+        """Write one chunk of records (blocking; run it in a thread)."""
+        for row in rows:
+            if self._columns is None:
+                self._columns = list(row.keys())
+            if self._raw is None:
+                self._start_part()
+            values = [export_value(value) for value in row.values()]
+            if self.fmt == 'csv':
+                self._csv.writerow(values)
+            else:
+                self._text.write(json.dumps(dict(zip(self._columns, values)), ensure_ascii=False, default=str) + '\n')
+            self.rows += 1
+            if self.part_bytes and self._raw.tell() >= self.part_bytes - EXPORT_PART_SLACK:
+                self._finish_part()
+
+    def close(self):
+        if self._raw is not None:
+            self._finish_part()
+        return self.parts
+
+    def discard(self):
+        for part in self.parts:
+            part.close()
+        if self._raw is not None:
+            self._raw.close()
+        self.parts = []
+
+async def export_rows(pool, query, args, writer, chunk_rows=None):
+    """Stream `query` through a server-side cursor into `writer`; returns the row count."""
+    async with pool.acquire() as conn:
+        async with conn.transaction(readonly=True):  # cursors only live inside a transaction
+            cursor = await conn.cursor(query, *args)
+            while True:
+                rows = await cursor.fetch(chunk_rows or EXPORT_CHUNK_ROWS)
+                if not rows:
+                    break
+                await asyncio.to_thread(writer.write_rows, rows)
+    await asyncio.to_thread(writer.close)
+    return writer.rows
+
+@bot.command()
+@use_cooldown('export')  # COOLDOWN_EXPORT_USER, default once every 5 minutes
+async def export(ctx, *options):
+    """Download your collection: `.export [csv|jsonl] [gz]`."""
+    fmt, compress = 'csv', False
+    for option in options:
+        option = option.lower()
+        if option in EXPORT_FORMATS:
+            fmt = option
+        elif option in ('gz', 'gzip'):
+            compress = True
+        else:
+            bot.cooldowns.refund('export', ctx.author.id, ctx.channel.id)
+            await ctx.send("Dùng `.export [csv|jsonl] [gz]` nhé 💕")
+            return
+
+    upload_limit = ctx.guild.filesize_limit if ctx.guild else ALBUM_UPLOAD_LIMIT
+    writer = ExportWriter(fmt, compress, part_bytes=upload_limit)
+    try:
+        rows = await export_rows(bot.db, USER_EXPORT_QUERY, (ctx.author.id,), writer)
+        if not rows:
+            bot.cooldowns.refund('export', ctx.author.id, ctx.channel.id)
+            await ctx.send("Bạn chưa có thẻ nào để xuất 😢")
+            return
+
+        parts = writer.parts
+        for number, part in enumerate(parts, 1):
+            suffix = f'-part{number}' if len(parts) > 1 else ''
+            file = discord.File(fp=part, filename=f'lovebot-collection-{ctx.author.id}{suffix}.{writer.extension}')
+            content = f"Bộ sưu tập của {ctx.author.name}: {rows} thẻ 💕" if number == 1 else None
+            with timed('upload'):
+                await ctx.send(content, file=file)
+    finally:
+        writer.discard()
+
+@export.error
+async def export_error(ctx, error):
+    if isinstance(error, commands.CommandOnCooldown):
+        await ctx.send(f"Đợi {format_cooldown(error.retry_after)} nữa rồi xuất tiếp nhé 💕")
+    else:
+        bot.cooldowns.refund('export', ctx.author.id, ctx.channel.id)
+        print(f"Error in export command: {error}")
+        await ctx.send("An error occurred while exporting your collection.")
+
+
+#___________________________________________________________Admin___________________________________________________________
+@bot.command()
+@commands.is_owner()
+async def cachestats(ctx):
+    urls = bot.attachment_urls
+    images = bot.image_cache
+    pages = bot.album_pages
+    embed = discord.Embed(title="Cache stats", color=discord.Color.blue())
+    embed.add_field(
+        name="Card image URLs",
+        value=f"{urls.hits} reused / {urls.misses} uploaded\n{urls.bytes_saved / 1024 / 1024:.1f} MiB not re-uploaded",
+        inline=False
+    )
+    embed.add_field(
+        name="Card variants",
+        value=f"{images.hits} memory / {images.disk_hits} disk / {images.misses} rendered\n"
+              f"{images._memory.size / 1024 / 1024:.1f} MiB in memory",
+        inline=False
+    )
+    embed.add_field(name="Album pages", value=f"{pages.hits} hits / {pages.misses} rendered", inline=False)
+    drops = bot.drop_buffer
+    embed.add_field(
+        name="Drop buffer",
+        value=f"{len(drops)}/{drops.depth} ready, {drops.size / 1024 / 1024:.1f}/{drops.max_bytes / 1024 / 1024:.0f} MiB, "
+              f"refill {drops.rate:g}/s\n{drops.hits} hits / {drops.misses} misses / {drops.discarded} discarded",
+        inline=False
+    )
+    await ctx.send(embed=embed)
+@bot.command()
+@commands.is_owner()
+async def migrateblobs(ctx):
+    """Move every card image out of cards.image into the blob store."""
+    await ctx.send("Đang chuyển ảnh sang blob store...")
+    moved = await migrate_images_to_blobs(bot.db, bot.blob_store)
+    await ctx.send(f"Đã chuyển {moved} ảnh 💕")
+@bot.command()
+@commands.is_owner()
+async def perf(ctx):
+    """Latency percentiles (ms) per command and phase, and event-loop lag."""
+    metrics = bot.metrics
+    operations = sorted({dict(labels)['operation'] for name, labels in metrics.histograms if name == 'operation_seconds'})
+    phase_operations = sorted({dict(labels)['operation'] for name, labels in metrics.histograms if name == 'phase_seconds'})
+
+    def row(label, histogram, extra=''):
+        return (f"{label:<14}{histogram.count:>6}{histogram.percentile(50) * 1000:>7.0f}"
+                f"{histogram.percentile(95) * 1000:>7.0f}{histogram.percentile(99) * 1000:>7.0f}{extra}")
+
+    lines = [f"{'total':<14}{'n':>6}{'p50':>7}{'p95':>7}{'p99':>7}  err"]
+    for operation in operations:
+        errors = metrics.counters.get(('errors', (('operation', operation),)), 0)
+        lines.append(row(operation, metrics.get('operation_seconds', operation=operation), f"{errors:>5}"))
+
+    lines.append('')
+    lines.append(f"{'phase':<14}{'n':>6}{'p50':>7}{'p95':>7}{'p99':>7}")
+    for operation in phase_operations:
+        for phase in Metrics.PHASES:
+            histogram = metrics.get('phase_seconds', operation=operation, phase=phase)
+            if histogram is not None:
+                lines.append(row(f"{operation}.{phase}"[:14], histogram))
+
+    lag = metrics.get('loop_lag_seconds') or LatencyHistogram()
+    lines.append('')
+    lines.append(f"loop lag p50 {lag.percentile(50) * 1000:.1f} / p99 {lag.percentile(99) * 1000:.1f} / max {lag.max * 1000:.1f} ms")
+    lines.append(f"db pool {bot.db.get_size() - bot.db.get_idle_size()}/{bot.db.get_size()} busy, "
+                 f"{bot.renderer.pending} renders pending")
+    shards = ', '.join(f"{shard_id}: {shard.latency * 1000:.0f}" for shard_id, shard in sorted(bot.shards.items()))
+    lines.append(f"cluster {CLUSTER_ID + 1}/{CLUSTER_COUNT}, shard latency (ms) {shards or '-'}")
+    if bot.startup_seconds is not None:
+        first = f"{bot.first_command_seconds:.1f}s" if bot.first_command_seconds is not None else "-"
+        lines.append(f"startup {bot.startup_seconds:.1f}s, first command {first}")
+
+    text = '\n'.join(lines)
+    if len(text) > 4000:
+        text = text[:4000] + '\n...'
+    await ctx.send(embed=discord.Embed(title="Performance", description=f"```\n{text}\n```", color=discord.Color.blue()))
 # Run the bot  
 if __name__ == "__main__":  
     token = os.getenv('DISCORD_TOKEN')  